@@ -1,13 +1,19 @@
-import os
-import gym_super_mario_bros
+import argparse
 import gym
-from nes_py.wrappers import JoypadSpace
-from gym_super_mario_bros.actions import SIMPLE_MOVEMENT
-from gym.wrappers import GrayScaleObservation
-from stable_baselines3.common.vec_env import VecFrameStack, DummyVecEnv
 from stable_baselines3 import PPO
-from stable_baselines3.common.callbacks import BaseCallback
-from stable_baselines3.common.monitor import Monitor
+from marioCallbacks import (
+    PhaseTimer,
+    ProfilingCallback,
+    AsyncCheckpointCallback,
+    EvaluationCallback,
+    CurriculumCallback,
+    latest_checkpoint,
+    KEEP_LAST,
+    KEEP_BEST,
+    EVAL_STAGES,
+)
+from marioEnv import make_vec_env, add_preprocessing_arguments, preprocessing_from_args
+from marioWrappers import add_render_arguments, add_recording_arguments, stage_env_id
 
 ################################################################################
 # CONSTANTS
@@ -15,36 +21,20 @@ from stable_baselines3.common.monitor import Monitor
 CHECKPOINT_DIR = "./models"  # Where to save the model
 LOG_DIR = "./logs"  # Where to save the tensorboard logs
 
+ENV_ID = "SuperMarioBros-1-1-v3"  # The environment to train on
+ENV_VERSION = "v3"  # Its ROM version, for the stages of --curriculum
+NUMBER_OF_WORKERS = 1  # How many environments to run in parallel (one process each)
+SEED = 0  # Seed for the first environment, each other worker gets SEED + its index
+
 
-SAVE_FREQUENCY = 100000  # How many steps should pass before saving the model
+SAVE_FREQUENCY = 100000  # How many steps (of all the workers together) should pass before saving the model
+EVAL_FREQUENCY = 500000  # How many steps between evaluations of the model (0 for none)
 
 LEARNING_RATE = 0.00001  # Learning rate for the model
 TOTAL_TIMESTEPS = 20000000  # Total number of steps to train the model
 NUMBER_OF_STEPS = 512  # Number of steps to run on each environment per update
 
 
-################################################################################
-# CALLBACK FOR SAVING PROGRESS
-class TrainAndLoggingCallback(BaseCallback):
-    def __init__(self, check_freq, save_path, verbose=1):
-        super(TrainAndLoggingCallback, self).__init__(verbose)
-        self.check_freq = check_freq
-        self.save_path = save_path
-
-    def _init_callback(self):
-        if self.save_path is not None:
-            os.makedirs(self.save_path, exist_ok=True)
-
-    def _on_step(self):
-        if self.n_calls % self.check_freq == 0:
-            model_path = os.path.join(
-                self.save_path, "best_model_{}".format(self.n_calls)
-            )
-            self.model.save(model_path)
-
-        return True
-
-
 #################################################################################
 # TIME LIMIT WRAPPER
 class TimeLimitWrapper(gym.Wrapper):
@@ -85,37 +75,176 @@ class TimeLimitWrapper(gym.Wrapper):
 
 
 #################################################################################
-# CREATE AND PREPROCESS THE ENVIRONMENT
-env = gym_super_mario_bros.make(
-    "SuperMarioBros-1-1-v3", apply_api_compatibility=True, render_mode="human"
-)  # Create the environment
-
-env = Monitor(env, LOG_DIR)  # Create a monitor for tensorboard logging
-
-# env = TimeLimitWrapper(env, max_steps=10000) # Set a time limit for each episode
-
-# The following lines reduce the information being fed into the model/reduce the state space
-JoypadSpace.reset = lambda self, **kwargs: self.env.reset(
-    **kwargs
-)  # A fix for the JoypadSpace wrapper
-env = JoypadSpace(env, SIMPLE_MOVEMENT)  # Set the joypad space to simple movement
-# env = GrayScaleObservation(env, keep_dim=True)  # Convert the image to grayscale
-env = DummyVecEnv([lambda: env])  # Create a dummy vector environment
-env = VecFrameStack(env, 4, channels_order="last")  # Stack the last 4 frames together
-
-#################################################################################
-# INITIALISE THE CALLBACK AND PPO MODEL
-
-callback = TrainAndLoggingCallback(check_freq=SAVE_FREQUENCY, save_path=CHECKPOINT_DIR)
-
-model = PPO(
-    "CnnPolicy",
-    env,
-    verbose=1,
-    tensorboard_log=LOG_DIR,
-    learning_rate=LEARNING_RATE,
-    n_steps=NUMBER_OF_STEPS,
-)
-
-model.learn(total_timesteps=TOTAL_TIMESTEPS, callback=callback)
-model.save("mario_ppo")
+# COMMAND LINE ARGUMENTS
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the PPO Mario agent.")
+    parser.add_argument("--learning-rate", type=float, default=LEARNING_RATE, help="learning rate for the model")
+    parser.add_argument(
+        "--n-steps", type=int, default=NUMBER_OF_STEPS, help="steps to run on each environment per update"
+    )
+    parser.add_argument(
+        "--total-timesteps", type=int, default=TOTAL_TIMESTEPS, help="total number of steps to train for"
+    )
+    parser.add_argument("--log-dir", default=LOG_DIR, help="where to save the tensorboard and monitor logs")
+    parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR, help="where to save the checkpoints")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=NUMBER_OF_WORKERS,
+        help="number of parallel environments, each in its own process when > 1",
+    )
+    parser.add_argument("--seed", type=int, default=SEED, help="seed for the first worker")
+    parser.add_argument(
+        "--shared-memory",
+        action="store_true",
+        help="have the workers write their frames into shared memory instead of sending them through pipes",
+    )
+    parser.add_argument(
+        "--max-episode-steps", type=int, default=None, help="end episodes after this many steps (default no limit)"
+    )
+    parser.add_argument(
+        "--snapshots",
+        action="store_true",
+        help="start some episodes from snapshots taken further along the stage",
+    )
+    parser.add_argument(
+        "--curriculum",
+        nargs="+",
+        default=None,
+        metavar="STAGE",
+        help="train on these stages (e.g. 1-1 1-2 2-1) instead of 1-1, playing the ones the "
+        "model is failing on more often",
+    )
+    parser.add_argument(
+        "--init-model",
+        default=None,
+        help="start from this model's weights, e.g. one pretrained by marioDataset.py "
+        "(it must use the same preprocessing options)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="carry on from the latest checkpoint in --checkpoint-dir (and its tensorboard run)",
+    )
+    parser.add_argument(
+        "--keep-last", type=int, default=KEEP_LAST, help="how many of the most recent checkpoints to keep"
+    )
+    parser.add_argument(
+        "--keep-best",
+        type=int,
+        default=KEEP_BEST,
+        help="how many of the highest scoring checkpoints to keep as well",
+    )
+    parser.add_argument(
+        "--eval-freq",
+        type=int,
+        default=EVAL_FREQUENCY,
+        help="evaluate the model every this many steps in other processes, keeping the best "
+        "as best_model.zip in --checkpoint-dir (0 to never evaluate)",
+    )
+    parser.add_argument("--eval-stages", nargs="+", default=EVAL_STAGES, help="stages to evaluate on")
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="log the time spent in each phase of training, the steps per second and the memory "
+        "used to tensorboard (under timing/ and memory/)",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="PATH",
+        help="also profile the training process with cProfile and write the stats to PATH "
+        "(e.g. train.prof, for snakeviz or pstats)",
+    )
+    add_render_arguments(parser)
+    add_recording_arguments(parser)
+    add_preprocessing_arguments(parser)
+    return parser.parse_args()
+
+
+# The environments and model are only created when this file is run directly,
+# since the worker processes re-import it on Windows.
+if __name__ == "__main__":
+    args = parse_args()
+
+    #############################################################################
+    # CREATE AND PREPROCESS THE ENVIRONMENT
+    # env = TimeLimitWrapper(env, max_steps=10000) # Set a time limit for each episode
+    # With a curriculum, every worker starts on its first stage and changes stage on reset
+    env_id = ENV_ID if args.curriculum is None else stage_env_id(args.curriculum[0], ENV_VERSION)
+    env = make_vec_env(
+        env_id,
+        n_workers=args.workers,
+        seed=args.seed,
+        log_dir=args.log_dir,
+        headless=args.headless,
+        render_every=args.render_every,
+        video_dir=args.video_dir,
+        snapshots=args.snapshots,
+        record_dir=args.record,
+        record_frames=args.record_frames,
+        timings=args.timings,
+        max_episode_steps=args.max_episode_steps,
+        shared_memory=args.shared_memory,
+        curriculum=args.curriculum,
+        resume=args.resume,  # Keep the episodes already in the monitor files
+        **preprocessing_from_args(args),
+    )  # Create the environments, with a monitor for tensorboard logging
+
+    #############################################################################
+    # INITIALISE THE CALLBACK AND PPO MODEL
+
+    # Checkpoints are written on a background thread, so training doesn't stop
+    # while they're saved, and only the latest and best few are kept
+    timer = PhaseTimer()
+    checkpoints = AsyncCheckpointCallback(
+        SAVE_FREQUENCY,
+        args.checkpoint_dir,
+        keep_last=args.keep_last,
+        keep_best=args.keep_best,
+        timer=timer,
+        score_reward=args.eval_freq <= 0,  # Evaluated checkpoints are scored by the evaluations instead
+    )
+    callback = [checkpoints]
+    if args.eval_freq > 0:
+        # Evaluate checkpoints on other stages in a process pool, without pausing training
+        callback.append(
+            EvaluationCallback(
+                checkpoints,
+                args.eval_freq,
+                stages=args.eval_stages,
+                preprocessing=preprocessing_from_args(args),
+            )
+        )
+    if args.curriculum is not None:
+        # Play the stages the model is failing on more often
+        callback.append(CurriculumCallback(args.curriculum, verbose=1))
+    if args.timings or args.profile is not None:
+        callback.append(ProfilingCallback(timer, args.profile))  # Log where the time goes
+
+    resume_path = latest_checkpoint(args.checkpoint_dir) if args.resume else None
+    if resume_path is not None:
+        # Carry on with the settings, step count and optimiser state it was saved with
+        print("Resuming from " + resume_path)
+        model = PPO.load(resume_path, env=env, tensorboard_log=args.log_dir)
+    else:
+        model = PPO(
+            "CnnPolicy",
+            env,
+            verbose=1,
+            tensorboard_log=args.log_dir,
+            learning_rate=args.learning_rate,
+            n_steps=args.n_steps,
+            seed=args.seed,
+        )
+    if args.init_model is not None and resume_path is None:
+        model.set_parameters(args.init_model)  # Keeps the settings above, only loads the weights
+
+    # When resuming, only train for the rest of --total-timesteps, and keep logging to the same run
+    model.learn(
+        total_timesteps=max(args.total_timesteps - model.num_timesteps, 0),
+        callback=callback,
+        reset_num_timesteps=resume_path is None,
+    )
+    env.close()  # Also writes the end of any recordings
+    model.save("mario_ppo")
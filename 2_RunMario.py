@@ -1,28 +1,41 @@
-import gym_super_mario_bros
-import gym
-from nes_py.wrappers import JoypadSpace
-from gym_super_mario_bros.actions import SIMPLE_MOVEMENT
-from gym.wrappers import GrayScaleObservation
-from stable_baselines3.common.vec_env import VecFrameStack, DummyVecEnv
-from stable_baselines3 import PPO
+import argparse
+from marioEnv import make_vec_env, add_preprocessing_arguments, preprocessing_from_args
+from marioWrappers import add_render_arguments, add_recording_arguments
+from marioExport import load_policy
 
 #################################################################################
 # CONSTANTS
 MODEL_PATH = "./models/model_best_v3_highlearningrate.zip"  # Path to the saved model
+ENV_ID = "SuperMarioBros-v3"  # The environment to run the model on
+
+#################################################################################
+# COMMAND LINE ARGUMENTS
+parser = argparse.ArgumentParser(description="Run the PPO Mario agent.")
+parser.add_argument(
+    "--model",
+    default=MODEL_PATH,
+    help="the saved model, or a policy exported by marioExport.py (.pt or .onnx) for faster steps",
+)
+parser.add_argument("--threads", type=int, default=None, help="threads to run the model with")
+add_render_arguments(parser)
+add_recording_arguments(parser)
+add_preprocessing_arguments(parser)  # Must match how the model was trained
+args = parser.parse_args()
 
 #################################################################################
 # PREPROCESS AND SETUP
-env = gym_super_mario_bros.make(
-    "SuperMarioBros-v3", apply_api_compatibility=True, render_mode="human"
+env = make_vec_env(
+    ENV_ID,
+    headless=args.headless,
+    render_every=args.render_every,
+    video_dir=args.video_dir,
+    record_dir=args.record,
+    record_frames=args.record_frames,
+    **preprocessing_from_args(args),
 )
-JoypadSpace.reset = lambda self, **kwargs: self.env.reset(**kwargs)
-env = JoypadSpace(env, SIMPLE_MOVEMENT)
-# env = GrayScaleObservation(env, keep_dim=True)
-env = DummyVecEnv([lambda: env])
-env = VecFrameStack(env, 4, channels_order="last")
 
-# Load the trained model
-model = PPO.load(MODEL_PATH)
+# Load the trained model (or its exported policy)
+model = load_policy(args.model, args.threads)
 
 # Run the model
 for i in range(10):
@@ -0,0 +1,782 @@
+import os
+import sys
+import json
+import platform
+import argparse
+import subprocess
+import tempfile
+import time
+import datetime
+import numpy as np
+import cv2 as cv
+import torch
+from stable_baselines3 import PPO
+from nes_py.wrappers import JoypadSpace
+from gym_super_mario_bros.actions import COMPLEX_MOVEMENT
+import ruleBasedMario
+from marioRam import locate_objects_ram
+from marioEnv import make_vec_env, add_preprocessing_arguments, preprocessing_from_args
+from marioWrappers import make_mario, stage_env_id, get_nes_env
+from marioExport import record_observations
+from marioCallbacks import snapshot_model
+
+# Benchmarks for the Mario environments and agents.
+# e.g. "poetry run python benchmarkMario.py envs --workers 1 4 8 --vec-envs subproc shared"
+#      "poetry run python benchmarkMario.py suite --output results.json" (everything, as JSON)
+#      "poetry run python benchmarkMario.py compare old.json results.json"
+
+################################################################################
+# CONSTANTS
+
+ENV_ID = "SuperMarioBros-1-1-v3"  # The environment to benchmark
+BENCHMARK_STEPS = 2000  # How many vector steps to time for each configuration
+VEC_ENVS = ["dummy", "subproc", "shared"]  # One process, a process per worker with pipes, and with shared memory
+
+FRAMES_PATH = "./benchmark_frames.npz"  # Recorded frames for the perception benchmarks
+FRAME_STAGES = ["1-1", "1-2", "4-1"]  # Stages the frames are recorded on
+FRAMES_PER_STAGE = 100  # Frames recorded on each stage
+PERCEPTION_TOLERANCE = 4  # Pixels that the vision and memory locations of an object can differ by
+
+# The suite (see run_suite)
+SUITE_GROUPS = ["env", "perception", "agent", "ppo", "checkpoint"]
+SUITE_REPEATS = 3  # Every measurement is repeated this many times, and the median kept
+SUITE_ENV_STEPS = 1000  # Steps timed per environment measurement
+SUITE_DETECTION_MODES = ["full", "roi", "pyramid", "tracked"]
+SUITE_BATCH_SIZES = [1, 4, 16]  # Observations per PPO.predict call
+SUITE_PREDICT_CALLS = 20  # PPO.predict calls timed per batch size
+REGRESSION_THRESHOLD = 0.1  # A metric 10% worse than before is a regression
+
+
+################################################################################
+# ENVIRONMENT STEPPING
+
+
+def benchmark_vec_env(n_workers, steps=BENCHMARK_STEPS, env_id=ENV_ID, vec_env="subproc", **preprocessing):
+    """
+    Time random actions through the same vectorised environment used for training.
+
+    :param n_workers: (int) number of parallel environments
+    :param steps: (int) number of vector steps to time
+    :param env_id: (str) gym_super_mario_bros environment id
+    :param vec_env: (str) "dummy" (every worker in this process), "subproc" (frames sent
+        through pipes, the default for training) or "shared" (SharedMemoryVecEnv)
+    :param preprocessing: frame_skip, grayscale and frame_size for make_vec_env
+    :return: (float) agent steps per second, summed over all workers
+    """
+    env = make_vec_env(
+        env_id,
+        n_workers=n_workers,
+        subprocesses=vec_env != "dummy",
+        shared_memory=vec_env == "shared",
+        **preprocessing,
+    )
+    env.reset()
+    rng = np.random.default_rng(0)
+    actions = rng.integers(env.action_space.n, size=(steps, n_workers))
+    start = time.perf_counter()
+    for step_actions in actions:
+        env.step(step_actions)
+    elapsed = time.perf_counter() - start
+    env.close()
+    return steps * n_workers / elapsed
+
+
+def run_envs(args):
+    preprocessing = preprocessing_from_args(args)
+    baseline = None
+    print(f"{'vec env':>8} {'workers':>8} {'steps/sec':>12} {'frames/sec':>12} {'speedup':>8}")
+    for n_workers in args.workers:
+        for vec_env in args.vec_envs:
+            steps_per_second = benchmark_vec_env(n_workers, args.steps, args.env_id, vec_env, **preprocessing)
+            frames_per_second = steps_per_second * preprocessing["frame_skip"]
+            if baseline is None:
+                baseline = steps_per_second
+            print(
+                f"{vec_env:>8} {n_workers:>8} {steps_per_second:>12.1f} {frames_per_second:>12.1f}"
+                f" {steps_per_second / baseline:>7.2f}x"
+            )
+
+
+################################################################################
+# RECORDED FRAMES
+
+
+def record_frames(path=FRAMES_PATH, stages=FRAME_STAGES, frames_per_stage=FRAMES_PER_STAGE):
+    """
+    Record consecutive frames from some stages, so perception can be timed on the same frames every time.
+
+    Mario runs right and jumps regularly, which is enough to see most kinds of
+    objects without depending on the agent being benchmarked.
+
+    :param path: (str) .npz file to write
+    :param stages: ([str]) stages to record, e.g. ["1-1", "1-2"]
+    :param frames_per_stage: (int) consecutive frames to record on each stage
+    """
+    frames, statuses, x_positions, lives, frame_stages = [], [], [], [], []
+    for stage in stages:
+        env = JoypadSpace(make_mario(stage_env_id(stage, "v0"), headless=True), COMPLEX_MOVEMENT)
+        env.reset()
+        for step in range(frames_per_stage):
+            action = 4 if step % 60 < 20 else 3  # right + B, jumping for 20 of every 60 frames
+            obs, reward, terminated, truncated, info = env.step(action)
+            frames.append(obs.copy())  # the emulator reuses its screen buffer
+            statuses.append(info["status"])
+            x_positions.append(info["x_pos"])
+            lives.append(info["life"])
+            frame_stages.append(stage)
+            if terminated or truncated:
+                env.reset()
+        env.close()
+    np.savez_compressed(
+        path,
+        frames=np.array(frames),
+        statuses=np.array(statuses),
+        x_positions=np.array(x_positions),
+        lives=np.array(lives),
+        stages=np.array(frame_stages),
+    )
+
+
+def load_frames(path=FRAMES_PATH):
+    """
+    Load the recorded frames, recording them first if the file doesn't exist.
+
+    :param path: (str) .npz file written by record_frames
+    :return: (dict) frames, statuses, x_positions, lives and stages arrays
+    """
+    if not os.path.exists(path):
+        print("Recording frames to " + path)
+        record_frames(path)
+    with np.load(path) as data:
+        corpus = {key: data[key] for key in data.files}
+    corpus.setdefault("lives", np.zeros(len(corpus["frames"]), dtype=int))  # older recordings
+    return corpus
+
+
+def run_record_frames(args):
+    record_frames(args.frames, args.stages, args.frames_per_stage)
+    print("Recorded {} frames to {}".format(len(args.stages) * args.frames_per_stage, args.frames))
+
+
+################################################################################
+# OBJECT DETECTION
+
+
+def _frame_infos(corpus):
+    # the parts of the info dict that the agent uses, for every recorded frame
+    for status, x_pos, life, stage in zip(
+        corpus["statuses"], corpus["x_positions"], corpus["lives"], corpus["stages"]
+    ):
+        world, stage_number = str(stage).split("-")
+        yield dict(status=str(status), x_pos=int(x_pos), life=int(life), world=int(world), stage=int(stage_number))
+
+
+def _detection_set(object_locations):
+    return {
+        (category, name, int(x), int(y))
+        for category, items in object_locations.items()
+        for (x, y), dimensions, name in items
+    }
+
+
+def detect_frames(corpus, mode):
+    """
+    Run locate_objects on every recorded frame in order, following Mario like make_action does.
+
+    :param corpus: (dict) from load_frames
+    :param mode: (str) one of ruleBasedMario's detection modes, or "tracked" to use an ObjectTracker
+    :return: (([dict], float)) the object locations of every frame, and frames per second
+    """
+    results = []
+    mario_hint, stage = None, None
+    tracker = ruleBasedMario.ObjectTracker()
+    start = time.perf_counter()
+    for frame, info in zip(corpus["frames"], _frame_infos(corpus)):
+        if (info["world"], info["stage"]) != stage:
+            mario_hint, stage = None, (info["world"], info["stage"])
+        if mode == "tracked":
+            object_locations = tracker.update(frame, info)
+        else:
+            object_locations = ruleBasedMario.locate_objects(frame, info["status"], mode, mario_hint)
+        if object_locations["mario"]:
+            mario_hint = object_locations["mario"][0][0]
+        results.append(object_locations)
+    return results, len(results) / (time.perf_counter() - start)
+
+
+def decide_frames(corpus, mode):
+    """
+    Run make_action on every recorded frame in order with the given detection mode.
+
+    :param corpus: (dict) from load_frames
+    :param mode: (str) one of ruleBasedMario's detection modes, or "tracked"
+    :return: ([int]) the action chosen for every frame
+    """
+    ruleBasedMario.DETECTION_MODE = "full" if mode == "tracked" else mode
+    tracker = ruleBasedMario.ObjectTracker() if mode == "tracked" else None
+    actions = []
+    stage = None
+    for frame, info in zip(corpus["frames"], _frame_infos(corpus)):
+        if (info["world"], info["stage"]) != stage:
+            ruleBasedMario.last_mario_location, stage = None, (info["world"], info["stage"])
+        actions.append(ruleBasedMario.make_action(frame, info, 0, None, 3, tracker))
+    return actions
+
+
+def compare_detections(reference, results):
+    """
+    Compare detections against the full screen search.
+
+    :param reference: ([dict]) object locations from the "full" mode
+    :param results: ([dict]) object locations from another mode, for the same frames
+    :return: (dict) recall, precision and recall_near_mario (recall of the objects
+        inside the region around Mario that the faster modes search)
+    """
+    found = matched = expected = near = near_matched = 0
+    for full, other in zip(reference, results):
+        full_set, other_set = _detection_set(full), _detection_set(other)
+        found += len(other_set)
+        expected += len(full_set)
+        matched += len(full_set & other_set)
+        if full["mario"]:
+            x0, y0, x1, y1 = ruleBasedMario._region_around(
+                *full["mario"][0][0], ruleBasedMario.ROI_RADIUS_X, ruleBasedMario.ROI_RADIUS_Y
+            )
+            near_set = {d for d in full_set if x0 <= d[2] < x1 and y0 <= d[3] < y1 or d[0] == "mario"}
+            near += len(near_set)
+            near_matched += len(near_set & other_set)
+    return dict(
+        recall=matched / max(expected, 1),
+        precision=matched / max(found, 1),
+        recall_near_mario=near_matched / max(near, 1),
+    )
+
+
+def run_detect(args):
+    corpus = load_frames(args.frames)
+    stages = list(dict.fromkeys(corpus["stages"]))  # in recorded order
+    reference, reference_fps = detect_frames(corpus, "full")
+    reference_actions = np.array(decide_frames(corpus, "full"))
+    print(
+        f"{'mode':>8} {'stage':>6} {'frames/sec':>11} {'recall':>7} {'precision':>9}"
+        f" {'near Mario':>10} {'same action':>11}"
+    )
+    for mode in args.modes:
+        results, fps = detect_frames(corpus, mode)
+        actions = np.array(decide_frames(corpus, mode))
+        # agreement is shown per stage, since dark stages (e.g. 1-2) produce far more
+        # (mostly spurious) matches than the others and would swamp the totals
+        for stage in stages + ["all"]:
+            selected = np.ones(len(actions), dtype=bool) if stage == "all" else corpus["stages"] == stage
+            agreement = compare_detections(
+                [r for r, keep in zip(reference, selected) if keep],
+                [r for r, keep in zip(results, selected) if keep],
+            )
+            same_action = np.mean(actions[selected] == reference_actions[selected])
+            fps_column = "{:.1f}".format(fps) if stage == "all" else ""
+            print(
+                f"{mode:>8} {stage:>6} {fps_column:>11}"
+                f" {agreement['recall']:>7.3f} {agreement['precision']:>9.3f}"
+                f" {agreement['recall_near_mario']:>10.3f} {same_action:>11.3f}"
+            )
+
+
+################################################################################
+# TEMPLATE MATCHING
+
+
+def match_category(grays, statuses, category):
+    """
+    Search every frame for one category of objects, the same way locate_objects does.
+
+    :param grays: ([np.ndarray]) greyscale frames
+    :param statuses: ([str]) Mario's status in each frame (which Mario templates to use)
+    :param category: (str) a template category, or "pipe" for the pipes (which "block" leaves out)
+    :return: (([set], float)) the (x, y, width, height, name) of every object found in each frame,
+        and the milliseconds per frame
+    """
+    results = []
+    start = time.perf_counter()
+    for gray, status in zip(grays, statuses):
+        cache = {}
+        found = set()
+        if category == "pipe":
+            found.update((x, y, w, h, name) for (x, y), (w, h), name in ruleBasedMario._locate_pipe(gray, cache=cache))
+        for object_name, object_templates in ruleBasedMario.templates.get(category, {}).items():
+            if object_name == "pipe" or (category == "mario" and object_name != status):
+                continue
+            stop_early = category == "mario"
+            for (x, y), (w, h) in ruleBasedMario._locate_object(gray, object_templates, stop_early, cache=cache):
+                found.add((int(x), int(y), w, h, object_name))
+        results.append(found)
+    return results, (time.perf_counter() - start) * 1000 / len(grays)
+
+
+def run_match(args):
+    corpus = load_frames(args.frames)
+    grays = [cv.cvtColor(frame, cv.COLOR_BGR2GRAY) for frame in corpus["frames"]]
+    statuses = [str(status) for status in corpus["statuses"]]
+    stages = list(dict.fromkeys(corpus["stages"]))  # in recorded order
+    engine = ruleBasedMario.MATCH_ENGINE
+    print(f"{'category':>11} {'loop ms':>8} {'batched ms':>10} {'speedup':>8}"
+          + "".join(f" {'same ' + stage:>9}" for stage in stages))
+    for category in list(ruleBasedMario.templates) + ["pipe"]:
+        ruleBasedMario.MATCH_ENGINE = "loop"
+        reference, loop_ms = match_category(grays, statuses, category)
+        ruleBasedMario.MATCH_ENGINE = "batched"
+        results, batched_ms = match_category(grays, statuses, category)
+        # the loop engine also "matches" flat areas (e.g. the black background of 1-2),
+        # where its scores are NaN or infinite, so the frames won't all be the same
+        same = np.array([a == b for a, b in zip(reference, results)])
+        print(f"{category:>11} {loop_ms:>8.2f} {batched_ms:>10.2f} {loop_ms / batched_ms:>7.2f}x"
+              + "".join(f" {np.mean(same[corpus['stages'] == stage]):>9.3f}" for stage in stages))
+    ruleBasedMario.MATCH_ENGINE = engine
+
+
+def run_palette(args):
+    corpus = load_frames(args.frames)
+    statuses = [str(status) for status in corpus["statuses"]]
+    stages = list(dict.fromkeys(corpus["stages"]))  # in recorded order
+    engine = ruleBasedMario.MATCH_ENGINE
+    # converting the frames is part of the cost, once per frame
+    start = time.perf_counter()
+    grays = [cv.cvtColor(frame, cv.COLOR_BGR2GRAY) for frame in corpus["frames"]]
+    gray_ms = (time.perf_counter() - start) * 1000 / len(grays)
+    start = time.perf_counter()
+    palettes = [ruleBasedMario.to_palette(frame) for frame in corpus["frames"]]
+    palette_ms = (time.perf_counter() - start) * 1000 / len(palettes)
+    print(f"{'category':>11} {'grey ms':>8} {'palette ms':>10} {'speedup':>8}"
+          + "".join(f" {'recall ' + stage:>11} {'prec. ' + stage:>10}" for stage in stages))
+    print(f"{'(convert)':>11} {gray_ms:>8.2f} {palette_ms:>10.2f} {gray_ms / palette_ms:>7.2f}x")
+    total_gray, total_palette = gray_ms, palette_ms
+    for category in list(ruleBasedMario.templates) + ["pipe"]:
+        ruleBasedMario.MATCH_ENGINE = args.engine
+        reference, reference_ms = match_category(grays, statuses, category)
+        ruleBasedMario.MATCH_ENGINE = "palette"
+        results, results_ms = match_category(palettes, statuses, category)
+        total_gray, total_palette = total_gray + reference_ms, total_palette + results_ms
+        columns = ""
+        for stage in stages:
+            selected = corpus["stages"] == stage
+            expected = sum(len(r) for r, keep in zip(reference, selected) if keep)
+            found = sum(len(r) for r, keep in zip(results, selected) if keep)
+            matched = sum(len(a & b) for a, b, keep in zip(reference, results, selected) if keep)
+            recall = "{:.3f}".format(matched / expected) if expected else "-"  # (nothing to find)
+            precision = "{:.3f}".format(matched / found) if found else "-"
+            columns += f" {recall:>11} {precision:>10}"
+        print(f"{category:>11} {reference_ms:>8.2f} {results_ms:>10.2f} {reference_ms / results_ms:>7.2f}x" + columns)
+    print(f"{'total':>11} {total_gray:>8.2f} {total_palette:>10.2f} {total_gray / total_palette:>7.2f}x")
+    ruleBasedMario.MATCH_ENGINE = engine
+
+
+################################################################################
+# READING OBJECTS FROM MEMORY
+
+
+def _matched(objects, others, tolerance):
+    # how many of objects have one of others with the same name within tolerance pixels
+    return sum(
+        any(name == other_name and abs(x - ox) <= tolerance and abs(y - oy) <= tolerance
+            for (ox, oy), _, other_name in others)
+        for (x, y), _, name in objects
+    )
+
+
+def compare_perception(stage, steps, every=2, tolerance=PERCEPTION_TOLERANCE):
+    """
+    Check the memory backend against the vision backend while Mario runs through a stage.
+
+    Mario runs right and jumps regularly, as in record_frames. Memory is one frame
+    ahead of the screen, so each screen is compared with the memory from the step
+    before it.
+
+    :param stage: (str) the stage to run, e.g. "1-1"
+    :param steps: (int) how many frames to run for
+    :param every: (int) only compare every this many frames
+    :param tolerance: (int) pixels that the two locations of an object can differ by
+    :return: (dict) category -> [objects found by vision, of those also in memory, objects
+        in memory that vision has templates for, of those also found by vision], and
+        "seconds" -> [vision, memory] seconds spent locating, and "same action" -> fraction
+        of frames where make_action made the same choice with both
+    """
+    template_names = {name for category in ruleBasedMario.templates for name in ruleBasedMario.templates[category]}
+    counts = {category: [0, 0, 0, 0] for category in ruleBasedMario.templates}
+    counts["seconds"] = [0.0, 0.0]
+    same_actions = []
+    perception = ruleBasedMario.PERCEPTION
+    env = JoypadSpace(make_mario(stage_env_id(stage, "v0"), headless=True), COMPLEX_MOVEMENT)
+    env.reset()
+    ram = get_nes_env(env).ram
+    previous_ram = ram.copy()
+    for step in range(steps):
+        action = 4 if step % 60 < 20 else 3  # right + B, jumping for 20 of every 60 frames
+        obs, reward, terminated, truncated, info = env.step(action)
+        if terminated or truncated:
+            env.reset()
+        elif step % every == 0:
+            start = time.perf_counter()
+            vision = ruleBasedMario.locate_objects(obs, info["status"], "full")
+            middle = time.perf_counter()
+            memory = locate_objects_ram(previous_ram, info["status"])
+            counts["seconds"][0] += middle - start
+            counts["seconds"][1] += time.perf_counter() - middle
+            for category in vision:
+                known = [o for o in memory[category] if o[2] in template_names]
+                counts[category][0] += len(vision[category])
+                counts[category][1] += _matched(vision[category], memory[category], tolerance)
+                counts[category][2] += len(known)
+                counts[category][3] += _matched(known, vision[category], tolerance)
+            actions = []
+            for ruleBasedMario.PERCEPTION in ("vision", "ram"):
+                actions.append(ruleBasedMario.make_action(obs, info, step, env, action))
+            same_actions.append(actions[0] == actions[1])
+        previous_ram = ram.copy()
+    env.close()
+    ruleBasedMario.PERCEPTION = perception
+    counts["same action"] = float(np.mean(same_actions))
+    return counts
+
+
+def run_ram(args):
+    print(f"{'stage':>6} {'category':>11} {'vision':>7} {'in memory':>9} {'memory':>7} {'on screen':>9}")
+    for stage in args.stages:
+        counts = compare_perception(stage, args.steps, args.every)
+        for category in ruleBasedMario.templates:
+            found, matched, known, seen = counts[category]
+            print(
+                f"{stage:>6} {category:>11} {found:>7} {matched / max(found, 1):>9.3f}"
+                f" {known:>7} {seen / max(known, 1):>9.3f}"
+            )
+        vision_seconds, memory_seconds = counts["seconds"]
+        print(
+            f"{stage:>6} vision {vision_seconds / max(memory_seconds, 1e-9):.0f}x slower than memory"
+            f", same action {counts['same action']:.3f}"
+        )
+
+
+################################################################################
+# SUITE
+
+
+def _metric(values, unit, better):
+    # a suite result: the median of the repeated measurements, and whether higher or lower is better
+    return dict(value=float(np.median(values)), values=[float(v) for v in values], unit=unit, better=better)
+
+
+def _step_rate(step, reset, steps):
+    # steps per second of step(i), calling reset() (untimed) whenever it returns True
+    elapsed = 0.0
+    for i in range(steps):
+        start = time.perf_counter()
+        done = step(i)
+        elapsed += time.perf_counter() - start
+        if done:
+            reset()
+    return steps / elapsed
+
+
+def suite_env(steps=SUITE_ENV_STEPS, repeats=SUITE_REPEATS, **preprocessing):
+    """
+    Time stepping 1-1 with the same random actions at each level of the environment stack.
+
+    :param steps: (int) steps per measurement
+    :param repeats: (int) measurements of each
+    :param preprocessing: frame_skip, grayscale and frame_size for the vectorised environment
+    :return: (dict) metric name -> result
+    """
+    actions = np.random.default_rng(0).integers(len(COMPLEX_MOVEMENT), size=steps)
+    env = JoypadSpace(make_mario(ENV_ID, headless=True), COMPLEX_MOVEMENT)
+    nes_env = get_nes_env(env)
+    buttons = [env._action_map[action] for action in actions]
+    emulator, joypad, vec_env = [], [], []
+    for _ in range(repeats):
+        nes_env.reset()
+        emulator.append(_step_rate(lambda i: nes_env.step(buttons[i])[2], nes_env.reset, steps))
+        env.reset()
+        joypad.append(_step_rate(lambda i: any(env.step(actions[i])[2:4]), env.reset, steps))
+        vec_env.append(benchmark_vec_env(1, steps, vec_env="dummy", **preprocessing))
+    env.close()
+    return {
+        "env/emulator_steps_per_second": _metric(emulator, "steps/s", "higher"),
+        "env/joypad_steps_per_second": _metric(joypad, "steps/s", "higher"),
+        "env/vec_env_steps_per_second": _metric(vec_env, "steps/s", "higher"),
+    }
+
+
+def suite_perception(corpus, modes=SUITE_DETECTION_MODES, repeats=SUITE_REPEATS):
+    """
+    Time locate_objects on the recorded frames in each detection mode.
+
+    :param corpus: (dict) from load_frames
+    :param modes: ([str]) detection modes, or "tracked"
+    :param repeats: (int) measurements of each
+    :return: (dict) metric name -> result
+    """
+    detect_frames({key: values[:1] for key, values in corpus.items()}, "full")  # loads the templates (not timed)
+    return {
+        "perception/{}_frames_per_second".format(mode): _metric(
+            [detect_frames(corpus, mode)[1] for _ in range(repeats)], "frames/s", "higher"
+        )
+        for mode in modes
+    }
+
+
+def suite_agent(corpus, repeats=SUITE_REPEATS):
+    """
+    Time make_action (locating the objects on the whole screen and choosing an action) on
+    every recorded frame.
+
+    :param corpus: (dict) from load_frames
+    :param repeats: (int) measurements
+    :return: (dict) metric name -> result
+    """
+    mode = ruleBasedMario.DETECTION_MODE
+    ruleBasedMario.DETECTION_MODE = "full"
+    means, tails = [], []
+    for _ in range(repeats):
+        times = []
+        stage = None
+        for frame, info in zip(corpus["frames"], _frame_infos(corpus)):
+            if (info["world"], info["stage"]) != stage:
+                ruleBasedMario.last_mario_location, stage = None, (info["world"], info["stage"])
+            start = time.perf_counter()
+            ruleBasedMario.make_action(frame, info, 0, None, 3)
+            times.append(1000 * (time.perf_counter() - start))
+        means.append(np.mean(times))
+        tails.append(np.percentile(times, 95))
+    ruleBasedMario.DETECTION_MODE = mode
+    return {
+        "agent/make_action_ms": _metric(means, "ms", "lower"),
+        "agent/make_action_p95_ms": _metric(tails, "ms", "lower"),
+    }
+
+
+def _suite_model(model_path, preprocessing):
+    # the model to time, and observations from the environment it sees (an untrained
+    # one, with a tiny rollout buffer, if there is no model)
+    env = make_vec_env(ENV_ID, subprocesses=False, **preprocessing)
+    observations = record_observations(env, max(SUITE_BATCH_SIZES) * 4)
+    if model_path is None:
+        model = PPO("CnnPolicy", env, n_steps=8, batch_size=8, seed=0, device="cpu")
+    else:
+        model = PPO.load(model_path, device="cpu")
+    env.close()
+    return model, observations
+
+
+def suite_ppo(model, observations, batch_sizes=SUITE_BATCH_SIZES, calls=SUITE_PREDICT_CALLS, repeats=SUITE_REPEATS):
+    """
+    Time PPO.predict on batches of observations.
+
+    :param model: (PPO) the model
+    :param observations: (np.ndarray) observations from the vectorised environment
+    :param batch_sizes: ([int]) observations per call
+    :param calls: (int) calls timed per measurement
+    :param repeats: (int) measurements of each batch size
+    :return: (dict) metric name -> result
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        batches = [np.take(observations, range(i, i + batch_size), axis=0, mode="wrap") for i in range(calls)]
+        model.predict(batches[0], deterministic=True)  # (the first call is slower)
+        values = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for batch in batches:
+                model.predict(batch, deterministic=True)
+            values.append(1000 * (time.perf_counter() - start) / calls)
+        results["ppo/predict_batch_{}_ms".format(batch_size)] = _metric(values, "ms", "lower")
+    return results
+
+
+def suite_checkpoint(model, repeats=SUITE_REPEATS):
+    """
+    Time saving and loading a checkpoint of the model, and the copy AsyncCheckpointCallback
+    makes of it (which is all that training waits for).
+
+    :param model: (PPO) the model
+    :param repeats: (int) measurements of each
+    :return: (dict) metric name -> result
+    """
+    snapshots, saves, loads = [], [], []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "checkpoint.zip")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            snapshot_model(model)
+            snapshots.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            model.save(path)
+            saves.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            PPO.load(path, device="cpu")
+            loads.append(time.perf_counter() - start)
+        size = os.path.getsize(path) / 2**20
+    return {
+        "checkpoint/snapshot_seconds": _metric(snapshots, "s", "lower"),
+        "checkpoint/save_seconds": _metric(saves, "s", "lower"),
+        "checkpoint/load_seconds": _metric(loads, "s", "lower"),
+        "checkpoint/size_mb": _metric([size], "MB", "lower"),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args):
+    torch.set_num_threads(args.threads)
+    preprocessing = preprocessing_from_args(args)
+    results = {}
+    if "env" in args.groups:
+        results.update(suite_env(args.steps, args.repeats, **preprocessing))
+    if "perception" in args.groups or "agent" in args.groups:
+        corpus = load_frames(args.frames)
+        if "perception" in args.groups:
+            results.update(suite_perception(corpus, args.modes, args.repeats))
+        if "agent" in args.groups:
+            results.update(suite_agent(corpus, args.repeats))
+    if "ppo" in args.groups or "checkpoint" in args.groups:
+        model, observations = _suite_model(args.model, preprocessing)
+        if "ppo" in args.groups:
+            results.update(suite_ppo(model, observations, args.batch_sizes, repeats=args.repeats))
+        if "checkpoint" in args.groups:
+            results.update(suite_checkpoint(model, args.repeats))
+
+    print(f"{'metric':<40} {'median':>10} {'unit':>9}")
+    for name, result in results.items():
+        print(f"{name:<40} {result['value']:>10.3f} {result['unit']:>9}")
+    if args.output is not None:
+        report = dict(
+            created=datetime.datetime.now().isoformat(timespec="seconds"),
+            commit=_git_commit(),
+            machine=dict(platform=platform.platform(), processor=platform.processor(), cpus=os.cpu_count()),
+            versions=dict(python=sys.version.split()[0], numpy=np.__version__, torch=torch.__version__, opencv=cv.__version__),
+            settings=dict(
+                groups=args.groups, repeats=args.repeats, steps=args.steps, frames=args.frames,
+                model=args.model, threads=args.threads, preprocessing=preprocessing,
+            ),
+            results=results,
+        )
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results written to " + args.output)
+
+
+def compare_results(old, new, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare the metrics two suite runs have in common.
+
+    :param old: (dict) the earlier suite report
+    :param new: (dict) the later suite report
+    :param threshold: (float) how much worse (as a fraction) a metric has to be to be a regression
+    :return: ([dict]) name, old, new, unit, change (as a fraction of old, positive is better)
+        and regression of every metric
+    """
+    rows = []
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        before, after = old["results"][name]["value"], result["value"]
+        change = (after - before) / before if before else 0.0
+        if result["better"] == "lower":
+            change = -change
+        rows.append(dict(name=name, old=before, new=after, unit=result["unit"], change=change,
+                         regression=change < -threshold))
+    return rows
+
+
+def run_compare(args):
+    reports = []
+    for path in (args.old, args.new):
+        with open(path) as f:
+            reports.append(json.load(f))
+    old, new = reports
+    print("old: {} ({}), new: {} ({})".format(old["commit"], old["created"], new["commit"], new["created"]))
+    settings = [{key: value for key, value in report["settings"].items() if key != "groups"} for report in reports]
+    if old["machine"] != new["machine"] or settings[0] != settings[1]:
+        print("(the runs were on different machines or with different settings, so the times aren't comparable)")
+    rows = compare_results(old, new, args.threshold)
+    print(f"{'metric':<40} {'old':>10} {'new':>10} {'unit':>9} {'change':>8}")
+    for row in rows:
+        print(f"{row['name']:<40} {row['old']:>10.3f} {row['new']:>10.3f} {row['unit']:>9} {row['change']:>+7.1%}"
+              + ("  REGRESSION" if row["regression"] else ""))
+    regressions = sum(row["regression"] for row in rows)
+    print("{} regressions (more than {:.0%} worse)".format(regressions, args.threshold))
+    if regressions:
+        sys.exit(1)
+
+
+################################################################################
+# COMMAND LINE
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the Mario environments and agents.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    envs = subparsers.add_parser("envs", help="environment steps per second for different worker counts")
+    envs.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="worker counts to compare")
+    envs.add_argument("--steps", type=int, default=BENCHMARK_STEPS, help="vector steps to time")
+    envs.add_argument("--env-id", default=ENV_ID, help="environment to benchmark")
+    envs.add_argument("--vec-envs", nargs="+", choices=VEC_ENVS, default=["subproc"], help="vectorised environments to compare")
+    add_preprocessing_arguments(envs)
+    envs.set_defaults(run=run_envs)
+
+    record = subparsers.add_parser("record-frames", help="record the frames used by the perception benchmarks")
+    record.add_argument("--frames", default=FRAMES_PATH, help="file to write")
+    record.add_argument("--stages", nargs="+", default=FRAME_STAGES, help="stages to record")
+    record.add_argument("--frames-per-stage", type=int, default=FRAMES_PER_STAGE, help="frames per stage")
+    record.set_defaults(run=run_record_frames)
+
+    detect = subparsers.add_parser("detect", help="locate_objects frames per second and agreement with the full search")
+    detect.add_argument("--frames", default=FRAMES_PATH, help="recorded frames (recorded if missing)")
+    detect.add_argument("--modes", nargs="+", default=["full", "roi", "pyramid", "tracked"], help="detection modes to compare")
+    detect.set_defaults(run=run_detect)
+
+    match = subparsers.add_parser("match", help="template matching time per category for each matching engine")
+    match.add_argument("--frames", default=FRAMES_PATH, help="recorded frames (recorded if missing)")
+    match.set_defaults(run=run_match)
+
+    palette = subparsers.add_parser("palette", help="colour matching on palette indices against greyscale matching")
+    palette.add_argument("--frames", default=FRAMES_PATH, help="recorded frames (recorded if missing)")
+    palette.add_argument("--engine", choices=["loop", "batched"], default="batched", help="greyscale engine to compare with")
+    palette.set_defaults(run=run_palette)
+
+    ram = subparsers.add_parser("ram", help="check the objects read from memory against the ones found on the screen")
+    ram.add_argument("--stages", nargs="+", default=FRAME_STAGES, help="stages to run")
+    ram.add_argument("--steps", type=int, default=FRAMES_PER_STAGE * 3, help="frames to run on each stage")
+    ram.add_argument("--every", type=int, default=2, help="only compare every this many frames")
+    ram.set_defaults(run=run_ram)
+
+    suite = subparsers.add_parser("suite", help="time the environment, perception, agent, PPO and checkpoints")
+    suite.add_argument("--groups", nargs="+", choices=SUITE_GROUPS, default=SUITE_GROUPS, help="what to time")
+    suite.add_argument("--output", default=None, help="write the results to this JSON file")
+    suite.add_argument("--repeats", type=int, default=SUITE_REPEATS, help="measurements of everything (the median is kept)")
+    suite.add_argument("--steps", type=int, default=SUITE_ENV_STEPS, help="environment steps per measurement")
+    suite.add_argument("--frames", default=FRAMES_PATH, help="recorded frames (recorded if missing)")
+    suite.add_argument("--modes", nargs="+", default=SUITE_DETECTION_MODES, help="detection modes to time")
+    suite.add_argument("--model", default=None, help="saved PPO model to time (default an untrained one)")
+    suite.add_argument("--batch-sizes", type=int, nargs="+", default=SUITE_BATCH_SIZES, help="observations per PPO.predict call")
+    suite.add_argument("--threads", type=int, default=1, help="torch threads")
+    add_preprocessing_arguments(suite)  # Must match how --model was trained
+    suite.set_defaults(run=run_suite)
+
+    compare = subparsers.add_parser("compare", help="compare two suite results, exiting with 1 if anything got slower")
+    compare.add_argument("old", help="the earlier results")
+    compare.add_argument("new", help="the later results")
+    compare.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="fraction worse that counts as a regression")
+    compare.set_defaults(run=run_compare)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.run(args)
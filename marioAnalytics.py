@@ -0,0 +1,427 @@
+import os
+import csv
+import glob
+import json
+import heapq
+import argparse
+from collections import deque
+import numpy as np
+
+try:
+    from tensorboard.backend.event_processing.event_file_loader import EventFileLoader
+    from tensorboard.util import tensor_util
+except ImportError:
+    EventFileLoader = None
+
+try:
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None  # optional, only needed for --plot
+
+# Compare training runs from their logs instead of screenshots of tensorboard:
+# the monitor files (one row per episode per worker) and the tensorboard event
+# files that 1_TrainMario.py writes. Both are read a record at a time, keeping
+# only binned curves, so dozens of long runs can be compared at once.
+# e.g. "poetry run python marioAnalytics.py ./logs --output report.csv"
+#      "poetry run python marioAnalytics.py ./sweeps/sweep/trial_* --thresholds 500 1000 --output report.json --plot curves.png"
+
+################################################################################
+# CONSTANTS
+
+LOG_DIR = "./logs/"  # Where 1_TrainMario.py writes its logs by default
+REWARD_TAG = "rollout/ep_rew_mean"  # PPO's mean reward of the last 100 episodes
+LENGTH_TAG = "rollout/ep_len_mean"
+FPS_TAG = "time/fps"
+WINDOW = 100  # Episodes the monitor curves are averaged over (the same as PPO's ep_rew_mean)
+BIN_STEPS = 10000  # Steps between the points kept of each curve
+
+REPORT_FIELDS = [
+    "run",
+    "source",
+    "episodes",
+    "steps",
+    "hours",
+    "steps_per_second",
+    "final_reward",
+    "best_reward",
+    "final_length",
+    "reward_at_budget",
+    "mean_reward_to_budget",
+]
+
+
+################################################################################
+# FINDING RUNS
+
+
+def find_runs(paths):
+    """
+    Find the runs in some directories (searched recursively).
+
+    A directory with monitor files (*.monitor.csv) is one run, its workers'
+    episodes combined, and so is a directory with tensorboard event files
+    (e.g. logs/PPO_3), so ./logs has a monitor run and a tensorboard run per PPO_n.
+
+    :param paths: ([str]) directories or glob patterns
+    :return: ([(str, str, [str])]) (run name, "monitor" or "tensorboard", its files)
+    """
+    runs = []
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            for directory, _, files in sorted(os.walk(path)):
+                monitors = sorted(os.path.join(directory, f) for f in files if f.endswith(".monitor.csv"))
+                events = sorted(os.path.join(directory, f) for f in files if f.startswith("events.out.tfevents"))
+                name = os.path.normpath(directory)
+                if monitors:
+                    runs.append((name, "monitor", monitors))
+                if events:
+                    runs.append((name, "tensorboard", events))
+    return runs
+
+
+################################################################################
+# READING LOGS
+
+
+def monitor_start(path):
+    """
+    :param path: (str) a .monitor.csv file
+    :return: (float) the wall time its worker started
+    """
+    with open(path) as f:
+        return json.loads(f.readline()[1:])["t_start"]  # the #{...} metadata line
+
+
+def read_monitor(path):
+    """
+    Read a monitor file's episodes, one at a time.
+
+    :param path: (str) a .monitor.csv file
+    :return: (generator) (wall time, reward, length) of each episode, in order
+    """
+    t_start = monitor_start(path)
+    with open(path) as f:
+        f.readline()
+        for row in csv.DictReader(f):
+            yield t_start + float(row["t"]), float(row["r"]), int(row["l"])
+
+
+def read_scalars(paths):
+    """
+    Read the scalars logged to tensorboard event files, one at a time.
+
+    :param paths: ([str]) the event files of a run, oldest first
+    :return: (generator) (wall time, step, tag, value) of each scalar
+    """
+    if EventFileLoader is None:
+        raise ImportError("reading tensorboard logs needs tensorboard (pip install tensorboard)")
+    for path in paths:
+        for event in EventFileLoader(path).Load():
+            for value in event.summary.value:
+                if value.HasField("simple_value"):
+                    number = value.simple_value
+                elif value.HasField("tensor"):
+                    number = tensor_util.make_ndarray(value.tensor)
+                    if number.size != 1:
+                        continue
+                    number = number.item()
+                else:
+                    continue
+                yield event.wall_time, event.step, value.tag, float(number)
+
+
+################################################################################
+# ANALYSIS
+
+
+class Curve:
+    """
+    A curve binned by steps, keeping the latest value in each bin.
+
+    :param bin_steps: (int) steps per bin
+    """
+
+    def __init__(self, bin_steps=BIN_STEPS):
+        self.bin_steps = bin_steps
+        self.points = []  # (steps, value)
+
+    def add(self, steps, value):
+        if self.points and self.points[-1][0] // self.bin_steps == steps // self.bin_steps:
+            self.points[-1] = (steps, value)
+        else:
+            self.points.append((steps, value))
+
+    def at(self, steps):
+        """
+        :param steps: (int) steps
+        :return: (float) the value of the bin they are in (or the latest before it), the first
+            value if they're before the first bin, or None if the curve is empty
+        """
+        if not self.points:
+            return None
+        # (a bin's point is its latest value, which is usually after steps if they're in that bin)
+        values = [value for point_steps, value in self.points if point_steps // self.bin_steps <= steps // self.bin_steps]
+        return values[-1] if values else self.points[0][1]
+
+    def mean_to(self, steps):
+        """
+        :param steps: (int) steps
+        :return: (float) the mean value up to then, weighting each point by the steps it covers, or None
+        """
+        total, covered, previous = 0.0, 0, 0
+        for point_steps, value in self.points:
+            end = min(point_steps, steps)
+            total += value * (end - previous)
+            covered += end - previous
+            previous = end
+            if point_steps >= steps:
+                break
+        return total / covered if covered > 0 else None
+
+    def first_reaching(self, threshold):
+        """
+        :param threshold: (float) a value
+        :return: (int) the steps when the curve first reached it, or None
+        """
+        return next((steps for steps, value in self.points if value >= threshold), None)
+
+
+def analyse_monitor(name, paths, window=WINDOW, bin_steps=BIN_STEPS):
+    """
+    Summarise a run from its monitor files.
+
+    The workers' episodes are merged in the order they ended. Steps are the
+    monitor's episode lengths, which are emulator frames (agent steps times
+    the frame skip).
+
+    :param name: (str) the run's name
+    :param paths: ([str]) its monitor files, one per worker
+    :param window: (int) episodes the reward and length curves are averaged over
+    :param bin_steps: (int) steps between the points kept of each curve
+    :return: (dict) the summary, with "reward_curve" and "length_curve"
+    """
+    rewards, lengths = deque(), deque()
+    reward_sum, length_sum = 0.0, 0
+    reward_curve, length_curve = Curve(bin_steps), Curve(bin_steps)
+    steps, episodes, best = 0, 0, None
+    last_time = None
+    for time, reward, length in heapq.merge(*[read_monitor(path) for path in paths]):
+        rewards.append(reward)
+        lengths.append(length)
+        reward_sum += reward
+        length_sum += length
+        if len(rewards) > window:
+            reward_sum -= rewards.popleft()
+            length_sum -= lengths.popleft()
+        steps += length
+        episodes += 1
+        last_time = time
+        mean_reward = reward_sum / len(rewards)
+        best = mean_reward if best is None else max(best, mean_reward)
+        reward_curve.add(steps, mean_reward)
+        length_curve.add(steps, length_sum / len(lengths))
+    # The monitor's first wall time is when the first episode ended, so start from the workers' start
+    first_time = min(monitor_start(path) for path in paths)
+    seconds = (last_time - first_time) if last_time is not None else 0.0
+    return dict(
+        run=name,
+        source="monitor",
+        episodes=episodes,
+        steps=steps,
+        hours=seconds / 3600,
+        steps_per_second=steps / seconds if seconds > 0 else None,
+        final_reward=reward_curve.points[-1][1] if reward_curve.points else None,
+        best_reward=best,
+        final_length=length_curve.points[-1][1] if length_curve.points else None,
+        reward_curve=reward_curve,
+        length_curve=length_curve,
+    )
+
+
+def analyse_tensorboard(name, paths, bin_steps=BIN_STEPS):
+    """
+    Summarise a run from its tensorboard event files.
+
+    The reward and length curves are PPO's rollout/ep_rew_mean and
+    rollout/ep_len_mean, against agent steps. Only the latest value of every
+    other scalar is kept.
+
+    :param name: (str) the run's name
+    :param paths: ([str]) its event files, oldest first
+    :param bin_steps: (int) steps between the points kept of each curve
+    :return: (dict) the summary, with "reward_curve", "length_curve" and "scalars"
+    """
+    reward_curve, length_curve = Curve(bin_steps), Curve(bin_steps)
+    scalars = {}
+    fps = []
+    steps, best = 0, None
+    first_time = last_time = None
+    for time, step, tag, value in read_scalars(paths):
+        first_time = time if first_time is None else min(first_time, time)
+        last_time = time if last_time is None else max(last_time, time)
+        steps = max(steps, step)
+        scalars[tag] = value
+        if tag == REWARD_TAG:
+            reward_curve.add(step, value)
+            best = value if best is None else max(best, value)
+        elif tag == LENGTH_TAG:
+            length_curve.add(step, value)
+        elif tag == FPS_TAG:
+            fps.append(value)
+    seconds = (last_time - first_time) if last_time is not None else 0.0
+    return dict(
+        run=name,
+        source="tensorboard",
+        episodes=None,
+        steps=steps,
+        hours=seconds / 3600,
+        # PPO's fps is the average since the start of the run (or the resume)
+        steps_per_second=fps[-1] if fps else (steps / seconds if seconds > 0 else None),
+        final_reward=scalars.get(REWARD_TAG),
+        best_reward=best,
+        final_length=scalars.get(LENGTH_TAG),
+        reward_curve=reward_curve,
+        length_curve=length_curve,
+        scalars=scalars,
+    )
+
+
+def compare_runs(summaries, budget=None, thresholds=()):
+    """
+    Add the sample efficiency comparisons to each run's summary.
+
+    Runs are compared at the same number of steps (the budget): the mean
+    reward then, and the mean of the reward curve up to then (the area under
+    it). thresholds adds the steps each run took to reach each mean reward.
+    Monitor and tensorboard runs are compared separately, since their steps
+    differ (emulator frames and agent steps).
+
+    :param summaries: ([dict]) the summaries from analyse_monitor and analyse_tensorboard
+    :param budget: (int) steps to compare at, or None for the shortest run's (of the same source)
+    :param thresholds: ([float]) mean rewards
+    :return: ([dict]) the summaries, by source and then best reward at the budget first
+    """
+    for summary in summaries:
+        if budget is None:
+            same_source = [other["steps"] for other in summaries if other["source"] == summary["source"]]
+            summary["budget"] = min([steps for steps in same_source if steps > 0], default=0)
+        else:
+            summary["budget"] = budget
+        curve = summary["reward_curve"]
+        reached = summary["steps"] >= summary["budget"]
+        summary["reward_at_budget"] = curve.at(summary["budget"]) if reached else None
+        summary["mean_reward_to_budget"] = curve.mean_to(summary["budget"]) if reached else None
+        for threshold in thresholds:
+            summary["steps_to_{:g}".format(threshold)] = curve.first_reaching(threshold)
+    return sorted(
+        summaries,
+        key=lambda s: (s["source"], -np.inf if s["reward_at_budget"] is None else s["reward_at_budget"]),
+        reverse=True,
+    )
+
+
+################################################################################
+# REPORT
+
+
+def write_report(path, summaries, thresholds=()):
+    """
+    Write the comparison as CSV, or as JSON (including the curves) if path ends in .json.
+
+    :param path: (str) output file
+    :param summaries: ([dict]) the compared summaries
+    :param thresholds: ([float]) the thresholds passed to compare_runs
+    """
+    fields = REPORT_FIELDS + ["budget"] + ["steps_to_{:g}".format(threshold) for threshold in thresholds]
+    if path.endswith(".json"):
+        rows = [
+            dict(
+                {field: summary[field] for field in fields},
+                reward_curve=summary["reward_curve"].points,
+                length_curve=summary["length_curve"].points,
+                scalars=summary.get("scalars", {}),
+            )
+            for summary in summaries
+        ]
+        with open(path, "w") as f:
+            json.dump(rows, f, indent=2)
+    else:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(summaries)
+
+
+def plot_curves(path, summaries):
+    """
+    Plot every run's reward and length curves, one above the other.
+
+    :param path: (str) image file to write, e.g. curves.png
+    :param summaries: ([dict]) the summaries
+    """
+    if plt is None:
+        raise ImportError("plotting needs matplotlib (pip install matplotlib)")
+    figure, (reward_axes, length_axes) = plt.subplots(2, 1, figsize=(10, 8), sharex=True)
+    for summary in summaries:
+        label = "{} ({})".format(summary["run"], summary["source"])
+        for axes, curve in ((reward_axes, summary["reward_curve"]), (length_axes, summary["length_curve"])):
+            if curve.points:
+                axes.plot(*zip(*curve.points), label=label)
+    reward_axes.set_ylabel("mean episode reward")
+    length_axes.set_ylabel("mean episode length")
+    length_axes.set_xlabel("steps")
+    reward_axes.legend(fontsize="small")
+    figure.tight_layout()
+    figure.savefig(path)
+    plt.close(figure)
+
+
+################################################################################
+# COMMAND LINE
+
+
+def _number(value, digits=1):
+    return "-" if value is None else "{:.{}f}".format(value, digits)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare training runs from their monitor and tensorboard logs.")
+    parser.add_argument("paths", nargs="*", default=[LOG_DIR], help="directories (or glob patterns) to search for runs")
+    parser.add_argument("--source", choices=["all", "monitor", "tensorboard"], default="all", help="which logs to read")
+    parser.add_argument("--budget", type=int, default=None, help="steps to compare the runs at (default the shortest run's)")
+    parser.add_argument("--thresholds", type=float, nargs="*", default=[], help="also report the steps to reach these mean rewards")
+    parser.add_argument("--window", type=int, default=WINDOW, help="episodes the monitor curves are averaged over")
+    parser.add_argument("--bin-steps", type=int, default=BIN_STEPS, help="steps between the points kept of each curve")
+    parser.add_argument("--output", default="report.csv", help="report file (.csv or .json, which includes the curves)")
+    parser.add_argument("--plot", default=None, help="also plot the curves to this image (needs matplotlib)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    runs = [run for run in find_runs(args.paths) if args.source in ("all", run[1])]
+    if not runs:
+        raise SystemExit("No monitor or tensorboard logs in {}".format(" ".join(args.paths)))
+
+    summaries = []
+    for name, source, paths in runs:
+        if source == "monitor":
+            summaries.append(analyse_monitor(name, paths, args.window, args.bin_steps))
+        else:
+            summaries.append(analyse_tensorboard(name, paths, args.bin_steps))
+    summaries = compare_runs(summaries, args.budget, args.thresholds)
+    write_report(args.output, summaries, args.thresholds)
+    if args.plot is not None:
+        plot_curves(args.plot, summaries)
+
+    print(f"{'steps':>10} {'steps/sec':>9} {'final':>8} {'best':>8} {'budget':>10} {'at budget':>9} {'mean to':>8}  run")
+    for summary in summaries:
+        print(
+            f"{summary['steps']:>10} {_number(summary['steps_per_second']):>9} {_number(summary['final_reward']):>8}"
+            f" {_number(summary['best_reward']):>8} {summary['budget']:>10} {_number(summary['reward_at_budget']):>9}"
+            f" {_number(summary['mean_reward_to_budget']):>8}  {summary['run']} ({summary['source']})"
+        )
+    print("Report written to " + args.output)
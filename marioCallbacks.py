@@ -0,0 +1,633 @@
+import os
+import re
+import copy
+import glob
+import json
+import time
+import queue
+import cProfile
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.save_util import save_to_zip_file
+from stable_baselines3.common.vec_env import VecEnvWrapper
+from marioEnv import VecTimingWrapper
+from marioEvaluate import _evaluate_job, _init_worker, rank_checkpoints
+
+try:
+    import psutil  # optional, only used to measure memory use (including the worker processes)
+except ImportError:
+    psutil = None
+try:
+    import resource  # Unix only, for the peak memory use when psutil isn't installed
+except ImportError:
+    resource = None
+
+# Callbacks for 1_TrainMario.py.
+# ProfilingCallback logs where the time goes during training to tensorboard
+# (under "timing/" and "memory/", next to PPO's own metrics).
+# AsyncCheckpointCallback saves checkpoints without pausing training, and only
+# keeps the latest and best ones. EvaluationCallback evaluates some of them in
+# other processes while training carries on, and keeps the best as best_model.zip.
+# CurriculumCallback spreads the workers' episodes over several stages, playing
+# the ones the model is failing on more often.
+# e.g. "poetry run python 1_TrainMario.py --timings --profile train.prof"
+
+################################################################################
+# CONSTANTS
+
+CHECKPOINT_PREFIX = "checkpoint"  # Checkpoints are saved as checkpoint_<environment steps>.zip
+# (or checkpoint_<environment steps>_final.zip when training ends on a step that was already saved)
+CHECKPOINT_INDEX = "checkpoints.json"  # Lists the checkpoints kept in a directory, with their scores
+KEEP_LAST = 5  # How many of the most recent checkpoints to keep
+KEEP_BEST = 3  # How many of the highest scoring checkpoints to keep as well
+
+EVAL_STAGES = ["1-2", "2-1"]  # Stages the model isn't trained on, to evaluate it on
+EVAL_EPISODES = 1  # Deterministic episodes per stage (the game has no randomness, so more would all be the same)
+EVAL_PROCESSES = 2  # Size of the evaluation process pool, which shares the cores with training
+BEST_MODEL = "best_model.zip"  # The best evaluated checkpoint is copied to this file
+FLAG_SCORE = 10000  # Score per flag reached, more than any x_pos, so scores rank like rank_checkpoints
+
+CURRICULUM_WINDOW = 50  # Recent episodes of each stage its success rate is measured over
+CURRICULUM_UPDATE_FREQUENCY = 20000  # How many steps between updates of the stages' probabilities
+CURRICULUM_UNIFORM = 0.2  # Share of the episodes spread evenly over the stages, so solved ones aren't forgotten
+
+################################################################################
+# PROFILING
+
+
+class PhaseTimer:
+    """
+    Add up the time spent in named phases of training, e.g. saving checkpoints.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def time(self, phase):
+        """
+        Time a block of code, e.g. "with timer.time("save"): model.save(path)".
+
+        :param phase: (str) the phase to add the time to
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[phase] = self.seconds.get(phase, 0.0) + time.perf_counter() - start
+
+
+def memory_usage():
+    """
+    Get the memory used by this process and its children (the SubprocVecEnv workers).
+
+    :return: (dict) "rss_mb" and "children_rss_mb" with psutil, or only "max_rss_mb"
+        (the peak of this process) without it, or nothing on Windows without psutil
+    """
+    if psutil is not None:
+        process = psutil.Process()
+        children = 0
+        for child in process.children(recursive=True):
+            try:
+                children += child.memory_info().rss
+            except psutil.Error:
+                pass  # it ended while being measured
+        return dict(rss_mb=process.memory_info().rss / 2 ** 20, children_rss_mb=children / 2 ** 20)
+    if resource is None:
+        return {}
+    # ru_maxrss is in kilobytes on Linux
+    return dict(max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10)
+
+
+class ProfilingCallback(BaseCallback):
+    """
+    Log how long each phase of training takes, the steps per second and the memory used.
+
+    After every rollout it records (in tensorboard, under "timing/" and "memory/"):
+    the seconds spent collecting the rollout, in the previous update (optimisation)
+    and in any phases timed with the timer (e.g. "save"); and the milliseconds per
+    step spent in the emulator, in the environment's wrappers, in the vectorised
+    environment, in frame stacking, and in the rest of collecting (the policy
+    and the rollout buffer). The per-step environment timings need the
+    environment from make_vec_env(..., timings=True).
+
+    :param timer: (PhaseTimer) timer other callbacks add their phases to
+    :param profile_path: (str) also run cProfile on the training process and write the
+        stats here (readable by pstats or snakeviz) after every rollout, or None
+    :param verbose: (int) verbosity
+    """
+
+    def __init__(self, timer=None, profile_path=None, verbose=0):
+        super(ProfilingCallback, self).__init__(verbose)
+        self.timer = timer if timer is not None else PhaseTimer()
+        self.profile_path = profile_path
+        self.profiler = None
+        self.vec_timers = {}
+        self.env_seconds = {}  # (worker, name) -> its latest running total
+        self.last = {}  # the totals when the last rollout was logged
+        self.rollout_start = self.rollout_end = None
+        self.last_time = None
+        self.train_seconds = 0.0
+
+    def _on_training_start(self):
+        env = self.training_env
+        while isinstance(env, VecEnvWrapper):
+            if isinstance(env, VecTimingWrapper):
+                self.vec_timers[env.name] = env
+            env = env.venv
+        self.last = self._totals()
+        self.last_time = time.perf_counter()
+        if self.profile_path is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def _totals(self):
+        totals = dict(self.timer.seconds, steps=self.model.num_timesteps)
+        for name, vec_timer in self.vec_timers.items():
+            totals[name] = vec_timer.seconds
+            totals[name + "_steps"] = vec_timer.steps
+        for (_, name), seconds in self.env_seconds.items():
+            totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def _on_rollout_start(self):
+        self.rollout_start = time.perf_counter()
+        if self.rollout_end is not None:
+            self.train_seconds = self.rollout_start - self.rollout_end  # the update in between
+
+    def _on_step(self):
+        for i, info in enumerate(self.locals["infos"]):
+            for name, seconds in info.get("timings", {}).items():
+                self.env_seconds[(i, name)] = seconds
+        return True
+
+    def _on_rollout_end(self):
+        self.rollout_end = time.perf_counter()
+        totals = self._totals()
+        change = {key: value - self.last.get(key, 0.0) for key, value in totals.items()}
+        steps = max(change["steps"], 1)  # environment steps, over all the workers
+        record = self.logger.record
+        record("timing/rollout_seconds", self.rollout_end - self.rollout_start)
+        record("timing/train_seconds", self.train_seconds)
+        for phase in self.timer.seconds:
+            record("timing/{}_seconds".format(phase), change[phase])
+        record("timing/steps_per_second", change["steps"] / (self.rollout_end - self.last_time))
+        if "emulator" in change:
+            record("timing/emulator_ms", 1000 * change["emulator"] / steps)
+            record("timing/env_wrappers_ms", 1000 * (change["env"] - change["emulator"]) / steps)
+        if "vec_env" in change:
+            vec_steps = max(change["vec_env_steps"], 1)  # steps of every worker at once
+            record("timing/vec_env_ms", 1000 * change["vec_env"] / vec_steps)
+            record("timing/frame_stack_ms", 1000 * (change["vec_env"] - change["workers"]) / vec_steps)
+            record("timing/policy_ms", 1000 * (self.rollout_end - self.rollout_start - change["vec_env"]) / vec_steps)
+        for key, value in memory_usage().items():
+            record("memory/" + key, value)
+        self.last = totals
+        self.last_time = self.rollout_end
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_path)  # (which stops the profiler)
+            self.profiler.enable()
+
+    def _on_training_end(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+
+
+################################################################################
+# CHECKPOINTS
+
+
+def snapshot_model(model):
+    """
+    Copy everything model.save would write, so it can be written while training continues.
+
+    :param model: (BaseAlgorithm) the model
+    :return: ((dict, dict)) the attributes and the state dicts (copied to new tensors)
+    """
+    exclude = set(model._excluded_save_params())
+    state_dicts, torch_variables = model._get_torch_save_params()
+    exclude.update(name.split(".")[0] for name in state_dicts + torch_variables)
+    data = {}
+    for name, value in model.__dict__.items():
+        if name in exclude:
+            continue
+        # the observations and episode buffers are updated in place by the next steps
+        data[name] = value.copy() if isinstance(value, np.ndarray) else copy.copy(value) if isinstance(value, deque) else value
+    return data, copy.deepcopy(model.get_parameters())
+
+
+def _checkpoint_steps(path):
+    numbers = re.findall(r"\d+", os.path.basename(path))
+    return int(numbers[-1]) if numbers else -1
+
+
+def read_checkpoint_index(save_path):
+    """
+    Read the checkpoints kept in a directory.
+
+    :param save_path: (str) the checkpoint directory
+    :return: ([dict]) path, steps and score (None if it hasn't got one) of each checkpoint,
+        oldest first, found from the checkpoint files if there is no index
+    """
+    index_path = os.path.join(save_path, CHECKPOINT_INDEX)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            return json.load(f)
+    paths = sorted(glob.glob(os.path.join(save_path, CHECKPOINT_PREFIX + "_*.zip")))  # (_final after the other)
+    return sorted((dict(path=path, steps=_checkpoint_steps(path), score=None) for path in paths), key=lambda c: c["steps"])
+
+
+def latest_checkpoint(save_path):
+    """
+    Find the most recent checkpoint in a directory, e.g. to resume training from.
+
+    :param save_path: (str) the checkpoint directory
+    :return: (str) its path, or None if there are none
+    """
+    checkpoints = [c for c in read_checkpoint_index(save_path) if os.path.exists(c["path"])]
+    # (the last of the ones with the most steps, which is the _final one if there is one)
+    return sorted(checkpoints, key=lambda c: c["steps"])[-1]["path"] if checkpoints else None
+
+
+class AsyncCheckpointCallback(BaseCallback):
+    """
+    Save checkpoints on a background thread, keeping only the latest and the best.
+
+    Every save_freq environment steps (and at the end of training) the model is
+    copied, which is quick, and the copy is written to a zip file by a separate
+    thread while training carries on. If the thread is still writing the last
+    one, training waits for it. After every write only the keep_last most recent
+    checkpoints and the keep_best with the highest scores are kept; an index of
+    them is kept in CHECKPOINT_INDEX.
+
+    A checkpoint's score starts as the mean training episode reward when it was
+    taken (or none, with score_reward=False), and can be replaced by a proper
+    evaluation with set_score. Pinned checkpoints are never removed.
+
+    :param save_freq: (int) environment steps (over all the workers) between checkpoints
+    :param save_path: (str) directory to save them in
+    :param keep_last: (int) how many of the most recent checkpoints to keep
+    :param keep_best: (int) how many of the highest scoring checkpoints to keep as well
+    :param timer: (PhaseTimer) adds the time training waits for each checkpoint as "save"
+    :param score_reward: (bool) score checkpoints by the mean training episode reward until
+        they're evaluated, False when they will be evaluated (the scores aren't comparable)
+    :param verbose: (int) verbosity
+    """
+
+    def __init__(
+        self,
+        save_freq,
+        save_path,
+        keep_last=KEEP_LAST,
+        keep_best=KEEP_BEST,
+        timer=None,
+        score_reward=True,
+        verbose=1,
+    ):
+        super(AsyncCheckpointCallback, self).__init__(verbose)
+        self.save_freq = save_freq
+        self.save_path = save_path
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.timer = timer if timer is not None else PhaseTimer()
+        self.score_reward = score_reward
+        self.checkpoints = []
+        self.pinned = set()  # paths that mustn't be removed yet, e.g. while they're evaluated
+        self.last_version = None  # (steps, updates) of the last checkpoint taken
+        self.last_path = None  # and where it was written
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = None
+        self.next_save = 0
+
+    def _init_callback(self):
+        os.makedirs(self.save_path, exist_ok=True)
+        self.checkpoints = [c for c in read_checkpoint_index(self.save_path) if os.path.exists(c["path"])]
+        self.next_save = (self.model.num_timesteps // self.save_freq + 1) * self.save_freq  # (when resuming)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._write_checkpoints, daemon=True)
+            self.thread.start()
+
+    def _on_step(self):
+        if self.num_timesteps >= self.next_save:
+            while self.next_save <= self.num_timesteps:
+                self.next_save += self.save_freq
+            self.save()
+        return True
+
+    def _on_training_end(self):
+        self.save()  # (as _final if one was taken at the same step, before the last update)
+        self.wait()
+
+    def save(self, pin=False):
+        """
+        Take a checkpoint now, and write it in the background.
+
+        :param pin: (bool) keep it until unpin is called
+        :return: (str) the path it will be written to
+        """
+        version = (self.num_timesteps, self.model._n_updates)
+        if version == self.last_version:
+            path = self.last_path  # already taken, e.g. by another callback at the same step
+        else:
+            name = "{}_{}".format(CHECKPOINT_PREFIX, self.num_timesteps)
+            if self.last_version is not None and self.last_version[0] == self.num_timesteps:
+                # the model was updated since the checkpoint at this step, which may have been
+                # scored (or copied to best_model.zip) already, so it mustn't be overwritten
+                name += "_final"
+            path = os.path.join(self.save_path, name + ".zip")
+        if pin:
+            with self.lock:
+                self.pinned.add(path)
+        if version == self.last_version:
+            return path
+        self.last_version, self.last_path = version, path
+        rewards = [info["r"] for info in self.model.ep_info_buffer]
+        score = float(np.mean(rewards)) if rewards and self.score_reward else None
+        with self.timer.time("save"):
+            data, params = snapshot_model(self.model)
+            self.queue.put((path, self.num_timesteps, score, data, params))
+        return path
+
+    def wait(self):
+        """Wait until every checkpoint taken so far has been written."""
+        self.queue.join()
+
+    def _write_checkpoints(self):
+        while True:
+            path, steps, score, data, params = self.queue.get()
+            try:
+                with open(path + ".tmp", "wb") as f:
+                    save_to_zip_file(f, data=data, params=params)
+                os.replace(path + ".tmp", path)  # never leave a half written checkpoint
+                with self.lock:
+                    self.checkpoints = [c for c in self.checkpoints if c["path"] != path]
+                    self.checkpoints.append(dict(path=path, steps=steps, score=score))
+                    self._apply_retention()
+                if self.verbose > 0:
+                    print("Saved checkpoint " + path)
+            except Exception as error:  # keep the thread running for the next checkpoint
+                print("Couldn't save checkpoint {}: {}".format(path, error))
+            finally:
+                self.queue.task_done()
+
+    def set_score(self, path, score):
+        """
+        Replace a checkpoint's score, e.g. with the result of evaluating it.
+
+        :param path: (str) the checkpoint
+        :param score: (float) its new score, higher is better
+        """
+        with self.lock:
+            for checkpoint in self.checkpoints:
+                if checkpoint["path"] == path:
+                    checkpoint["score"] = score
+            self._apply_retention()
+
+    def unpin(self, path):
+        """
+        Let a pinned checkpoint be removed again.
+
+        :param path: (str) the checkpoint
+        """
+        with self.lock:
+            self.pinned.discard(path)
+            self._apply_retention()
+
+    def written(self, path):
+        """
+        Check whether a checkpoint has been written yet.
+
+        :param path: (str) the checkpoint
+        :return: (bool) True once it's been written
+        """
+        with self.lock:
+            return any(c["path"] == path for c in self.checkpoints)
+
+    def _apply_retention(self):
+        checkpoints = sorted(self.checkpoints, key=lambda c: c["steps"])
+        keep = {c["path"] for c in checkpoints[-self.keep_last:]} if self.keep_last > 0 else set()
+        keep.update(self.pinned)
+        scored = sorted((c for c in checkpoints if c["score"] is not None), key=lambda c: c["score"], reverse=True)
+        keep.update(c["path"] for c in scored[:self.keep_best])
+        for checkpoint in checkpoints:
+            if checkpoint["path"] not in keep and os.path.exists(checkpoint["path"]):
+                os.remove(checkpoint["path"])
+        self.checkpoints = [c for c in checkpoints if c["path"] in keep]
+        index_path = os.path.join(self.save_path, CHECKPOINT_INDEX)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.checkpoints, f, indent=2)
+        os.replace(index_path + ".tmp", index_path)
+
+
+################################################################################
+# EVALUATION
+
+
+class EvaluationCallback(BaseCallback):
+    """
+    Evaluate the model every eval_freq steps in a process pool, without pausing training.
+
+    Each evaluation takes a pinned checkpoint with checkpoints (an
+    AsyncCheckpointCallback), and once it's written runs deterministic episodes
+    of it on every stage with marioEvaluate.evaluate_checkpoint in the pool.
+    When they finish, the results are logged to tensorboard (under "eval/"), the
+    checkpoint's score is set (flag rate, then mean x_pos, as rank_checkpoints
+    ranks them), and if it's the best so far it's copied to BEST_MODEL. If an
+    evaluation is still running when the next is due, the next one is skipped.
+
+    :param checkpoints: (AsyncCheckpointCallback) the callback saving the checkpoints
+    :param eval_freq: (int) environment steps (over all the workers) between evaluations
+    :param stages: ([str]) stages such as "1-2" to evaluate on, ideally ones the model isn't trained on
+    :param episodes: (int) episodes per stage
+    :param processes: (int) size of the process pool
+    :param preprocessing: (dict) frame_skip, grayscale and frame_size the model is trained with
+    :param evaluate_kwargs: more arguments for evaluate_checkpoint, e.g. version or max_episode_steps
+    :param verbose: (int) verbosity
+    """
+
+    def __init__(
+        self,
+        checkpoints,
+        eval_freq,
+        stages=EVAL_STAGES,
+        episodes=EVAL_EPISODES,
+        processes=EVAL_PROCESSES,
+        preprocessing=None,
+        evaluate_kwargs=None,
+        verbose=1,
+    ):
+        super(EvaluationCallback, self).__init__(verbose)
+        self.checkpoints = checkpoints
+        self.eval_freq = eval_freq
+        self.stages = stages
+        self.processes = processes
+        self.kwargs = dict(episodes=episodes, deterministic=True, **(preprocessing or {}), **(evaluate_kwargs or {}))
+        self.pool = None
+        self.pending = None  # the checkpoint waiting to be written
+        self.running = None  # (checkpoint, steps, futures) being evaluated
+        self.best_score = None
+        self.next_eval = 0
+
+    def _init_callback(self):
+        if self.pool is None:
+            # spawn, so the workers don't inherit the training process's threads or environments
+            self.pool = ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker
+            )
+        self.next_eval = (self.model.num_timesteps // self.eval_freq + 1) * self.eval_freq
+        scores = [c["score"] for c in read_checkpoint_index(self.checkpoints.save_path) if c["score"] is not None]
+        if self.best_score is None and scores and os.path.exists(self._best_path()):
+            self.best_score = max(scores)  # when resuming
+
+    def _best_path(self):
+        return os.path.join(self.checkpoints.save_path, BEST_MODEL)
+
+    def _on_step(self):
+        if self.num_timesteps >= self.next_eval:
+            while self.next_eval <= self.num_timesteps:
+                self.next_eval += self.eval_freq
+            if self.pending is None and self.running is None:
+                self.pending = (self.checkpoints.save(pin=True), self.num_timesteps)
+            elif self.verbose > 0:
+                print("Skipping the evaluation at {} steps, the last one is still running".format(self.num_timesteps))
+        if self.pending is not None and self.checkpoints.written(self.pending[0]):
+            path, steps = self.pending
+            futures = [self.pool.submit(_evaluate_job, (path, stage, self.kwargs)) for stage in self.stages]
+            self.running = (path, steps, futures)
+            self.pending = None
+        if self.running is not None and all(future.done() for future in self.running[2]):
+            self._finish()
+        return True
+
+    def _finish(self):
+        path, steps, futures = self.running
+        self.running = None
+        try:
+            rows = [future.result()[0] for future in futures]
+        except Exception as error:
+            print("Couldn't evaluate {}: {}".format(path, error))
+            self.checkpoints.unpin(path)
+            return
+        _, flag_rate, mean_x_pos = rank_checkpoints(rows)[0]
+        score = flag_rate * FLAG_SCORE + mean_x_pos
+        record = self.logger.record
+        record("eval/checkpoint_steps", steps)
+        record("eval/flag_rate", flag_rate)
+        record("eval/mean_x_pos", mean_x_pos)
+        record("eval/score", score)
+        for row in rows:
+            record("eval/{}_mean_x_pos".format(row["stage"]), row["mean_x_pos"])
+        if self.best_score is None or score > self.best_score:
+            self.best_score = score
+            # copied rather than linked, so it's kept whatever happens to the checkpoint
+            shutil.copyfile(path, self._best_path() + ".tmp")
+            os.replace(self._best_path() + ".tmp", self._best_path())
+            if self.verbose > 0:
+                print("New best model ({} steps): flag rate {:.2f}, mean x_pos {:.1f}".format(steps, flag_rate, mean_x_pos))
+        record("eval/best_score", self.best_score)
+        self.checkpoints.set_score(path, score)
+        self.checkpoints.unpin(path)
+
+    def _on_training_end(self):
+        # finish the evaluation in progress, so best_model.zip is up to date
+        if self.pending is not None:
+            self.checkpoints.wait()
+            self._on_step()
+        if self.running is not None:
+            for future in self.running[2]:
+                future.exception()  # waits for it
+            self._finish()
+        self.pool.shutdown()
+        self.pool = None
+
+
+################################################################################
+# CURRICULUM
+
+
+class CurriculumCallback(BaseCallback):
+    """
+    Play the stages the model is failing on more often (see CurriculumWrapper in marioWrappers.py).
+
+    Every episode that ends is counted as a success (reaching the flag) or not
+    for its stage, over the last window episodes of each stage. Every
+    update_freq steps the workers are sent new probabilities for the stages
+    with env_method, so they change stage on their next reset without being
+    restarted. A stage's weight is the fraction of its recent episodes that
+    failed (counting one success and one failure to begin with, like
+    SnapshotResetWrapper's snapshots), and a uniform share of the episodes is
+    spread over every stage. The success rates and probabilities are logged to
+    tensorboard (under "curriculum/").
+
+    :param stages: ([str]) the stages the environments were made with, in the same order
+    :param update_freq: (int) environment steps (over all the workers) between updates
+    :param window: (int) recent episodes of each stage to measure its success rate over
+    :param uniform: (float) share of the episodes spread evenly over the stages
+    :param verbose: (int) verbosity
+    """
+
+    def __init__(
+        self,
+        stages,
+        update_freq=CURRICULUM_UPDATE_FREQUENCY,
+        window=CURRICULUM_WINDOW,
+        uniform=CURRICULUM_UNIFORM,
+        verbose=0,
+    ):
+        super(CurriculumCallback, self).__init__(verbose)
+        self.stages = list(stages)
+        self.update_freq = update_freq
+        self.uniform = uniform
+        self.results = {stage: deque(maxlen=window) for stage in self.stages}
+        self.next_update = 0
+
+    def _init_callback(self):
+        self.next_update = self.model.num_timesteps + self.update_freq
+
+    def _on_step(self):
+        for done, info in zip(self.locals["dones"], self.locals["infos"]):
+            if done:
+                stage = "{}-{}".format(info["world"], info["stage"])
+                if stage in self.results:
+                    self.results[stage].append(bool(info["flag_get"]))
+        if self.num_timesteps >= self.next_update:
+            while self.next_update <= self.num_timesteps:
+                self.next_update += self.update_freq
+            self.update()
+        return True
+
+    def success_rates(self):
+        """
+        :return: ([float]) the fraction of each stage's recent episodes that reached the flag
+            (nan for stages with none yet)
+        """
+        return [float(np.mean(results)) if results else float("nan") for results in self.results.values()]
+
+    def probabilities(self):
+        """
+        :return: (np.ndarray) the chance of each stage being played
+        """
+        failures = np.array([(len(results) - sum(results) + 1) / (len(results) + 2) for results in self.results.values()])
+        return (1 - self.uniform) * failures / failures.sum() + self.uniform / len(self.stages)
+
+    def update(self):
+        """
+        Send the workers the probabilities for the current success rates, and log them.
+        """
+        probabilities = self.probabilities()
+        self.training_env.env_method("set_probabilities", probabilities.tolist())
+        for stage, success_rate, probability in zip(self.stages, self.success_rates(), probabilities):
+            self.logger.record("curriculum/{}_success_rate".format(stage), success_rate)
+            self.logger.record("curriculum/{}_probability".format(stage), probability)
+        if self.verbose > 0:
+            print("Curriculum: " + ", ".join(
+                "{} {:.2f}".format(stage, probability) for stage, probability in zip(self.stages, probabilities)
+            ))
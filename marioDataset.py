@@ -0,0 +1,386 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import gym
+import numpy as np
+import torch
+from nes_py.wrappers import JoypadSpace
+from gym_super_mario_bros.actions import COMPLEX_MOVEMENT
+from stable_baselines3 import PPO
+import ruleBasedMario
+from ruleBasedRunner import ALL_STAGES, _init_worker
+from marioEnv import FRAME_STACK, make_vec_env, add_preprocessing_arguments, preprocessing_from_args
+from marioWrappers import make_mario, stage_env_id, ResizeObservation
+
+# Record the rule-based agent playing, as (observation, action) pairs the PPO
+# model would see and could choose, and pretrain the PPO policy to copy it
+# (behaviour cloning) before training it with 1_TrainMario.py --init-model.
+# e.g. "poetry run python marioDataset.py generate --stages 1-1 1-2 --seeds 4 --preprocess"
+#      "poetry run python marioDataset.py pretrain --only-completed"
+#      "poetry run python 1_TrainMario.py --preprocess --init-model ./models/pretrained.zip"
+
+################################################################################
+# CONSTANTS
+
+DATASET_DIR = "./dataset"  # Where the shards are written
+PRETRAINED_PATH = "./models/pretrained.zip"  # Where the pretrained model is saved
+
+VERSION = "v3"  # ROM version, the same as 1_TrainMario.py (the rule-based agent reads memory, so any works)
+PERCEPTION = "ram"  # How the rule-based agent locates objects ("vision" only works on v0)
+SEEDS = 2  # Episodes per stage, each with a different random start
+MAX_EPISODE_STEPS = 10000  # Frames before an episode is cut off
+
+# The COMPLEX_MOVEMENT action the rule-based agent chooses -> the SIMPLE_MOVEMENT
+# action the PPO model has for it. SIMPLE_MOVEMENT can only move left without
+# jumping or running, and has no up or down.
+COMPLEX_TO_SIMPLE = [0, 1, 2, 3, 4, 5, 6, 6, 6, 6, 0, 0]
+
+NPY_HEADER_SIZE = 128  # Bytes reserved for a shard's .npy header, so it can be rewritten in place
+
+EPOCHS = 5
+BATCH_SIZE = 256
+PRETRAIN_LEARNING_RATE = 0.0001  # Higher than PPO's, the labels are fixed so this is ordinary supervised learning
+
+
+################################################################################
+# WRITING SHARDS
+
+
+def _write_npy_header(f, shape, dtype):
+    # an .npy version 1.0 header, padded with spaces to exactly NPY_HEADER_SIZE bytes
+    header = repr(dict(descr=np.dtype(dtype).str, fortran_order=False, shape=tuple(shape))).encode()
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + b"\n"
+    f.seek(0)
+    f.write(b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header)
+
+
+class ShardWriter:
+    """
+    Stream (observation, action) pairs to a pair of .npy files.
+
+    The observations are written to disk as they arrive (a full-size colour
+    observation stack is about 700KB), and the header is filled in with the
+    final number of samples when the shard is closed, so both files can be
+    memory-mapped by np.load(..., mmap_mode="r").
+
+    :param path: (str) the shard's path without an extension, e.g. "./dataset/1-1_0"
+    :param obs_shape: ((int)) shape of one observation
+    """
+
+    def __init__(self, path, obs_shape):
+        self.path = path
+        self.obs_shape = obs_shape
+        self.actions = []
+        self.obs_file = open(path + "_obs.npy", "wb")
+        _write_npy_header(self.obs_file, (0,) + tuple(obs_shape), np.uint8)
+
+    def append(self, obs, action):
+        self.obs_file.write(np.ascontiguousarray(obs, dtype=np.uint8).tobytes())
+        self.actions.append(action)
+
+    def close(self):
+        _write_npy_header(self.obs_file, (len(self.actions),) + tuple(self.obs_shape), np.uint8)
+        self.obs_file.close()
+        np.save(self.path + "_actions.npy", np.array(self.actions, dtype=np.uint8))
+
+
+class DemonstrationWrapper(gym.Wrapper):
+    """
+    Write the observations the PPO model would have seen while another agent plays.
+
+    The agent plays every frame with COMPLEX_MOVEMENT actions. The frames are
+    preprocessed the same way make_vec_env does (max-pooled over each group of
+    frame_skip frames, resized, and the last FRAME_STACK stacked), and the action
+    chosen on the first frame of each group is written with the observation
+    before it, converted to SIMPLE_MOVEMENT. The wait before the agent's first
+    move (the random start) is not written.
+
+    :param env: (gym.Env) Mario environment with the COMPLEX_MOVEMENT actions
+    :param writer: (ShardWriter) where to write the pairs
+    :param frame_skip: (int) frames per PPO action
+    :param grayscale: (bool) convert the frames to grayscale
+    :param frame_size: (int) resize the frames to frame_size x frame_size, or None
+    """
+
+    def __init__(self, env, writer, frame_skip=1, grayscale=False, frame_size=None):
+        super(DemonstrationWrapper, self).__init__(env)
+        self.writer = writer
+        self.frame_skip = frame_skip
+        self.resize = ResizeObservation(env, frame_size, grayscale)  # only used to convert frames
+        self.frames = np.zeros((2,) + env.observation_space.shape, dtype=np.uint8)
+        self.stack = np.zeros(demonstration_obs_shape(env.observation_space.shape, grayscale, frame_size), np.uint8)
+        self.frame = 0
+        self.started = False
+
+    def _push(self, frame):
+        channels = self.stack.shape[-1] // FRAME_STACK
+        self.stack = np.roll(self.stack, -channels, axis=-1)
+        self.stack[..., -channels:] = self.resize.observation(frame)
+
+    def reset(self, **kwargs):
+        obs, info = self.env.reset(**kwargs)
+        self.stack[:] = 0
+        self._push(obs)
+        self.frame = 0
+        self.started = False
+        return obs, info
+
+    def step(self, action):
+        group_frame = self.frame % self.frame_skip
+        self.started = self.started or action != 0
+        if group_frame == 0 and self.started:
+            self.writer.append(self.stack, COMPLEX_TO_SIMPLE[action])
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        self.frames[group_frame % 2] = obs
+        self.frame += 1
+        if group_frame == self.frame_skip - 1 or terminated or truncated:
+            # the same frame MaxAndSkipFrame would return
+            self._push(self.frames[0] if group_frame == 0 else self.frames.max(axis=0))
+        return obs, reward, terminated, truncated, info
+
+
+def demonstration_obs_shape(frame_shape, grayscale=False, frame_size=None):
+    """
+    Get the shape of the stacked observations for some preprocessing.
+
+    :param frame_shape: ((int)) shape of the emulator's frames
+    :param grayscale: (bool) whether the frames are grayscale
+    :param frame_size: (int) the frames' new width and height, or None
+    :return: ((int)) the shape of one observation, as make_vec_env would give it
+    """
+    height, width, channels = frame_shape
+    if frame_size is not None:
+        height, width = frame_size, frame_size
+    return (height, width, (1 if grayscale else channels) * FRAME_STACK)
+
+
+################################################################################
+# GENERATING A DATASET
+
+
+def generate_shard(job):
+    """
+    Run the rule-based agent for one episode and write it as a shard.
+
+    :param job: ((str, int, dict)) the stage, the seed, and the output directory,
+        version, max_steps and preprocessing
+    :return: (dict) the episode's result from run_episode, with its shard name, stage,
+        seed and number of samples
+    """
+    stage, seed, options = job
+    name = "{}_{}".format(stage, seed)
+    preprocessing = options["preprocessing"]
+    env = JoypadSpace(make_mario(stage_env_id(stage, options["version"]), headless=True), COMPLEX_MOVEMENT)
+    shape = demonstration_obs_shape(env.observation_space.shape, preprocessing["grayscale"], preprocessing["frame_size"])
+    writer = ShardWriter(os.path.join(options["output"], name), shape)
+    env = DemonstrationWrapper(env, writer, **preprocessing)
+    # (no sticky actions, which would be recorded as if the agent had chosen them)
+    result = ruleBasedMario.run_episode(env, None, options["max_steps"], seed, sticky=0)
+    env.close()
+    writer.close()
+    return dict(result, name=name, stage=stage, seed=seed, samples=len(writer.actions))
+
+
+def generate_dataset(
+    output,
+    stages,
+    seeds,
+    processes=None,
+    version=VERSION,
+    max_steps=MAX_EPISODE_STEPS,
+    perception=PERCEPTION,
+    frame_skip=1,
+    grayscale=False,
+    frame_size=None,
+):
+    """
+    Run the rule-based agent on every stage with every seed and write a shard per episode.
+
+    The episodes are spread over a process pool. A manifest.json in output lists the
+    shards and the preprocessing they were written with, and shards already listed
+    in it with the same stage and seed are replaced.
+
+    :param output: (str) the dataset directory
+    :param stages: ([str]) stages such as "1-1"
+    :param seeds: ([int]) seeds for the random starts, one episode per stage and seed
+    :param processes: (int) size of the process pool, defaults to the number of cores
+    :param version: (str) the ROM version
+    :param max_steps: (int) frames before an episode is cut off
+    :param perception: (str) ruleBasedMario's PERCEPTION
+    :param frame_skip: (int) frames per PPO action
+    :param grayscale: (bool) convert the frames to grayscale
+    :param frame_size: (int) resize the frames to frame_size x frame_size, or None
+    :return: (dict) the manifest
+    """
+    os.makedirs(output, exist_ok=True)
+    preprocessing = dict(frame_skip=frame_skip, grayscale=grayscale, frame_size=frame_size)
+    manifest = dict(version=version, frame_stack=FRAME_STACK, preprocessing=preprocessing, shards=[])
+    manifest_path = os.path.join(output, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["preprocessing"] != preprocessing or manifest["version"] != version:
+            raise ValueError("{} was generated with {} {}".format(output, manifest["version"], manifest["preprocessing"]))
+
+    options = dict(output=output, version=version, max_steps=max_steps, preprocessing=preprocessing)
+    jobs = [(stage, seed, options) for stage in stages for seed in seeds]
+    settings = (ruleBasedMario.DETECTION_MODE, perception, ruleBasedMario.MATCH_ENGINE, ruleBasedMario.DECISIONS)
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=settings) as pool:
+        results = list(pool.map(generate_shard, jobs))
+
+    names = {result["name"] for result in results}
+    manifest["shards"] = [shard for shard in manifest["shards"] if shard["name"] not in names] + [
+        dict(name=r["name"], stage=r["stage"], seed=r["seed"], samples=r["samples"], flag=r["flag"],
+             x_pos=r["x_pos"], reward=r["reward"])
+        for r in results
+    ]
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2, default=int)
+    return manifest
+
+
+################################################################################
+# PRETRAINING
+
+
+def load_dataset(dataset, only_completed=False):
+    """
+    Memory-map the shards of a dataset.
+
+    :param dataset: (str) the dataset directory
+    :param only_completed: (bool) only use episodes that reached the flag
+    :return: ((dict, [np.ndarray], [np.ndarray])) the manifest, and the observations
+        (memory-mapped) and actions of each shard
+    """
+    with open(os.path.join(dataset, "manifest.json")) as f:
+        manifest = json.load(f)
+    shards = [s for s in manifest["shards"] if s["samples"] > 0 and (s["flag"] or not only_completed)]
+    observations = [np.load(os.path.join(dataset, s["name"] + "_obs.npy"), mmap_mode="r") for s in shards]
+    actions = [np.load(os.path.join(dataset, s["name"] + "_actions.npy")) for s in shards]
+    return manifest, observations, actions
+
+
+def pretrain(model, observations, actions, epochs=EPOCHS, batch_size=BATCH_SIZE, learning_rate=PRETRAIN_LEARNING_RATE, seed=0):
+    """
+    Train a PPO model's policy to choose the recorded actions (behaviour cloning).
+
+    Each minibatch is read from the memory-mapped shards in sorted order, so only
+    the samples in it are loaded from disk.
+
+    :param model: (PPO) a model with the same observation space as the shards
+    :param observations: ([np.ndarray]) each shard's observations
+    :param actions: ([np.ndarray]) each shard's actions
+    :param epochs: (int) passes over the whole dataset
+    :param batch_size: (int) samples per gradient step
+    :param learning_rate: (float) Adam's learning rate
+    :param seed: (int) seed for shuffling
+    :return: ([dict]) the mean loss and accuracy of each epoch
+    """
+    rng = np.random.default_rng(seed)
+    sizes = [len(a) for a in actions]
+    offsets = np.cumsum([0] + sizes)
+    all_actions = np.concatenate(actions)
+    policy = model.policy
+    policy.set_training_mode(True)
+    optimizer = torch.optim.Adam(policy.parameters(), lr=learning_rate)
+    history = []
+    for epoch in range(epochs):
+        losses, correct = [], 0
+        order = rng.permutation(offsets[-1])
+        for start in range(0, len(order), batch_size):
+            batch = np.sort(order[start:start + batch_size])
+            shard = np.searchsorted(offsets, batch, side="right") - 1
+            obs = np.concatenate([observations[s][batch[shard == s] - offsets[s]] for s in np.unique(shard)])
+            obs_tensor, _ = policy.obs_to_tensor(obs)
+            action_tensor = torch.as_tensor(all_actions[batch], device=policy.device).long()
+            _, log_prob, entropy = policy.evaluate_actions(obs_tensor, action_tensor)
+            loss = -log_prob.mean()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+            with torch.no_grad():
+                predicted = policy.get_distribution(obs_tensor).mode()
+            correct += int((predicted == action_tensor).sum())
+        history.append(dict(epoch=epoch + 1, loss=float(np.mean(losses)), accuracy=correct / offsets[-1]))
+        print("Epoch {}: loss {:.4f}, accuracy {:.3f}".format(epoch + 1, history[-1]["loss"], history[-1]["accuracy"]))
+    policy.set_training_mode(False)
+    return history
+
+
+################################################################################
+# COMMAND LINE
+
+
+def run_generate(args):
+    preprocessing = preprocessing_from_args(args)
+    if args.perception == "vision" and args.version != "v0":
+        raise SystemExit("the rule-based agent's templates only match the v0 graphics, use --version v0")
+    print("Generating {} stages with {} seeds".format(len(args.stages), args.seeds))
+    manifest = generate_dataset(
+        args.output,
+        args.stages,
+        range(args.seeds),
+        processes=args.processes,
+        version=args.version,
+        max_steps=args.max_steps,
+        perception=args.perception,
+        **preprocessing,
+    )
+    shards = manifest["shards"]
+    print("{} shards, {} samples, {} episodes reached the flag".format(
+        len(shards), sum(s["samples"] for s in shards), sum(s["flag"] for s in shards)))
+
+
+def run_pretrain(args):
+    manifest, observations, actions = load_dataset(args.dataset, args.only_completed)
+    if not actions:
+        raise SystemExit("no episodes to train on in " + args.dataset)
+    # the model only needs an environment with the dataset's observation and action spaces
+    env = make_vec_env(stage_env_id("1-1", manifest["version"]), subprocesses=False, **manifest["preprocessing"])
+    if args.init_model is not None:
+        model = PPO.load(args.init_model, env=env, device="cpu")
+    else:
+        model = PPO("CnnPolicy", env, seed=args.seed, device="cpu")
+    print("Pretraining on {} samples from {} episodes".format(sum(len(a) for a in actions), len(actions)))
+    pretrain(model, observations, actions, args.epochs, args.batch_size, args.learning_rate, args.seed)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    model.save(args.output)
+    env.close()
+    print("Model written to {} (train it with 1_TrainMario.py --init-model {} and the preprocessing options {})".format(
+        args.output, args.output, manifest["preprocessing"]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pretrain the PPO model on the rule-based agent's play.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate = subparsers.add_parser("generate", help="record the rule-based agent as a dataset")
+    generate.add_argument("--stages", nargs="+", default=ALL_STAGES, help="e.g. 1-1 1-2 (default: all 32)")
+    generate.add_argument("--seeds", type=int, default=SEEDS, help="episodes per stage")
+    generate.add_argument("--processes", type=int, default=None, help="size of the process pool")
+    generate.add_argument("--version", default=VERSION, help="ROM version of the environments")
+    generate.add_argument("--max-steps", type=int, default=MAX_EPISODE_STEPS, help="frames per episode")
+    generate.add_argument("--perception", choices=["vision", "ram"], default=PERCEPTION)
+    generate.add_argument("--output", default=DATASET_DIR, help="dataset directory")
+    add_preprocessing_arguments(generate)  # Must match how the model will be trained
+    generate.set_defaults(run=run_generate)
+
+    pretrain_parser = subparsers.add_parser("pretrain", help="train the PPO policy to copy the dataset")
+    pretrain_parser.add_argument("--dataset", default=DATASET_DIR)
+    pretrain_parser.add_argument("--only-completed", action="store_true", help="only use episodes that reached the flag")
+    pretrain_parser.add_argument("--init-model", default=None, help="start from this model instead of a new one")
+    pretrain_parser.add_argument("--epochs", type=int, default=EPOCHS)
+    pretrain_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    pretrain_parser.add_argument("--learning-rate", type=float, default=PRETRAIN_LEARNING_RATE)
+    pretrain_parser.add_argument("--seed", type=int, default=0)
+    pretrain_parser.add_argument("--output", default=PRETRAINED_PATH)
+    pretrain_parser.set_defaults(run=run_pretrain)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.run(args)
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import gym
+from nes_py.wrappers import JoypadSpace
+from gym_super_mario_bros.actions import SIMPLE_MOVEMENT
+from stable_baselines3.common.vec_env import VecFrameStack, DummyVecEnv, SubprocVecEnv, VecEnvWrapper
+from stable_baselines3.common.monitor import Monitor
+from marioWrappers import make_mario, MaxAndSkipFrame, ResizeObservation, StepTimingWrapper
+from marioSharedMemory import SharedMemoryVecEnv
+
+# Shared environment setup for the PPO scripts (1_TrainMario.py, 2_RunMario.py
+# and 3_RunMarioDeterministic.py), so that training and running the model
+# always see exactly the same preprocessing.
+
+################################################################################
+# CONSTANTS
+
+FRAME_STACK = 4  # How many frames are stacked together into one observation
+
+# The preprocessing used by --preprocess: repeat each action for 4 frames and
+# feed the model 84x84 grayscale frames, which makes observations (and the
+# rollout buffer) about 30 times smaller than the full 240x256 colour frames.
+# The default is no preprocessing, which is what the included models expect.
+PREPROCESS_FRAME_SKIP = 4
+PREPROCESS_FRAME_SIZE = 84
+
+# A fix for the JoypadSpace wrapper. This is done when the module is imported
+# (rather than in the scripts) so it is also applied inside worker processes.
+JoypadSpace.reset = lambda self, **kwargs: self.env.reset(**kwargs)
+
+
+################################################################################
+# CREATE AND PREPROCESS THE ENVIRONMENT
+
+
+def _monitor(env, path, resume):
+    # a Monitor writing to path.monitor.csv, carrying on from the episodes already in it when
+    # resuming (with the same start time, so their wall times stay in order)
+    filename = "{}.{}".format(path, Monitor.EXT)
+    if not (resume and os.path.exists(filename)):
+        return Monitor(env, path)
+    with open(filename) as f:
+        t_start = json.loads(f.readline()[1:])["t_start"]  # the #{...} metadata line
+    env = Monitor(env, path, override_existing=False)
+    env.t_start = t_start
+    return env
+
+
+def add_preprocessing_arguments(parser):
+    """
+    Add the observation preprocessing options to an argument parser.
+
+    A model has to be run with the same preprocessing it was trained with.
+
+    :param parser: (argparse.ArgumentParser) the parser of an entry point
+    """
+    parser.add_argument(
+        "--preprocess",
+        action="store_true",
+        help="shorthand for --frame-skip {0} --grayscale --frame-size {1}".format(
+            PREPROCESS_FRAME_SKIP, PREPROCESS_FRAME_SIZE
+        ),
+    )
+    parser.add_argument(
+        "--frame-skip",
+        type=int,
+        default=1,
+        help="repeat each action for this many frames, max-pooling the last two",
+    )
+    parser.add_argument("--grayscale", action="store_true", help="use grayscale frames")
+    parser.add_argument(
+        "--frame-size", type=int, default=None, help="resize frames to this width and height"
+    )
+
+
+def preprocessing_from_args(args):
+    """
+    Turn the options added by add_preprocessing_arguments into make_vec_env arguments.
+
+    :param args: (argparse.Namespace) the parsed command line
+    :return: (dict) frame_skip, grayscale and frame_size
+    """
+    if args.preprocess:
+        return dict(
+            frame_skip=PREPROCESS_FRAME_SKIP, grayscale=True, frame_size=PREPROCESS_FRAME_SIZE
+        )
+    return dict(frame_skip=args.frame_skip, grayscale=args.grayscale, frame_size=args.frame_size)
+
+
+def make_env(
+    env_id,
+    rank=0,
+    log_dir=None,
+    headless=True,
+    render_every=1,
+    video_dir=None,
+    frame_skip=1,
+    grayscale=False,
+    frame_size=None,
+    max_episode_steps=None,
+    snapshots=False,
+    record_dir=None,
+    record_frames=False,
+    timings=False,
+    curriculum=None,
+    resume=False,
+):
+    """
+    Return a function that creates a single Mario environment.
+
+    :param env_id: (str) gym_super_mario_bros environment id, e.g. "SuperMarioBros-1-1-v3"
+    :param rank: (int) index of the worker, used to give each worker its own monitor file
+    :param log_dir: (str) where to write the monitor logs, or None for no monitor
+    :param headless: (bool) never open a window
+    :param render_every: (int) only render every Kth episode
+    :param video_dir: (str) write rendered episodes to videos here instead of a window
+    :param frame_skip: (int) repeat each action for this many frames
+    :param grayscale: (bool) convert frames to grayscale
+    :param frame_size: (int) resize frames to frame_size x frame_size, or None
+    :param max_episode_steps: (int) end episodes after this many agent steps, or None
+    :param snapshots: (bool) start some episodes from snapshots further along the stage
+    :param record_dir: (str) record every episode to a file per worker in this directory, or None
+    :param record_frames: (bool) also store the frames in the recordings
+    :param timings: (bool) report the time spent in the emulator and in the whole environment
+        in info["timings"] (see StepTimingWrapper)
+    :param curriculum: ([str]) play a stage sampled from these every episode, or None
+    :param resume: (bool) add to the monitor file instead of starting it again
+    :return: (callable) a function with no arguments that returns the environment
+    """
+
+    def _init():
+        # Create the environment
+        record_path = None if record_dir is None else os.path.join(record_dir, "worker_{}.mario".format(rank))
+        env = make_mario(env_id, headless, render_every, video_dir, snapshots, record_path, record_frames, curriculum)
+        if timings:
+            env = StepTimingWrapper(env, "emulator")  # Time spent in the emulator itself
+        if log_dir is not None:
+            # Create a monitor for tensorboard logging (one file per worker)
+            env = _monitor(env, os.path.join(log_dir, str(rank)), resume)
+        env = JoypadSpace(env, SIMPLE_MOVEMENT)  # Set the joypad space to simple movement
+        if frame_skip > 1:
+            env = MaxAndSkipFrame(env, frame_skip)  # Only choose an action every few frames
+        if grayscale or frame_size is not None:
+            env = ResizeObservation(env, frame_size, grayscale)  # Shrink the frames
+        if max_episode_steps is not None:
+            env = gym.wrappers.TimeLimit(env, max_episode_steps)  # Stop stuck episodes
+        if timings:
+            env = StepTimingWrapper(env, "env")  # Time spent in the emulator and all the wrappers
+        return env
+
+    return _init
+
+
+def make_vec_env(
+    env_id,
+    n_workers=1,
+    seed=0,
+    log_dir=None,
+    headless=True,
+    render_every=1,
+    video_dir=None,
+    frame_skip=1,
+    grayscale=False,
+    frame_size=None,
+    max_episode_steps=None,
+    subprocesses=True,
+    snapshots=False,
+    record_dir=None,
+    record_frames=False,
+    timings=False,
+    shared_memory=False,
+    curriculum=None,
+    resume=False,
+):
+    """
+    Create a vector of Mario environments with the last FRAME_STACK frames stacked.
+
+    With more than one worker, every environment runs its own NES emulator in a
+    separate process so rollouts are collected on several cores at once. Only
+    the first worker is rendered, to avoid opening a window (or writing videos)
+    per process.
+
+    :param env_id: (str) gym_super_mario_bros environment id
+    :param n_workers: (int) number of environments (and processes, if more than 1)
+    :param seed: (int) seed for the first worker, worker i is seeded with seed + i
+    :param log_dir: (str) where to write the monitor logs, or None for no monitor
+    :param headless: (bool) never open a window
+    :param render_every: (int) only render every Kth episode of the first worker
+    :param video_dir: (str) write the first worker's rendered episodes to videos here
+    :param frame_skip: (int) repeat each action for this many frames
+    :param grayscale: (bool) convert frames to grayscale
+    :param frame_size: (int) resize frames to frame_size x frame_size, or None
+    :param max_episode_steps: (int) end episodes after this many agent steps, or None
+    :param subprocesses: (bool) False to run all the workers in this process, e.g. when
+        this process is already one of many
+    :param snapshots: (bool) start some episodes from snapshots further along the stage
+        (see SnapshotResetWrapper)
+    :param record_dir: (str) record every episode to a file per worker in this directory, or None
+        (see marioRecording.py)
+    :param record_frames: (bool) also store the frames in the recordings
+    :param timings: (bool) time the emulator, the wrappers, the vectorised environment and the
+        frame stacking, for ProfilingCallback (see marioCallbacks.py)
+    :param shared_memory: (bool) run the workers in processes that write their frames into
+        shared memory, stacked where they are written (see SharedMemoryVecEnv), instead of
+        sending them through pipes and stacking them with VecFrameStack
+    :param curriculum: ([str]) have every worker play a stage sampled from these every
+        episode (see CurriculumWrapper), env_id being the first of them, or None
+    :param resume: (bool) carry on the monitor files in log_dir (when resuming training)
+        instead of starting them again
+    :return: (VecEnv) the vectorised, frame stacked environment
+    """
+    options = dict(
+        frame_skip=frame_skip,
+        grayscale=grayscale,
+        frame_size=frame_size,
+        max_episode_steps=max_episode_steps,
+        snapshots=snapshots,
+        record_dir=record_dir,
+        record_frames=record_frames,
+        timings=timings,
+        curriculum=curriculum,
+        resume=resume,
+    )
+    env_fns = [make_env(env_id, 0, log_dir, headless, render_every, video_dir, **options)]
+    env_fns += [make_env(env_id, rank, log_dir, **options) for rank in range(1, n_workers)]
+    if shared_memory:
+        env = SharedMemoryVecEnv(env_fns, FRAME_STACK)  # One process per environment, stacked in shared memory
+    elif n_workers > 1 and subprocesses:
+        env = SubprocVecEnv(env_fns)  # One process per environment
+    else:
+        env = DummyVecEnv(env_fns)  # Run the environments in this process
+    env.seed(seed)  # Each worker gets its own seed on the next reset
+    if timings:
+        env = VecTimingWrapper(env, "workers")  # Stepping every worker, including sending the frames back
+    if not shared_memory:
+        env = VecFrameStack(env, FRAME_STACK, channels_order="last")  # Stack the last 4 frames together
+    if timings:
+        env = VecTimingWrapper(env, "vec_env")  # Everything, including the frame stacking
+    return env
+
+
+class VecTimingWrapper(VecEnvWrapper):
+    """
+    Add up the time spent stepping and resetting a vectorised environment.
+
+    :param venv: (VecEnv) the vectorised environment to time
+    :param name: (str) what ProfilingCallback reports it as
+    """
+
+    def __init__(self, venv, name):
+        super(VecTimingWrapper, self).__init__(venv)
+        self.name = name
+        self.seconds = 0.0
+        self.steps = 0
+        self.start = None
+
+    def reset(self):
+        start = time.perf_counter()
+        obs = self.venv.reset()
+        self.seconds += time.perf_counter() - start
+        return obs
+
+    def step_async(self, actions):
+        self.start = time.perf_counter()
+        self.venv.step_async(actions)
+
+    def step_wait(self):
+        result = self.venv.step_wait()
+        self.seconds += time.perf_counter() - self.start
+        self.steps += 1
+        return result
@@ -0,0 +1,287 @@
+import os
+import re
+import csv
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from stable_baselines3 import PPO
+from marioEnv import make_vec_env, add_preprocessing_arguments, preprocessing_from_args
+from marioWrappers import stage_env_id
+
+# Rank saved PPO checkpoints by running them on a set of stages.
+# e.g. "poetry run python marioEvaluate.py --checkpoints "./models/checkpoint_*.zip"
+#       --stages 1-1 1-2 --episodes 8 --output results.csv"
+
+################################################################################
+# CONSTANTS
+
+STAGES = ["1-1"]  # Stages to evaluate on by default ("all" is the whole game)
+VERSION = "v3"  # ROM version of the environments, the included models use v3
+EPISODES = 5  # Episodes per checkpoint and stage
+ENVS_PER_JOB = 4  # Episodes run at the same time (and predicted in one batch) per job
+MAX_EPISODE_STEPS = 5000  # Agent steps before an episode is cut off (e.g. stuck on a pipe)
+
+RESULT_FIELDS = [
+    "checkpoint",
+    "stage",
+    "episodes",
+    "mean_x_pos",
+    "max_x_pos",
+    "flag_rate",
+    "mean_reward",
+    "mean_steps",
+    "mean_episode_seconds",
+]
+
+
+################################################################################
+# RUNNING EPISODES
+
+
+def run_episodes(model, env, episodes, deterministic=True):
+    """
+    Run a model on a vectorised environment until it has finished enough episodes.
+
+    Each environment runs an equal share of the episodes, so quick episodes
+    (e.g. early deaths) aren't over-represented. Actions for all environments
+    are predicted in one batch.
+
+    :param model: (BaseAlgorithm) the model to run
+    :param env: (VecEnv) the environment, with the same preprocessing the model was trained with
+    :param episodes: (int) how many episodes to run in total
+    :param deterministic: (bool) whether to use the most likely action instead of sampling
+    :return: ([dict]) one dict per episode with x_pos, flag, reward, steps and seconds
+    """
+    n_envs = env.num_envs
+    quotas = [episodes // n_envs + (i < episodes % n_envs) for i in range(n_envs)]
+    results = [[] for _ in range(n_envs)]
+    max_x = np.zeros(n_envs, dtype=np.int64)
+    flags = np.zeros(n_envs, dtype=bool)
+    rewards = np.zeros(n_envs)
+    steps = np.zeros(n_envs, dtype=np.int64)
+    starts = np.full(n_envs, time.perf_counter())
+
+    obs = env.reset()
+    while any(len(results[i]) < quotas[i] for i in range(n_envs)):
+        actions, _ = model.predict(obs, deterministic=deterministic)
+        obs, step_rewards, dones, infos = env.step(actions)
+        rewards += step_rewards
+        steps += 1
+        for i, info in enumerate(infos):
+            # x_pos goes back to the start of the stage after a death in the
+            # whole-game environments, so keep the furthest point reached
+            max_x[i] = max(max_x[i], info["x_pos"])
+            flags[i] |= info["flag_get"]
+            if not dones[i]:
+                continue
+            if len(results[i]) < quotas[i]:
+                results[i].append(
+                    dict(
+                        x_pos=int(max_x[i]),
+                        flag=bool(flags[i]),
+                        reward=float(rewards[i]),
+                        steps=int(steps[i]),
+                        seconds=time.perf_counter() - starts[i],
+                    )
+                )
+            max_x[i], flags[i], rewards[i], steps[i] = 0, False, 0, 0
+            starts[i] = time.perf_counter()
+    return [episode for env_results in results for episode in env_results]
+
+
+def summarise(checkpoint, stage, episodes):
+    """
+    Summarise the episodes of one checkpoint on one stage as a row of the results table.
+
+    :param checkpoint: (str) path of the checkpoint
+    :param stage: (str) the stage it was run on
+    :param episodes: ([dict]) episodes from run_episodes
+    :return: (dict) a row with the RESULT_FIELDS keys
+    """
+    return dict(
+        checkpoint=checkpoint,
+        stage=stage,
+        episodes=len(episodes),
+        mean_x_pos=float(np.mean([e["x_pos"] for e in episodes])),
+        max_x_pos=max(e["x_pos"] for e in episodes),
+        flag_rate=float(np.mean([e["flag"] for e in episodes])),
+        mean_reward=float(np.mean([e["reward"] for e in episodes])),
+        mean_steps=float(np.mean([e["steps"] for e in episodes])),
+        mean_episode_seconds=float(np.mean([e["seconds"] for e in episodes])),
+    )
+
+
+def evaluate_checkpoint(
+    checkpoint,
+    stage,
+    episodes=EPISODES,
+    n_envs=ENVS_PER_JOB,
+    deterministic=True,
+    version=VERSION,
+    max_episode_steps=MAX_EPISODE_STEPS,
+    **preprocessing
+):
+    """
+    Run one checkpoint on one stage and summarise the results.
+
+    :param checkpoint: (str) path of a saved PPO model
+    :param stage: (str) "world-stage" such as "1-1", or "all" for the whole game
+    :param episodes: (int) how many episodes to run (only 1 if deterministic)
+    :param n_envs: (int) how many episodes to run at the same time
+    :param deterministic: (bool) whether to use the most likely action instead of sampling
+    :param version: (str) the ROM version
+    :param max_episode_steps: (int) agent steps before an episode is cut off
+    :param preprocessing: frame_skip, grayscale and frame_size the model was trained with
+    :return: ((dict, [dict])) the results table row and the individual episodes
+    """
+    if deterministic:
+        episodes = 1  # neither the game nor the model has any randomness, so they would all be the same
+    env = make_vec_env(
+        stage_env_id(stage, version),
+        n_workers=min(n_envs, episodes),
+        max_episode_steps=max_episode_steps,
+        subprocesses=False,  # The jobs themselves already run in parallel
+        **preprocessing
+    )
+    model = PPO.load(checkpoint, device="cpu")
+    episode_results = run_episodes(model, env, episodes, deterministic)
+    env.close()
+    return summarise(checkpoint, stage, episode_results), episode_results
+
+
+def _evaluate_job(job):
+    checkpoint, stage, kwargs = job
+    return evaluate_checkpoint(checkpoint, stage, **kwargs)
+
+
+def _init_worker():
+    # every job runs in its own process, so stop torch using every core in each of them
+    torch.set_num_threads(1)
+
+
+def evaluate_checkpoints(checkpoints, stages, processes=None, **kwargs):
+    """
+    Evaluate every checkpoint on every stage, spreading the jobs over a process pool.
+
+    :param checkpoints: ([str]) paths of saved PPO models
+    :param stages: ([str]) stages to run each checkpoint on
+    :param processes: (int) size of the process pool, defaults to the number of cores
+    :param kwargs: passed on to evaluate_checkpoint
+    :return: (([dict], [[dict]])) the results table rows and the episodes of each row
+    """
+    jobs = [(checkpoint, stage, kwargs) for checkpoint in checkpoints for stage in stages]
+    with ProcessPoolExecutor(processes, initializer=_init_worker) as pool:
+        outputs = list(pool.map(_evaluate_job, jobs))
+    return [row for row, _ in outputs], [episodes for _, episodes in outputs]
+
+
+################################################################################
+# RESULTS
+
+
+def find_checkpoints(patterns):
+    """
+    Expand glob patterns into checkpoint paths, in the order they were saved.
+
+    :param patterns: ([str]) e.g. ["./models/checkpoint_*.zip"]
+    :return: ([str]) the matching paths, sorted by the step number in their name
+    """
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+
+    def step_number(path):
+        numbers = re.findall(r"\d+", os.path.basename(path))
+        return (int(numbers[-1]) if numbers else -1, path)
+
+    return sorted(paths, key=step_number)
+
+
+def rank_checkpoints(rows):
+    """
+    Rank checkpoints by flag rate and then mean x_pos, averaged over all stages.
+
+    :param rows: ([dict]) results table rows
+    :return: ([(str, float, float)]) (checkpoint, flag rate, mean x_pos), best first
+    """
+    by_checkpoint = {}
+    for row in rows:
+        by_checkpoint.setdefault(row["checkpoint"], []).append(row)
+    ranking = [
+        (
+            checkpoint,
+            float(np.mean([row["flag_rate"] for row in checkpoint_rows])),
+            float(np.mean([row["mean_x_pos"] for row in checkpoint_rows])),
+        )
+        for checkpoint, checkpoint_rows in by_checkpoint.items()
+    ]
+    return sorted(ranking, key=lambda r: (r[1], r[2]), reverse=True)
+
+
+def write_results(path, rows, episodes):
+    """
+    Write the results table as CSV, or as JSON (including every episode) if path ends in .json.
+
+    :param path: (str) output file
+    :param rows: ([dict]) results table rows
+    :param episodes: ([[dict]]) the episodes of each row
+    """
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(
+                [dict(row, episode_results=eps) for row, eps in zip(rows, episodes)], f, indent=2
+            )
+    else:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+################################################################################
+# COMMAND LINE
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evaluate and rank saved PPO checkpoints.")
+    parser.add_argument(
+        "--checkpoints", nargs="+", required=True, help='glob patterns, e.g. "./models/*.zip"'
+    )
+    parser.add_argument("--stages", nargs="+", default=STAGES, help='e.g. 1-1 1-2 4-1, or "all"')
+    parser.add_argument("--version", default=VERSION, help="ROM version of the environments")
+    parser.add_argument("--episodes", type=int, default=EPISODES, help="episodes per checkpoint and stage (with --stochastic)")
+    parser.add_argument("--envs", type=int, default=ENVS_PER_JOB, help="episodes run at once per job")
+    parser.add_argument("--processes", type=int, default=None, help="size of the process pool")
+    parser.add_argument("--max-steps", type=int, default=MAX_EPISODE_STEPS, help="agent steps per episode")
+    parser.add_argument("--stochastic", action="store_true", help="sample actions instead of the most likely")
+    parser.add_argument("--output", default="results.csv", help="results file (.csv or .json)")
+    add_preprocessing_arguments(parser)  # Must match how the models were trained
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    checkpoints = find_checkpoints(args.checkpoints)
+    if not checkpoints:
+        raise SystemExit("No checkpoints match {}".format(" ".join(args.checkpoints)))
+    print("Evaluating {} checkpoints on {} stages".format(len(checkpoints), len(args.stages)))
+
+    rows, episodes = evaluate_checkpoints(
+        checkpoints,
+        args.stages,
+        processes=args.processes,
+        episodes=args.episodes,
+        n_envs=args.envs,
+        deterministic=not args.stochastic,
+        version=args.version,
+        max_episode_steps=args.max_steps,
+        **preprocessing_from_args(args),
+    )
+    write_results(args.output, rows, episodes)
+
+    print(f"{'flag rate':>9} {'mean x_pos':>10}  checkpoint")
+    for checkpoint, flag_rate, mean_x_pos in rank_checkpoints(rows):
+        print(f"{flag_rate:>9.2f} {mean_x_pos:>10.1f}  {checkpoint}")
+    print("Results written to " + args.output)
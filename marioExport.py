@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from torch import nn
+from stable_baselines3 import PPO
+from marioEnv import make_vec_env, add_preprocessing_arguments, preprocessing_from_args
+
+try:
+    import onnxruntime  # optional, only needed to run ONNX exports
+except ImportError:
+    onnxruntime = None
+
+# Export a saved PPO model's policy as a standalone TorchScript or ONNX file, which
+# can be run without stable_baselines3, optionally quantized, and compare how long
+# it takes per step with PPO.predict.
+# e.g. "poetry run python marioExport.py export ./models/best_model.zip --quantize int8"
+#      "poetry run python marioExport.py benchmark ./models/best_model.zip ./models/best_model.int8.pt"
+#      "poetry run python 2_RunMario.py --model ./models/best_model.int8.pt --threads 1"
+
+################################################################################
+# CONSTANTS
+
+FORMATS = ["torchscript", "onnx"]
+QUANTIZATIONS = ["none", "int8", "half"]
+BENCHMARK_STEPS = 200  # Observations timed per model
+WARMUP_STEPS = 10  # Untimed steps first (the first few calls of a traced model are slower)
+
+
+################################################################################
+# EXPORTING
+
+
+class PolicyNetwork(nn.Module):
+    """
+    The part of a PPO policy that chooses actions, as a plain torch module.
+
+    It takes the observations exactly as the vectorised environment returns
+    them (uint8, channels last) and returns the logits of each action, doing the
+    channel transpose and scaling stable_baselines3 would do first.
+
+    :param model: (PPO) the model, with a CnnPolicy
+    :param half: (bool) run in 16 bit floats
+    """
+
+    def __init__(self, model, half=False):
+        super(PolicyNetwork, self).__init__()
+        policy = model.policy
+        self.features_extractor = policy.pi_features_extractor
+        self.policy_net = policy.mlp_extractor.policy_net
+        self.action_net = policy.action_net
+        self.normalize = bool(policy.normalize_images)
+        self.dtype = torch.float16 if half else torch.float32
+        self.to(self.dtype)
+
+    def forward(self, obs):
+        x = obs.permute(0, 3, 1, 2).to(self.dtype)
+        if self.normalize:
+            x = x / 255.0
+        return self.action_net(self.policy_net(self.features_extractor(x)))
+
+
+def export_policy(model_path, output, export_format="torchscript", quantize="none"):
+    """
+    Export a saved PPO model's policy network.
+
+    "int8" quantizes the weights of the fully connected layers (most of the
+    network's weights, and the slowest part on CPU) to 8 bits; the convolutions
+    stay float. "half" converts the whole network to 16 bit floats. ONNX exports
+    can't be int8 quantized this way.
+
+    :param model_path: (str) the saved PPO model
+    :param output: (str) the file to write (.pt for TorchScript, .onnx for ONNX)
+    :param export_format: (str) "torchscript" or "onnx"
+    :param quantize: (str) "none", "int8" or "half"
+    :return: (dict) the metadata written next to it (output + ".json")
+    """
+    model = PPO.load(model_path, device="cpu")
+    network = PolicyNetwork(model, half=quantize == "half").eval()
+    # an example observation, in the shape the environment gives them (channels last)
+    channels, height, width = model.observation_space.shape
+    example = torch.zeros((1, height, width, channels), dtype=torch.uint8)
+    if quantize == "int8":
+        if export_format == "onnx":
+            raise ValueError("int8 quantization is only supported for TorchScript exports")
+        network = torch.ao.quantization.quantize_dynamic(network, {nn.Linear}, dtype=torch.qint8)
+
+    with torch.no_grad():
+        if export_format == "torchscript":
+            traced = torch.jit.trace(network, example)
+            traced = torch.jit.freeze(traced.eval())  # fold the weights into the graph
+            traced.save(output)
+        else:
+            try:
+                torch.onnx.export(
+                    network,
+                    (example,),
+                    output,
+                    input_names=["obs"],
+                    output_names=["logits"],
+                    dynamic_axes={"obs": {0: "batch"}, "logits": {0: "batch"}},
+                )
+            except ModuleNotFoundError as error:
+                raise ImportError("exporting to ONNX needs the onnx packages ({})".format(error)) from error
+    metadata = dict(
+        source=model_path,
+        format=export_format,
+        quantize=quantize,
+        obs_shape=[height, width, channels],
+        n_actions=int(model.action_space.n),
+    )
+    with open(output + ".json", "w") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+################################################################################
+# RUNNING
+
+
+class ExportedPolicy:
+    """
+    Run an exported policy, with the same predict method as a PPO model.
+
+    :param path: (str) a .pt (TorchScript) or .onnx file written by export_policy
+    :param threads: (int) threads to run it with, or None for the default
+    :param seed: (int) seed for sampling actions when predict isn't deterministic
+    """
+
+    def __init__(self, path, threads=None, seed=None):
+        self.path = path
+        self.rng = np.random.default_rng(seed)
+        if path.endswith(".onnx"):
+            if onnxruntime is None:
+                raise ImportError("running ONNX models needs onnxruntime (pip install onnxruntime)")
+            options = onnxruntime.SessionOptions()
+            if threads is not None:
+                options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+            self.module = None
+        else:
+            if threads is not None:
+                torch.set_num_threads(threads)
+            self.module = torch.jit.load(path, map_location="cpu")
+            self.session = None
+
+    def logits(self, obs):
+        """
+        Get the logits of every action.
+
+        :param obs: (np.ndarray) a batch of observations from the vectorised environment
+        :return: (np.ndarray) the logits, one row per observation
+        """
+        if self.session is not None:
+            return self.session.run(None, {"obs": np.asarray(obs, dtype=np.uint8)})[0]
+        with torch.inference_mode():
+            return self.module(torch.from_numpy(np.asarray(obs, dtype=np.uint8))).float().numpy()
+
+    def predict(self, obs, deterministic=False):
+        """
+        Choose actions, like PPO.predict.
+
+        :param obs: (np.ndarray) a batch of observations from the vectorised environment
+        :param deterministic: (bool) whether to choose the most likely action instead of sampling
+        :return: ((np.ndarray, None)) the actions, and no state
+        """
+        logits = self.logits(obs)
+        if deterministic:
+            return logits.argmax(axis=1), None
+        # sample from the softmax of the logits, the same distribution as PPO
+        probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        cumulative = probabilities.cumsum(axis=1)
+        samples = self.rng.random((len(logits), 1))
+        return (samples > cumulative[:, :-1]).sum(axis=1), None
+
+
+def load_policy(path, threads=None):
+    """
+    Load a saved PPO model, or an exported policy if the path ends in .pt or .onnx.
+
+    :param path: (str) the model
+    :param threads: (int) threads to run it with, or None for the default
+    :return: (PPO or ExportedPolicy) something with a PPO-like predict method
+    """
+    if path.endswith(".pt") or path.endswith(".onnx"):
+        return ExportedPolicy(path, threads)
+    if threads is not None:
+        torch.set_num_threads(threads)
+    return PPO.load(path)
+
+
+################################################################################
+# BENCHMARK
+
+
+def time_predictions(model, observations, deterministic=True):
+    """
+    Time how long a model takes to choose an action for each observation, one at a time.
+
+    :param model: (PPO or ExportedPolicy) the model
+    :param observations: (np.ndarray) observations from the vectorised environment
+    :return: ((np.ndarray, np.ndarray)) the milliseconds per observation, and the actions chosen
+    """
+    for obs in observations[:WARMUP_STEPS]:
+        model.predict(obs[None], deterministic=deterministic)
+    times, actions = [], []
+    for obs in observations:
+        start = time.perf_counter()
+        action, _ = model.predict(obs[None], deterministic=deterministic)
+        times.append(1000 * (time.perf_counter() - start))
+        actions.append(int(action[0]))
+    return np.array(times), np.array(actions)
+
+
+def record_observations(env, steps, seed=0):
+    """
+    Record observations of random play to time the models on.
+
+    :param env: (VecEnv) the environment, with the models' preprocessing
+    :param steps: (int) how many observations
+    :param seed: (int) seed for the random actions
+    :return: (np.ndarray) the observations
+    """
+    rng = np.random.default_rng(seed)
+    obs = env.reset()
+    observations = []
+    for _ in range(steps):
+        observations.append(obs[0].copy())
+        obs, _, _, _ = env.step(rng.integers(env.action_space.n, size=env.num_envs))
+    return np.array(observations)
+
+
+def run_benchmark(args):
+    env = make_vec_env("SuperMarioBros-1-1-v3", subprocesses=False, **preprocessing_from_args(args))
+    observations = record_observations(env, args.steps)
+    env.close()
+
+    torch.set_num_threads(args.threads)
+    model = PPO.load(args.model, device="cpu")
+    baseline_times, baseline_actions = time_predictions(model, observations)
+    print(f"{'model':<40} {'mean ms':>8} {'p50 ms':>7} {'p99 ms':>7} {'speedup':>7} {'same action':>11}")
+    print(f"{'PPO.predict':<40} {baseline_times.mean():>8.3f} {np.percentile(baseline_times, 50):>7.3f}"
+          f" {np.percentile(baseline_times, 99):>7.3f} {1.0:>7.2f} {1.0:>11.3f}")
+    for path in args.exports:
+        times, actions = time_predictions(ExportedPolicy(path, args.threads), observations)
+        print(f"{os.path.basename(path):<40} {times.mean():>8.3f} {np.percentile(times, 50):>7.3f}"
+              f" {np.percentile(times, 99):>7.3f} {baseline_times.mean() / times.mean():>7.2f}"
+              f" {np.mean(actions == baseline_actions):>11.3f}")
+
+
+################################################################################
+# COMMAND LINE
+
+
+def run_export(args):
+    if args.output is None:
+        suffix = "" if args.quantize == "none" else "." + args.quantize
+        args.output = os.path.splitext(args.model)[0] + suffix + (".onnx" if args.format == "onnx" else ".pt")
+    metadata = export_policy(args.model, args.output, args.format, args.quantize)
+    print("Exported {} ({}, quantization {}, observations {})".format(
+        args.output, metadata["format"], metadata["quantize"], tuple(metadata["obs_shape"])))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export PPO policies for fast inference.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser("export", help="export a saved PPO model's policy")
+    export.add_argument("model", help="the saved PPO model (.zip)")
+    export.add_argument("--format", choices=FORMATS, default="torchscript")
+    export.add_argument("--quantize", choices=QUANTIZATIONS, default="none")
+    export.add_argument("--output", default=None, help="defaults to the model's path with .pt or .onnx")
+    export.set_defaults(run=run_export)
+
+    benchmark = subparsers.add_parser("benchmark", help="compare the time per step with PPO.predict")
+    benchmark.add_argument("model", help="the saved PPO model (.zip)")
+    benchmark.add_argument("exports", nargs="*", help="exported versions of it")
+    benchmark.add_argument("--steps", type=int, default=BENCHMARK_STEPS, help="observations to time")
+    benchmark.add_argument("--threads", type=int, default=1, help="torch/onnxruntime threads")
+    add_preprocessing_arguments(benchmark)  # Must match how the model was trained
+    benchmark.set_defaults(run=run_benchmark)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.run(args)
@@ -0,0 +1,199 @@
+import numpy as np
+
+# A tile-sized occupancy grid of the screen for the rule-based agent's decisions.
+# The located objects (from ruleBasedMario.locate_objects or
+# marioRam.locate_objects_ram) are drawn into a small array of cells once per
+# frame, and make_action asks it questions like "is Mario standing on something"
+# or "is there an enemy within 4 tiles", which look at a few cells with numpy
+# instead of going through every object.
+
+################################################################################
+# CONSTANTS
+
+SCREEN_HEIGHT = 240
+SCREEN_WIDTH = 256
+TILE_SIZE = 16  # The level is made of 16x16 tiles, one cell each
+GRID_ROWS = SCREEN_HEIGHT // TILE_SIZE
+GRID_COLUMNS = SCREEN_WIDTH // TILE_SIZE + 1  # the screen is usually between tiles, so one more column
+
+# What can be in a cell (a cell can have several of these at once)
+SOLID = 1  # blocks, pipes and the ground
+ENEMY = 2  # enemies that can be jumped on
+HAZARD = 4  # enemies that can't, e.g. piranha plants
+CATEGORY_CELLS = {"block": SOLID, "enemy": ENEMY, "hard_enemy": HAZARD}
+CELL_BITS = np.array(list(CATEGORY_CELLS.values()), np.uint8)
+
+GROUND_TOLERANCE = 2  # how far (pixels) above or below the top of a block Mario's feet can be and still be on it
+PIT_LOOKAHEAD = 1  # how many columns in front of Mario must have ground below his feet
+PIT_DEPTH = GRID_ROWS  # how many rows below Mario's feet to look for ground in front of him (1 counts any drop)
+PIT_WALL = 2  # and how many rows above them
+ENEMY_RANGE = 4  # how many columns ahead of (or behind) the back of Mario to look for enemies
+ENEMY_ROWS = 1  # and how many rows above and below him
+BEHIND_RANGE = 1  # how many columns behind Mario to look for enemies to jump back over
+LEDGE_LOOKAHEAD = 2  # how many columns in front of Mario to look for a drop onto lower ground
+LANDING_RANGE = 6  # and how many to look for enemies where he would land
+
+# Where Mario is (relative to where he jumps from, in pixels, y upwards) every 3 frames of a
+# jump that holds jump for 25 frames while running right, measured on 1-1 at a low running speed
+JUMP_ARC = np.array([
+    (2, 0), (6, 14), (10, 27), (15, 37), (20, 46), (26, 54), (31, 60), (36, 64),
+    (41, 67), (47, 68), (50, 66), (55, 59), (61, 46), (66, 31), (71, 16), (76, 1),
+])
+
+
+################################################################################
+# THE GRID
+
+
+# (x, y, width, height) -> (left, right, top, bottom) pixel edges of a box, with one matrix multiply
+_EDGES = np.array([[1, 1, 0, 0], [0, 0, 1, 1], [0, 1, 0, 0], [0, 0, 0, 1]])
+_EDGE_LIMITS = np.array([GRID_COLUMNS, GRID_COLUMNS, GRID_ROWS, GRID_ROWS])
+_CORNER_SIGNS = np.array([1.0, -1.0, -1.0, 1.0])
+
+
+def _rasterise(boxes, origin_x):
+    # Which cells of each category's layer are covered by any of its boxes (rows of x, y, width,
+    # height, category index): +1/-1 is added at the corners of every box, all at once with a
+    # bincount, and those are added up along the rows and columns
+    edges = (boxes[:, :4] @ _EDGES - [origin_x, origin_x + 1, 0, 1]) // TILE_SIZE + [0, 1, 0, 1]
+    edges = np.minimum(np.maximum(edges, 0), _EDGE_LIMITS)  # (cells, from the first to one past the last)
+    rows = edges[:, [2, 2, 3, 3]] + boxes[:, 4:] * (GRID_ROWS + 1)
+    index = rows * (GRID_COLUMNS + 1) + edges[:, [0, 1, 0, 1]]
+    weights = np.broadcast_to(_CORNER_SIGNS, index.shape).ravel()
+    shape = (len(CATEGORY_CELLS), GRID_ROWS + 1, GRID_COLUMNS + 1)
+    corners = np.bincount(index.ravel(), weights, minlength=shape[0] * shape[1] * shape[2]).reshape(shape)
+    return corners.cumsum(axis=1).cumsum(axis=2)[:, :GRID_ROWS, :GRID_COLUMNS] > 0.5
+
+
+class OccupancyGrid:
+    """
+    The screen as GRID_ROWS x GRID_COLUMNS tiles, each a combination of SOLID,
+    ENEMY and HAZARD.
+
+    The columns line up with the level's tiles, which is where the blocks are,
+    so a block fills exactly one cell. Enemies and Mario are usually between
+    tiles, so they cover every cell they overlap. The questions all take Mario's
+    location in the same format as the located objects, ((x, y), (width, height)),
+    with x and y the top left corner of his sprite on the screen.
+
+    :param object_locations: (dict) category -> [((x, y), (width, height), name)], as returned
+        by locate_objects
+    """
+
+    def __init__(self, object_locations):
+        boxes = [
+            location + dimensions + (layer,)
+            for layer, category in enumerate(CATEGORY_CELLS)
+            for location, dimensions, name in object_locations.get(category, [])
+        ]
+        boxes = np.array(boxes, np.int64).reshape(-1, 5)
+        blocks = boxes[boxes[:, 4] == 0]  # (the first rows)
+        # the blocks' x coordinates all have the same remainder (how far the screen has scrolled
+        # into a tile), so the most common one is used in case a few were matched a pixel off
+        offset = np.bincount(blocks[:, 0] % TILE_SIZE).argmax() if len(blocks) else 0
+        self.origin_x = int(offset) - TILE_SIZE  # the screen x of the left edge of the first column
+        # and the odd one out (e.g. a pipe matched 2 pixels to the side) is moved onto the nearest tile,
+        # so it doesn't spill into the next column
+        snap = np.array([self.origin_x, 0])
+        boxes[:len(blocks), :2] = (boxes[:len(blocks), :2] - snap + TILE_SIZE // 2) // TILE_SIZE * TILE_SIZE + snap
+        layers = _rasterise(boxes, self.origin_x)
+        # each category has its own bit, so adding up the layers combines them
+        self.cells = (layers * CELL_BITS[:, None, None]).sum(axis=0, dtype=np.uint8)
+
+    def column(self, x):
+        """
+        :param x: (int or np.ndarray) screen x coordinate(s)
+        :return: (int or np.ndarray) the column(s) they are in (possibly outside the grid)
+        """
+        return (x - self.origin_x) // TILE_SIZE
+
+    def _region(self, rows, columns, kinds):
+        # whether any cell in the (clipped) range of rows and columns has any of kinds
+        rows = slice(max(rows[0], 0), max(rows[1], 0))
+        columns = slice(max(columns[0], 0), max(columns[1], 0))
+        return bool((self.cells[rows, columns] & kinds).any())
+
+    def grounded(self, mario):
+        """
+        Is Mario standing on something?
+
+        :param mario: (((int, int), (int, int))) Mario's location and dimensions
+        :return: (bool) whether there's a solid cell right under his feet
+        """
+        (x, y), (width, height) = mario
+        feet = y + height + GROUND_TOLERANCE
+        if feet % TILE_SIZE > 2 * GROUND_TOLERANCE:
+            return False  # his feet aren't at the top of a row, so he's in the air (or beside something)
+        row = feet // TILE_SIZE
+        # (not counting the edges of his sprite, which overlap the side of a pipe he's falling past)
+        columns = (self.column(x + GROUND_TOLERANCE), self.column(x + width - 1 - GROUND_TOLERANCE) + 1)
+        return self._region((row, row + 1), columns, SOLID)
+
+    def pit_ahead(self, mario, columns=PIT_LOOKAHEAD, depth=PIT_DEPTH):
+        """
+        Does the ground end in front of Mario?
+
+        :param mario: (((int, int), (int, int))) Mario's location and dimensions
+        :param columns: (int) how many columns to look at, starting with the first one that
+            starts in front of his back
+        :param depth: (int) how many rows below his feet to look for ground, e.g. 1 for the
+            end of the platform he's on, or GRID_ROWS for only gaps all the way down
+        :return: (bool) whether any of those columns has nothing solid from PIT_WALL rows above
+            his feet (a wall in front of him isn't a pit) down to depth rows below them
+        """
+        (x, y), (width, height) = mario
+        row = (y + height + GROUND_TOLERANCE) // TILE_SIZE
+        first = -((self.origin_x - x) // TILE_SIZE)
+        floor = self.cells[max(row - PIT_WALL, 0):max(row + depth, 0), max(first, 0):max(first + columns, 0)]
+        if floor.shape[1] == 0:
+            return False  # the columns are off the screen
+        return bool(floor.shape[0] == 0 or not (floor & SOLID).any(axis=0).all())
+
+    def enemy_within(self, mario, columns=ENEMY_RANGE, behind=False, kinds=ENEMY | HAZARD, below=False):
+        """
+        Is there an enemy close to Mario, at about his height (or below him)?
+
+        :param mario: (((int, int), (int, int))) Mario's location and dimensions
+        :param columns: (int) how many columns in front of (or behind) the one his back is in
+        :param behind: (bool) look behind him (to the left) instead of in front of him
+        :param kinds: (int) what counts as an enemy, e.g. HAZARD for only the ones that can't
+            be jumped on
+        :param below: (bool) also look all the way down to the bottom of the screen, e.g. where
+            he would land if he walked off a ledge
+        :return: (bool) whether any of those cells, within ENEMY_ROWS rows of him, has an enemy
+        """
+        (x, y), (width, height) = mario
+        rows = (y // TILE_SIZE - ENEMY_ROWS, GRID_ROWS if below else (y + height - 1) // TILE_SIZE + ENEMY_ROWS + 1)
+        back = self.column(x)
+        if behind:
+            return self._region(rows, (back - columns, back), kinds)
+        return self._region(rows, (back, back + columns + 1), kinds)
+
+    def jump_hits(self, mario, kinds=HAZARD, arc=JUMP_ARC):
+        """
+        Would Mario run into something if he jumped right now?
+
+        This assumes he follows the whole arc, so it's only meant for things he
+        can't land on, like hazards.
+
+        :param mario: (((int, int), (int, int))) Mario's location and dimensions
+        :param kinds: (int) what to look for
+        :param arc: (np.ndarray) his (x, y upwards) offsets during the jump, e.g. JUMP_ARC
+        :return: (bool) whether any cell he would pass through has any of kinds
+        """
+        (x, y), (width, height) = mario
+        # the corners and middle of his sprite at every point of the arc, since he's never more
+        # than a tile wide (so a corner is in every column he covers) or two tiles tall
+        xs = (x + arc[:, 0, None] + np.array([0, width - 1]))[:, :, None]
+        ys = (y - arc[:, 1, None] + np.array([0, height // 2, height - 1]))[:, None, :]
+        columns, rows = np.broadcast_arrays(self.column(xs), ys // TILE_SIZE)
+        inside = (rows >= 0) & (rows < GRID_ROWS) & (columns >= 0) & (columns < GRID_COLUMNS)
+        return bool((self.cells[rows[inside], columns[inside]] & kinds).any())
+
+    def __str__(self):
+        # one character per cell: # solid, e enemy, ! hazard, . empty (enemies and hazards win)
+        symbols = np.full(self.cells.shape, ".")
+        symbols[(self.cells & SOLID) > 0] = "#"
+        symbols[(self.cells & ENEMY) > 0] = "e"
+        symbols[(self.cells & HAZARD) > 0] = "!"
+        return "\n".join("".join(row) for row in symbols)
@@ -0,0 +1,365 @@
+import time
+import zlib
+import multiprocessing as mp
+import numpy as np
+import gym_super_mario_bros
+from nes_py.wrappers import JoypadSpace
+from gym_super_mario_bros.actions import COMPLEX_MOVEMENT
+from marioWrappers import get_nes_env, restore_start_state
+from marioRam import locate_objects_ram
+
+# A lookahead planner for the rule-based agent (ruleBasedMario.py --plan).
+# At a decision point the emulator's state is backed up, a few candidate moves
+# (run, jump, wait, back off, ...) are each played from it, followed by what the
+# rules would do after them until PLAN_HORIZON frames, and the one that gets Mario
+# furthest without dying is taken instead of the rules' choice. The candidates are simulated in the environment itself in
+# between its steps, or spread over worker processes that each have their own
+# copy of the environment, kept in the same state by pressing the same buttons.
+# Every decision stops simulating after PLAN_BUDGET seconds, even in the middle
+# of a candidate.
+
+################################################################################
+# CONSTANTS
+
+PLAN_HORIZON = 40  # Frames simulated for every candidate (its moves, then the rollout policy's)
+# Seconds per decision. Every candidate is about PLAN_HORIZON emulator frames (1.5 ms each on a
+# laptop), so this is enough for about 4 of CANDIDATES on one core (all of them with workers), and
+# keeps a whole episode faster than the game's 60 steps a second. A single decision still holds the
+# game up for this long, as nothing can be simulated in one frame (1/60 s); 0.5 tries every candidate
+# but falls behind real time
+PLAN_BUDGET = 0.25
+PLAN_INTERVAL = 16  # Also plan every this many steps when the rules just want to run right
+PLAN_MARGIN = 8  # Pixels further a candidate has to get than the rules' choice to be taken instead
+DEATH_PENALTY = 1000  # Subtracted from the score of a candidate that dies (less the frames it survived)
+FLAG_BONUS = 1000  # Added to the score of a candidate that reaches a flag
+
+# The candidates, as (COMPLEX_MOVEMENT action, frames) moves. The jumps hold
+# jump for as long as the rules' jumps do (see run_episode's jumpCount)
+CANDIDATES = {
+    "run": [(3, 8)],
+    "jump": [(4, 25), (3, 10)],
+    "small jump": [(4, 5), (3, 10)],
+    "wait": [(0, 8)],
+    "back off": [(6, 8)],
+    "jump back": [(9, 25), (8, 10)],
+}
+PROPOSALS = {3: "run", 4: "jump", 0: "wait", 9: "jump back"}  # The candidate of each action make_action returns
+
+# The NES buttons (controller byte) of every COMPLEX_MOVEMENT action, the same as JoypadSpace's
+ACTION_BUTTONS = np.array(
+    [sum(JoypadSpace._button_map[button] for button in buttons) for buttons in COMPLEX_MOVEMENT], np.uint8
+)
+
+
+################################################################################
+# SIMULATING
+
+
+def candidate_actions(moves):
+    """
+    :param moves: ([(int, int)]) (action, frames) moves, e.g. CANDIDATES["jump"]
+    :return: ([int]) the action of every frame
+    """
+    return [action for action, frames in moves for _ in range(frames)]
+
+
+def candidate_buttons(moves):
+    """
+    :param moves: ([(int, int)]) (action, frames) moves
+    :return: ([int]) the NES buttons of every frame
+    """
+    return ACTION_BUTTONS[candidate_actions(moves)].tolist()
+
+
+def _policy_buttons(action):
+    # the buttons a rollout policy's action is played as: its jumps are held like run_episode holds them
+    if action in PROPOSALS and PROPOSALS[action].startswith("jump"):
+        return candidate_buttons(CANDIDATES[PROPOSALS[action]])
+    return [int(ACTION_BUTTONS[action])]
+
+
+def run_right(nes_env, info):
+    """
+    A rollout policy that always runs right.
+
+    :param nes_env: (SuperMarioBrosEnv) the simulated environment
+    :param info: (dict) the info of its last step
+    :return: (int) the COMPLEX_MOVEMENT action to take
+    """
+    return 3
+
+
+def rule_policy(nes_env, info, decisions=None):
+    """
+    A rollout policy that does what the rule-based agent would, with the objects
+    read from memory (whatever its PERCEPTION is, since that is much faster).
+
+    :param nes_env: (SuperMarioBrosEnv) the simulated environment
+    :param info: (dict) the info of its last step
+    :param decisions: (str) ruleBasedMario's DECISIONS, or None for this process's
+    :return: (int) the COMPLEX_MOVEMENT action to take
+    """
+    from ruleBasedMario import choose_action  # (imported here, since ruleBasedMario imports this file)
+
+    object_locations = locate_objects_ram(nes_env.ram, info["status"])
+    if not object_locations["mario"]:
+        return 3
+    location, dimensions, name = object_locations["mario"][0]
+    return choose_action(object_locations, (location, dimensions), info["status"], decisions)
+
+
+def simulate(nes_env, buttons, horizon=PLAN_HORIZON, policy=rule_policy, deadline=None):
+    """
+    Press buttons from the current state of the emulator, then follow the policy,
+    and score how it went.
+
+    This steps the emulator; _score_candidates puts it back afterwards.
+
+    :param nes_env: (SuperMarioBrosEnv) the environment from get_nes_env
+    :param buttons: ([int]) the NES buttons of the first frames (at least one)
+    :param horizon: (int) frames to simulate in total
+    :param policy: (callable) (nes_env, info) -> COMPLEX_MOVEMENT action for the rest of the
+        frames, e.g. rule_policy or run_right
+    :param deadline: (float) time.perf_counter() to give up at, or None
+    :return: (float) how far Mario got (in pixels), less DEATH_PENALTY if he died, plus
+        FLAG_BONUS if he reached a flag, or None if the deadline passed first
+    """
+    start_x, life, stage = nes_env._x_position, nes_env._life, (nes_env._world, nes_env._stage)
+    x = start_x
+    buttons = list(buttons)
+    for frame in range(max(horizon, len(buttons))):
+        if deadline is not None and time.perf_counter() > deadline:
+            return None  # (a shorter simulation can't be compared with the others)
+        if not buttons:
+            buttons = _policy_buttons(policy(nes_env, info))
+        _, _, done, info = nes_env.step(buttons.pop(0))
+        if info["flag_get"] or (info["world"], info["stage"]) != stage:
+            return x - start_x + FLAG_BONUS
+        if done or nes_env._is_dying or nes_env._is_dead or info["life"] < life:
+            # (x from before he died, since it jumps back to the checkpoint)
+            return x - start_x - DEATH_PENALTY + frame
+        x = info["x_pos"]
+    return x - start_x
+
+
+def _score_candidates(nes_env, candidates, deadline, horizon, policy):
+    # Simulate each (index, buttons) candidate from the current state in order, scoring the
+    # ones that finish before the deadline, and put the emulator back in that state. The state is
+    # kept in the emulator's only backup, so reset() won't go back to the start of the stage after this
+    python_state = (nes_env.done, nes_env._time_last, nes_env._x_position_last)
+    nes_env._backup()
+    scores = {}
+    for index, buttons in candidates:
+        if time.perf_counter() > deadline:
+            break
+        nes_env.done = False
+        score = simulate(nes_env, buttons, horizon, policy, deadline)
+        nes_env._restore()
+        if score is not None:
+            scores[index] = score
+    nes_env.done, nes_env._time_last, nes_env._x_position_last = python_state
+    return scores
+
+
+def _ram_checksum(nes_env):
+    return zlib.crc32(nes_env.ram.tobytes())
+
+
+################################################################################
+# WORKER
+
+
+def _planner_worker(remote, parent_remote, env_id, horizon, policy):
+    """
+    Keep a copy of the environment in a worker process, and simulate candidates in it.
+
+    "step" presses the same buttons as the environment did (and says when it has, so
+    the planner can keep it at most a step behind), and "plan" scores candidates
+    from there until a deadline.
+    """
+    parent_remote.close()
+    nes_env = get_nes_env(gym_super_mario_bros.make(env_id))
+    nes_env.reset()
+    while True:
+        try:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                if not nes_env.done:
+                    nes_env.step(data)
+                remote.send(None)
+            elif cmd == "plan":
+                # (perf_counter is the same clock in every process, so the deadline is the planner's)
+                candidates, deadline = data
+                scores = _score_candidates(nes_env, candidates, deadline, horizon, policy)
+                remote.send((scores, _ram_checksum(nes_env)))
+            elif cmd == "reset":
+                # (its backup has been the current state, not the start of the stage)
+                restore_start_state(nes_env)
+                nes_env.reset()
+                remote.send(None)
+            elif cmd == "close":
+                nes_env.close()
+                remote.close()
+                break
+            else:
+                raise NotImplementedError("`{}` is not implemented in the planner worker".format(cmd))
+        except EOFError:
+            break
+
+
+################################################################################
+# PLANNER
+
+
+class Planner:
+    """
+    Chooses between CANDIDATES by simulating them, for run_episode.
+
+    run_episode calls reset before every episode, record after every step (so the
+    workers' environments press the same buttons), and plan at decision points.
+    Without workers the candidates are simulated in the environment itself, which
+    uses its backup, so the start of the stage is rebuilt by the next reset. The
+    workers step in the background while the environment takes its next step, but
+    never get more than one step behind, so they're ready when it's time to plan.
+
+    :param workers: (int) worker processes to simulate the candidates in, or 0 to
+        simulate them one after another in the environment itself
+    :param env_id: (str) the environment's id, for the workers' copies (the same stage
+        and ROM version), e.g. "SuperMarioBros-v0"
+    :param budget: (float) seconds per decision
+    :param horizon: (int) frames simulated for every candidate
+    :param policy: (callable) what to do after a candidate's moves, e.g. rule_policy or run_right
+        (a function of a module, so the workers can be sent it)
+    :param start_method: (str) multiprocessing start method, defaults to forkserver (or spawn)
+    """
+
+    def __init__(
+        self, workers=0, env_id=None, budget=PLAN_BUDGET, horizon=PLAN_HORIZON, policy=rule_policy, start_method=None
+    ):
+        if workers > 0 and env_id is None:
+            raise ValueError("the workers need the env_id of the environment")
+        self.budget = budget
+        self.horizon = horizon
+        self.policy = policy
+        self.names = list(CANDIDATES)
+        self.buttons = [candidate_buttons(CANDIDATES[name]) for name in self.names]
+        self.backup_moved = False  # whether the environment's backup isn't the start of the stage
+        self.stepping = False  # whether the workers are still taking the last recorded step
+        # counts for the whole run
+        self.decisions = 0
+        self.simulated = 0  # candidates simulated
+        self.overruled = 0  # decisions where a candidate other than the rules' choice was taken
+        self.seconds = 0.0
+        self.longest = 0.0  # seconds of the longest decision
+
+        self.remotes, self.processes = [], []
+        if workers > 0:
+            if start_method is None:
+                start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+            ctx = mp.get_context(start_method)
+            for _ in range(workers):
+                remote, work_remote = ctx.Pipe()
+                process = ctx.Process(
+                    target=_planner_worker, args=(work_remote, remote, env_id, horizon, policy), daemon=True
+                )
+                process.start()
+                work_remote.close()
+                self.remotes.append(remote)
+                self.processes.append(process)
+
+    def reset(self, env):
+        """
+        Get ready for a new episode, before env.reset().
+
+        :param env: (gym.Env) the environment
+        """
+        if self.backup_moved:
+            restore_start_state(get_nes_env(env))
+            self.backup_moved = False
+        self._catch_up()
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for remote in self.remotes:
+            remote.recv()
+
+    def record(self, action):
+        """
+        :param action: (int) the COMPLEX_MOVEMENT action the environment just took
+        """
+        self._catch_up()
+        for remote in self.remotes:
+            remote.send(("step", ACTION_BUTTONS[action]))
+        self.stepping = bool(self.remotes)
+
+    def _catch_up(self):
+        # wait for the workers to finish the last recorded step
+        if self.stepping:
+            for remote in self.remotes:
+                remote.recv()
+            self.stepping = False
+
+    def plan(self, env, proposal):
+        """
+        Simulate the candidates from the environment's current state and choose one.
+
+        :param env: (gym.Env) the environment, where the last recorded step left it
+        :param proposal: (int) the action the rules chose, whose candidate is simulated first
+            and kept unless another one gets at least PLAN_MARGIN pixels further (or it didn't
+            finish in the budget)
+        :return: ([int]) the actions of the chosen candidate's moves, to take one per step
+        """
+        if proposal not in PROPOSALS:
+            return [proposal]
+        start = time.perf_counter()
+        deadline = start + self.budget
+        first = self.names.index(PROPOSALS[proposal])
+        order = [first] + [index for index in range(len(self.names)) if index != first]
+        candidates = [(index, self.buttons[index]) for index in order]
+        nes_env = get_nes_env(env)
+        if self.remotes:
+            self._catch_up()
+            # every worker gets some of the candidates, in order, so the first one is simulated first
+            for rank, remote in enumerate(self.remotes):
+                remote.send(("plan", (candidates[rank::len(self.remotes)], deadline)))
+            scores = {}
+            for remote in self.remotes:
+                worker_scores, checksum = remote.recv()
+                if checksum != _ram_checksum(nes_env):
+                    raise RuntimeError("a planner worker's environment is out of sync (was every step recorded?)")
+                scores.update(worker_scores)
+        else:
+            scores = _score_candidates(nes_env, candidates, deadline, self.horizon, self.policy)
+            self.backup_moved = True
+        best = first  # (if it didn't finish, there's nothing to compare the others with)
+        if first in scores:
+            best = max([index for index in order if index in scores], key=scores.get)  # (ties go to the earlier)
+            if scores[best] < scores[first] + PLAN_MARGIN:
+                best = first
+        self.decisions += 1
+        self.simulated += len(scores)
+        self.overruled += best != first
+        self.seconds += time.perf_counter() - start
+        self.longest = max(self.longest, time.perf_counter() - start)
+        return candidate_actions(CANDIDATES[self.names[best]])
+
+    def summary(self):
+        """
+        :return: (str) how many decisions were made, and how long they took
+        """
+        if self.decisions == 0:
+            return "planner: no decisions"
+        return "planner: {} decisions, {:.1f} candidates and {:.0f} ms each (at most {:.0f} ms), {} overruled the rules".format(
+            self.decisions,
+            self.simulated / self.decisions,
+            1000 * self.seconds / self.decisions,
+            1000 * self.longest,
+            self.overruled,
+        )
+
+    def close(self):
+        self._catch_up()
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.remotes, self.processes = [], []
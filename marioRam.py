@@ -0,0 +1,163 @@
+import numpy as np
+
+# Locate objects by reading the NES's memory instead of looking at the screen.
+# locate_objects_ram returns the same structure as ruleBasedMario.locate_objects,
+# so the rule-based agent can use either ("poetry run python ruleBasedMario.py
+# --perception ram"). The addresses come from the Super Mario Bros. disassembly.
+
+################################################################################
+# CONSTANTS
+
+SCREEN_HEIGHT = 240
+SCREEN_WIDTH = 256
+TILE_SIZE = 16  # The level is made of 16x16 tiles
+TILE_ROWS = 13  # Rows of tiles kept in memory, starting TILES_TOP pixels from the top of the screen
+TILES_TOP = 32
+
+# Addresses of Mario's state
+PLAYER_SCREEN_X = 0x03AD  # x relative to the left edge of the screen
+PLAYER_SCREEN_Y = 0x03B8  # y of the top of a 32 pixel tall box around Mario
+PLAYER_Y_PAGE = 0x00B5  # 1 when Mario is on the screen vertically (0 above it, 2+ fallen in a pit)
+
+# Addresses of the object slots (5 enemies, then the power-up)
+OBJECT_SLOTS = 6
+OBJECT_ACTIVE = 0x000F
+OBJECT_TYPE = 0x0016
+OBJECT_X_PAGE = 0x006E
+OBJECT_X = 0x0087
+OBJECT_Y_PAGE = 0x00B6
+OBJECT_Y = 0x00CF
+
+# Address of the left edge of the screen in the level (page * 256 + x)
+SCREEN_LEFT_PAGE = 0x071A
+SCREEN_LEFT_X = 0x071C
+
+# The tiles of the two screens around the camera, each 13 rows of 16 tiles
+TILE_BUFFER = 0x0500
+TILE_BUFFER_PAGE = TILE_ROWS * 16
+
+# Sprites are drawn one line lower than their y, and objects' y is 8 pixels above
+# where a 16 pixel tall enemy's sprite starts, so standing enemies end at y + 25
+SPRITE_Y_OFFSET = 1
+OBJECT_BOTTOM = 25
+
+# object type -> (category, name, (width, height)), the names match the templates where there is one
+OBJECT_TYPES = {
+    0x00: ("enemy", "koopa", (16, 24)),  # green
+    0x01: ("enemy", "koopa", (16, 24)),  # red, in the demo
+    0x02: ("enemy", "buzzy beetle", (16, 16)),
+    0x03: ("enemy", "koopa", (16, 24)),  # red
+    0x04: ("enemy", "koopa", (16, 24)),  # green, bouncing in place
+    0x05: ("enemy", "hammer bro", (16, 24)),
+    0x06: ("enemy", "goomba", (16, 16)),
+    0x07: ("enemy", "blooper", (16, 24)),
+    0x08: ("enemy", "bullet bill", (16, 16)),
+    0x0A: ("enemy", "cheep cheep", (16, 16)),
+    0x0B: ("enemy", "cheep cheep", (16, 16)),
+    0x0C: ("hard_enemy", "podoboo", (16, 16)),
+    0x0D: ("hard_enemy", "piranha plant", (16, 24)),
+    0x0E: ("enemy", "paratroopa", (16, 24)),
+    0x0F: ("enemy", "paratroopa", (16, 24)),
+    0x10: ("enemy", "paratroopa", (16, 24)),
+    0x11: ("enemy", "lakitu", (16, 24)),
+    0x12: ("hard_enemy", "spiny", (16, 16)),
+    0x14: ("enemy", "cheep cheep", (16, 16)),
+    0x15: ("hard_enemy", "bowser flame", (24, 8)),
+    0x2D: ("hard_enemy", "bowser", (32, 32)),
+    0x2E: ("item", "mushroom", (16, 16)),  # any power-up
+    0x2F: ("item", "vine", (16, 16)),
+    0x32: ("item", "spring", (16, 32)),
+    0x33: ("enemy", "bullet bill", (16, 16)),
+}
+
+# Tiles that Mario can move through: empty, the flagpole, vines, coins and hidden blocks
+PASSABLE_TILES = {0x00, 0x24, 0x25, 0x26, 0x5F, 0x60, 0xC2, 0xC3}
+QUESTION_TILES = {0xC0, 0xC1}
+PIPE_TOP_TILES = {0x10, 0x12}  # the left half of the top of a pipe (0x10 is one that can be entered)
+PIPE_TILES = set(range(0x10, 0x16))
+
+
+################################################################################
+# READING THE SCREEN FROM MEMORY
+
+
+def camera_x(ram):
+    """
+    Get the level x coordinate of the left edge of the screen.
+
+    :param ram: (np.ndarray) the NES's 2KB of memory, e.g. get_nes_env(env).ram
+    :return: (int) the x coordinate in pixels
+    """
+    return int(ram[SCREEN_LEFT_PAGE]) * 256 + int(ram[SCREEN_LEFT_X])
+
+
+def visible_tiles(ram):
+    """
+    Get the tiles on the screen from the tile buffer.
+
+    :param ram: (np.ndarray) the NES's memory
+    :return: ((np.ndarray, int)) the TILE_ROWS x 17 tiles covering the screen (the screen is
+        usually between tiles, so one more column than fits), and the screen x of the first column
+    """
+    camera = camera_x(ram)
+    columns = camera // TILE_SIZE + np.arange(SCREEN_WIDTH // TILE_SIZE + 1)
+    # the buffer holds two screens side by side, and wraps around
+    pages = (columns // 16) % 2
+    buffer = np.asarray(ram[TILE_BUFFER:TILE_BUFFER + 2 * TILE_BUFFER_PAGE]).reshape(2, TILE_ROWS, 16)
+    tiles = buffer[pages, :, columns % 16].T
+    return tiles, int(columns[0]) * TILE_SIZE - camera
+
+
+def _locate_blocks(ram):
+    tiles, left = visible_tiles(ram)
+    blocks = []
+    solid = ~np.isin(tiles, list(PASSABLE_TILES | PIPE_TILES))
+    for row, column in zip(*np.nonzero(solid)):
+        name = "question_block" if tiles[row, column] in QUESTION_TILES else "block"
+        blocks.append(((left + column * TILE_SIZE, TILES_TOP + row * TILE_SIZE), (TILE_SIZE, TILE_SIZE), name))
+
+    # each pipe is one object, from its top down to the last pipe tile below it
+    in_pipe = np.isin(tiles, list(PIPE_TILES))
+    for row, column in zip(*np.nonzero(np.isin(tiles, list(PIPE_TOP_TILES)))):
+        rows = np.argmin(np.append(in_pipe[row:, column], False))
+        blocks.append(
+            ((left + column * TILE_SIZE, TILES_TOP + row * TILE_SIZE), (2 * TILE_SIZE, rows * TILE_SIZE), "pipe")
+        )
+    return blocks
+
+
+def locate_objects_ram(ram, mario_status):
+    """
+    Locate Mario, enemies, blocks and items from the NES's memory.
+
+    The result is in the same format as ruleBasedMario.locate_objects, using the
+    screen coordinates of the top left corner of each object's sprite. Memory is
+    one frame ahead of the screen returned with it, so objects can be a few
+    pixels further along than on that screen.
+
+    :param ram: (np.ndarray) the NES's memory, e.g. get_nes_env(env).ram
+    :param mario_status: (str) "small", "tall" or "fireball", from info["status"]
+    :return: (dict) category -> [((x, y), (width, height), name)]
+    """
+    object_locations = {"mario": [], "enemy": [], "hard_enemy": [], "block": [], "item": []}
+
+    if ram[PLAYER_Y_PAGE] == 1:
+        # the templates are "small" and "tall" (which includes fireball Mario)
+        name = "small" if mario_status == "small" else "tall"
+        height = 16 if name == "small" else 32
+        y = int(ram[PLAYER_SCREEN_Y]) + 32 - height + SPRITE_Y_OFFSET
+        object_locations["mario"].append(((int(ram[PLAYER_SCREEN_X]), y), (16, height), name))
+
+    camera = camera_x(ram)
+    for slot in range(OBJECT_SLOTS):
+        object_type = OBJECT_TYPES.get(int(ram[OBJECT_TYPE + slot]))
+        if not ram[OBJECT_ACTIVE + slot] or ram[OBJECT_Y_PAGE + slot] != 1 or object_type is None:
+            continue
+        category, name, (width, height) = object_type
+        x = int(ram[OBJECT_X_PAGE + slot]) * 256 + int(ram[OBJECT_X + slot]) - camera
+        y = int(ram[OBJECT_Y + slot]) + OBJECT_BOTTOM - height
+        if -width < x < SCREEN_WIDTH:
+            object_locations[category].append(((x, y), (width, height), name))
+
+    object_locations["block"] = _locate_blocks(ram)
+    return object_locations
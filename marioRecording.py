@@ -0,0 +1,378 @@
+import io
+import os
+import json
+import struct
+import argparse
+import gym
+import cv2 as cv
+import numpy as np
+import gym_super_mario_bros
+
+# Record episodes to a compact file, and replay them.
+# Only the buttons pressed (and the rewards and info) are stored by default, since
+# the emulator is deterministic: any frame can be made again by pressing the same
+# buttons from the start of the episode.
+# e.g. "poetry run python ruleBasedMario.py --headless --record ./recordings"
+#      "poetry run python marioRecording.py info ./recordings/rule_based.mario"
+#      "poetry run python marioRecording.py replay ./recordings/rule_based.mario --episode 0 --video episode_0.mp4"
+
+################################################################################
+# CONSTANTS
+
+MAGIC = b"MARIOREC"  # The start of every recording file
+CHUNK_MAGIC = b"CHNK"  # The start of every chunk
+VERSION = 1
+CHUNK_STEPS = 4096  # Steps buffered in memory before they're written as a chunk
+
+# The info dict's keys (all whole numbers or booleans, except status)
+INFO_KEYS = ["coins", "flag_get", "life", "score", "stage", "time", "world", "x_pos", "y_pos"]
+STATUSES = ["small", "tall", "fireball"]
+
+
+################################################################################
+# WRITING
+
+
+class TrajectoryWriter:
+    """
+    Append steps to a recording file, in compressed chunks.
+
+    The file is a header followed by chunks, each holding up to CHUNK_STEPS
+    steps as a compressed .npz. Chunks are only ever appended, so a recording
+    can be added to by later runs, and a crash loses at most the last chunk.
+
+    :param path: (str) the recording file, added to if it already exists
+    :param env_id: (str) the environment being recorded, needed to replay it
+    :param frames: (bool) also store every frame_every-th frame (as a PNG)
+    :param frame_every: (int) how often to store a frame when frames is True
+    :param chunk_steps: (int) steps per chunk
+    """
+
+    def __init__(self, path, env_id, frames=False, frame_every=1, chunk_steps=CHUNK_STEPS):
+        self.path = path
+        self.frames = frames
+        self.frame_every = frame_every
+        self.chunk_steps = chunk_steps
+        self.episode = -1
+        self.step = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            reader = TrajectoryReader(path)
+            if reader.metadata["env_id"] != env_id:
+                raise ValueError("{} is a recording of {}, not {}".format(path, reader.metadata["env_id"], env_id))
+            self.episode = max((chunk["episode"].max() for chunk in reader.chunks() if len(chunk["episode"])), default=-1)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            header = json.dumps(dict(env_id=env_id, frames=frames, frame_every=frame_every)).encode()
+            with open(path, "wb") as f:
+                f.write(MAGIC + struct.pack("<II", VERSION, len(header)) + header)
+        self._clear()
+
+    def _clear(self):
+        self.buffer = {key: [] for key in ["episode", "step", "action", "reward", "done", "status"] + INFO_KEYS}
+        self.frame_steps, self.frame_data = [], []
+        self.starts, self.prefixes = [], []
+
+    def start_episode(self, prefix=b""):
+        """
+        Start a new episode.
+
+        :param prefix: (bytes) buttons pressed from the start of the stage before the
+            episode started (e.g. from a snapshot), which are replayed first
+        """
+        self.episode += 1
+        self.step = 0
+        self.starts.append(self.episode)
+        self.prefixes.append(bytes(prefix))
+
+    def append(self, action, reward, done, info, frame=None):
+        """
+        Record one step.
+
+        :param action: (int) the NES buttons pressed (0-255)
+        :param reward: (float) the step's reward
+        :param done: (bool) whether the episode ended
+        :param info: (dict) the step's info
+        :param frame: (np.ndarray) the step's frame, only stored when recording frames
+        """
+        buffer = self.buffer
+        buffer["episode"].append(self.episode)
+        buffer["step"].append(self.step)
+        buffer["action"].append(action)
+        buffer["reward"].append(reward)
+        buffer["done"].append(done)
+        buffer["status"].append(STATUSES.index(info["status"]) if info["status"] in STATUSES else 255)
+        for key in INFO_KEYS:
+            buffer[key].append(info[key])
+        if self.frames and frame is not None and self.step % self.frame_every == 0:
+            # PNG keeps the frames exact, and the NES's few flat colours compress well
+            self.frame_steps.append(len(buffer["step"]) - 1)
+            self.frame_data.append(cv.imencode(".png", cv.cvtColor(frame, cv.COLOR_RGB2BGR))[1].tobytes())
+        self.step += 1
+        if len(buffer["step"]) >= self.chunk_steps:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered steps as a chunk."""
+        if not self.buffer["step"] and not self.starts:
+            return
+        buffer = self.buffer
+        arrays = dict(
+            episode=np.array(buffer["episode"], dtype=np.int32),
+            step=np.array(buffer["step"], dtype=np.int32),
+            action=np.array(buffer["action"], dtype=np.uint8),
+            reward=np.array(buffer["reward"], dtype=np.float32),
+            done=np.array(buffer["done"], dtype=bool),
+            status=np.array(buffer["status"], dtype=np.uint8),
+            starts=np.array(self.starts, dtype=np.int32),
+            prefix_data=np.frombuffer(b"".join(self.prefixes), dtype=np.uint8),
+            prefix_offsets=np.cumsum([0] + [len(p) for p in self.prefixes]),
+            frame_steps=np.array(self.frame_steps, dtype=np.int32),
+            frame_data=np.frombuffer(b"".join(self.frame_data), dtype=np.uint8),
+            frame_offsets=np.cumsum([0] + [len(f) for f in self.frame_data]),
+        )
+        for key in INFO_KEYS:
+            arrays["info_" + key] = np.array(buffer[key], dtype=np.int32)
+        payload = io.BytesIO()
+        np.savez_compressed(payload, **arrays)
+        with open(self.path, "ab") as f:
+            f.write(CHUNK_MAGIC + struct.pack("<Q", payload.tell()) + payload.getvalue())
+        self._clear()
+
+    def close(self):
+        self.flush()
+
+
+class RecordingWrapper(gym.Wrapper):
+    """
+    Record every step of a Mario environment with a TrajectoryWriter.
+
+    It goes directly on top of the environment from gym_super_mario_bros.make
+    (or a SnapshotResetWrapper), so the actions recorded are NES buttons, which
+    replay the same whatever action set the agent used.
+
+    :param env: (gym.Env) the environment to record
+    :param env_id: (str) its id, e.g. "SuperMarioBros-1-1-v3"
+    :param path: (str) the recording file, added to if it already exists
+    :param frames: (bool) also store the frames
+    :param frame_every: (int) only store every this many frames
+    """
+
+    def __init__(self, env, env_id, path, frames=False, frame_every=1):
+        super(RecordingWrapper, self).__init__(env)
+        self.writer = TrajectoryWriter(path, env_id, frames, frame_every)
+
+    def reset(self, **kwargs):
+        obs, info = self.env.reset(**kwargs)
+        # a SnapshotResetWrapper starts episodes after the buttons in its backup
+        self.writer.start_episode(getattr(self.env, "backup_buttons", b""))
+        return obs, info
+
+    def step(self, action):
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        self.writer.append(action, reward, terminated or truncated, info, obs)
+        return obs, reward, terminated, truncated, info
+
+    def close(self):
+        self.writer.close()
+        return self.env.close()
+
+
+################################################################################
+# READING AND REPLAYING
+
+
+class TrajectoryReader:
+    """
+    Read a recording file.
+
+    :param path: (str) the recording file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(path + " isn't a Mario recording")
+            version, header_length = struct.unpack("<II", f.read(8))
+            self.metadata = json.loads(f.read(header_length))
+            self.data_start = f.tell()
+
+    def chunks(self):
+        """
+        Read the chunks one at a time.
+
+        :return: (generator) a dict of arrays per chunk (an incomplete last chunk is skipped)
+        """
+        with open(self.path, "rb") as f:
+            f.seek(self.data_start)
+            while True:
+                header = f.read(len(CHUNK_MAGIC) + 8)
+                if len(header) < len(CHUNK_MAGIC) + 8 or header[:len(CHUNK_MAGIC)] != CHUNK_MAGIC:
+                    return
+                payload = f.read(struct.unpack("<Q", header[len(CHUNK_MAGIC):])[0])
+                try:
+                    with np.load(io.BytesIO(payload)) as data:
+                        yield {key: data[key] for key in data.files}
+                except (ValueError, OSError, EOFError):
+                    return  # cut off while it was being written
+
+    def episodes(self):
+        """
+        Summarise every episode.
+
+        :return: ([dict]) episode, prefix (buttons replayed before it), steps, reward,
+            x_pos (the furthest), flag and frames (how many were stored)
+        """
+        episodes = {}
+        for chunk in self.chunks():
+            for i, episode in enumerate(chunk["starts"].tolist()):
+                prefix = chunk["prefix_data"][chunk["prefix_offsets"][i]:chunk["prefix_offsets"][i + 1]].tobytes()
+                episodes[episode] = dict(episode=episode, prefix=prefix, steps=0, reward=0.0, x_pos=0, flag=False, frames=0)
+            for episode in np.unique(chunk["episode"]).tolist():
+                selected = chunk["episode"] == episode
+                summary = episodes[episode]
+                summary["steps"] += int(selected.sum())
+                summary["reward"] += float(chunk["reward"][selected].sum())
+                summary["x_pos"] = max(summary["x_pos"], int(chunk["info_x_pos"][selected].max()))
+                summary["flag"] = summary["flag"] or bool(chunk["info_flag_get"][selected].any())
+                summary["frames"] += int(selected[chunk["frame_steps"]].sum())
+        return [episodes[episode] for episode in sorted(episodes)]
+
+    def steps(self, episode):
+        """
+        Get the recorded steps of one episode.
+
+        :param episode: (int) the episode number
+        :return: ((bytes, [dict], {int: np.ndarray})) the prefix buttons, each step's action,
+            reward, done and info, and the stored frames by step number
+        """
+        prefix, steps, frames = b"", [], {}
+        for chunk in self.chunks():
+            starts = chunk["starts"].tolist()
+            if episode in starts:
+                i = starts.index(episode)
+                prefix = chunk["prefix_data"][chunk["prefix_offsets"][i]:chunk["prefix_offsets"][i + 1]].tobytes()
+            stored = dict(zip(chunk["frame_steps"].tolist(), range(len(chunk["frame_steps"]))))
+            for i in np.flatnonzero(chunk["episode"] == episode).tolist():
+                info = {key: int(chunk["info_" + key][i]) for key in INFO_KEYS}
+                info["flag_get"] = bool(info["flag_get"])
+                status = int(chunk["status"][i])
+                info["status"] = STATUSES[status] if status < len(STATUSES) else None
+                steps.append(dict(action=int(chunk["action"][i]), reward=float(chunk["reward"][i]),
+                                  done=bool(chunk["done"][i]), info=info))
+                if i in stored:
+                    j = stored[i]
+                    data = chunk["frame_data"][chunk["frame_offsets"][j]:chunk["frame_offsets"][j + 1]]
+                    frames[int(chunk["step"][i])] = cv.cvtColor(cv.imdecode(data, cv.IMREAD_COLOR), cv.COLOR_BGR2RGB)
+        return prefix, steps, frames
+
+
+def replay(path, episode):
+    """
+    Make an episode's frames again by pressing the recorded buttons.
+
+    :param path: (str) the recording file
+    :param episode: (int) the episode number
+    :return: (generator) (step, frame, info, recorded info) for every step, where info is
+        what the emulator gave this time
+    """
+    from marioWrappers import get_nes_env  # (marioWrappers imports this file)
+
+    reader = TrajectoryReader(path)
+    prefix, steps, _ = reader.steps(episode)
+    env = gym_super_mario_bros.make(reader.metadata["env_id"], apply_api_compatibility=True, render_mode=None)
+    env.reset()
+    nes_env = get_nes_env(env)
+    for button in prefix:
+        nes_env.step(button)
+    try:
+        for i, recorded in enumerate(steps):
+            frame, reward, terminated, truncated, info = env.step(recorded["action"])
+            yield i, frame, info, recorded["info"]
+    finally:
+        env.close()
+
+
+def regenerate_frame(path, episode, step):
+    """
+    Get one frame of an episode, from the recording if it was stored or by replaying it.
+
+    :param path: (str) the recording file
+    :param episode: (int) the episode number
+    :param step: (int) the step within the episode
+    :return: (np.ndarray) the RGB frame
+    """
+    _, _, frames = TrajectoryReader(path).steps(episode)
+    if step in frames:
+        return frames[step]
+    for i, frame, info, recorded in replay(path, episode):
+        if i == step:
+            return frame.copy()
+    raise IndexError("episode {} only has {} steps".format(episode, i + 1))
+
+
+################################################################################
+# COMMAND LINE
+
+
+def run_info(args):
+    reader = TrajectoryReader(args.recording)
+    episodes = reader.episodes()
+    print("{} ({}), {} episodes, {} steps, {:.1f} MB".format(
+        args.recording, reader.metadata["env_id"], len(episodes), sum(e["steps"] for e in episodes),
+        os.path.getsize(args.recording) / 1e6))
+    print(f"{'episode':>7} {'steps':>7} {'reward':>8} {'x_pos':>6} {'flag':>5} {'frames':>6}")
+    for e in episodes:
+        print(f"{e['episode']:>7} {e['steps']:>7} {e['reward']:>8.1f} {e['x_pos']:>6} {str(e['flag']):>5} {e['frames']:>6}")
+
+
+def run_replay(args):
+    writer = None
+    mismatches = steps = 0
+    for i, frame, info, recorded in replay(args.recording, args.episode):
+        steps += 1
+        mismatches += any(info[key] != recorded[key] for key in recorded)
+        if args.video is not None:
+            if writer is None:
+                height, width = frame.shape[:2]
+                writer = cv.VideoWriter(args.video, cv.VideoWriter_fourcc(*"mp4v"), 60, (width, height))
+            writer.write(cv.cvtColor(frame, cv.COLOR_RGB2BGR))
+    if writer is not None:
+        writer.release()
+        print("Video written to " + args.video)
+    print("Replayed {} steps, {} differed from the recording".format(steps, mismatches))
+
+
+def run_frame(args):
+    frame = regenerate_frame(args.recording, args.episode, args.step)
+    cv.imwrite(args.output, cv.cvtColor(frame, cv.COLOR_RGB2BGR))
+    print("Frame written to " + args.output)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Inspect and replay Mario recordings.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    info = subparsers.add_parser("info", help="list the episodes in a recording")
+    info.add_argument("recording")
+    info.set_defaults(run=run_info)
+
+    replay_parser = subparsers.add_parser("replay", help="replay an episode, checking it matches the recording")
+    replay_parser.add_argument("recording")
+    replay_parser.add_argument("--episode", type=int, default=0)
+    replay_parser.add_argument("--video", default=None, help="also write the frames to this .mp4")
+    replay_parser.set_defaults(run=run_replay)
+
+    frame = subparsers.add_parser("frame", help="get one frame of an episode as an image")
+    frame.add_argument("recording")
+    frame.add_argument("--episode", type=int, default=0)
+    frame.add_argument("--step", type=int, required=True)
+    frame.add_argument("--output", default="frame.png")
+    frame.set_defaults(run=run_frame)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.run(args)
@@ -0,0 +1,211 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from gymnasium import spaces
+from stable_baselines3.common.vec_env import SubprocVecEnv, VecEnv
+from stable_baselines3.common.vec_env.base_vec_env import CloudpickleWrapper
+from stable_baselines3.common.vec_env.patch_gym import _patch_env
+
+# A vectorised environment where the worker processes write their frames straight
+# into shared memory, instead of pickling them and sending them back through a
+# pipe, and the frames are stacked where they are written instead of being
+# copied into a separate stack every step (what VecFrameStack does).
+# Used by make_vec_env(..., shared_memory=True) (--shared-memory in 1_TrainMario.py).
+# e.g. "poetry run python benchmarkMario.py envs --workers 1 4 8 --vec-envs dummy subproc shared"
+
+################################################################################
+# CONSTANTS
+
+RING_STACKS = 8  # Length of each environment's frame ring buffer, in frame stacks (at least 3)
+
+
+################################################################################
+# WORKER
+
+
+def _shared_worker(remote, parent_remote, env_fn_wrapper):
+    """
+    Run one environment in a worker process, like SubprocVecEnv's worker, but
+    writing its frames into the shared ring buffer.
+
+    The "attach" command gives it the shared memory to write to: its own row of
+    the ring buffer, and a slot for the first frame of each new episode.
+    """
+    from stable_baselines3.common.env_util import is_wrapped
+
+    parent_remote.close()
+    env = _patch_env(env_fn_wrapper.var())
+    memory, ring, reset_frame = None, None, None
+    while True:
+        try:
+            cmd, data = remote.recv()
+            if cmd == "step":
+                action, position = data
+                observation, reward, terminated, truncated, info = env.step(action)
+                done = terminated or truncated
+                info["TimeLimit.truncated"] = truncated and not terminated
+                ring[:, :, position] = observation  # (the main process makes it the terminal observation)
+                reset_info = {}
+                if done:
+                    observation, reset_info = env.reset()
+                    reset_frame[...] = observation
+                remote.send((reward, done, info, reset_info))
+            elif cmd == "reset":
+                observation, reset_info = env.reset(seed=data)
+                reset_frame[...] = observation
+                remote.send(reset_info)
+            elif cmd == "attach":
+                name, rank, ring_shape, offset = data
+                memory = shared_memory.SharedMemory(name=name)  # (removed by the main process)
+                ring = np.ndarray(ring_shape, np.uint8, memory.buf)[rank]
+                reset_frame = np.ndarray((ring_shape[0],) + ring_shape[1:3] + ring_shape[4:], np.uint8, memory.buf, offset)[rank]
+                remote.send(None)
+            elif cmd == "close":
+                env.close()
+                del ring, reset_frame
+                if memory is not None:
+                    memory.close()
+                remote.close()
+                break
+            elif cmd == "get_spaces":
+                remote.send((env.observation_space, env.action_space))
+            elif cmd == "env_method":
+                method = getattr(env, data[0])
+                remote.send(method(*data[1], **data[2]))
+            elif cmd == "get_attr":
+                remote.send(getattr(env, data))
+            elif cmd == "set_attr":
+                remote.send(setattr(env, data[0], data[1]))
+            elif cmd == "is_wrapped":
+                remote.send(is_wrapped(env, data))
+            elif cmd == "render":
+                remote.send(env.render())
+            else:
+                raise NotImplementedError("`{}` is not implemented in the worker".format(cmd))
+        except EOFError:
+            break
+
+
+################################################################################
+# VECTORISED ENVIRONMENT
+
+
+class SharedMemoryVecEnv(SubprocVecEnv):
+    """
+    One process per environment, like SubprocVecEnv, with the last n_stack frames
+    stacked like VecFrameStack(channels_order="last"), but without copying frames.
+
+    Each environment has a ring buffer of frames in shared memory, laid out so
+    that the last n_stack frames are next to each other for every pixel. Every
+    step, the main process tells the workers which slot to write their frame to,
+    and the stacked observation is just a view of the n_stack slots up to it, so
+    only the rewards, dones and infos go through the pipes. When the ring buffer
+    runs out, or an episode ends (and its stack has to start again from zeros),
+    the current stacks are copied to a fresh part of it, once for every
+    environment. A view is never overwritten for at least one step after it is
+    returned (PPO keeps the last observation until after the next step).
+
+    :param env_fns: ([callable]) functions that create the environments
+    :param n_stack: (int) how many frames are stacked together into one observation
+    :param ring_frames: (int) slots in each ring buffer, at least 3 * n_stack
+    :param start_method: (str) multiprocessing start method, defaults to forkserver (or spawn)
+    """
+
+    def __init__(self, env_fns, n_stack, ring_frames=None, start_method=None):
+        self.waiting = False
+        self.closed = False
+        self.n_stack = n_stack
+        self.ring_frames = RING_STACKS * n_stack if ring_frames is None else ring_frames
+        if self.ring_frames < 3 * n_stack:
+            raise ValueError("ring_frames must be at least 3 * n_stack")
+        n_envs = len(env_fns)
+
+        if start_method is None:
+            start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+        ctx = mp.get_context(start_method)
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(n_envs)])
+        self.processes = []
+        for work_remote, remote, env_fn in zip(self.work_remotes, self.remotes, env_fns):
+            process = ctx.Process(target=_shared_worker, args=(work_remote, remote, CloudpickleWrapper(env_fn)), daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        self.remotes[0].send(("get_spaces", None))
+        frame_space, action_space = self.remotes[0].recv()
+        if frame_space.dtype != np.uint8 or len(frame_space.shape) != 3:
+            raise ValueError("SharedMemoryVecEnv needs uint8 (height, width, channels) frames")
+        height, width, channels = frame_space.shape
+        observation_space = spaces.Box(
+            low=np.repeat(frame_space.low, n_stack, axis=-1),
+            high=np.repeat(frame_space.high, n_stack, axis=-1),
+            dtype=np.uint8,
+        )
+        VecEnv.__init__(self, n_envs, observation_space, action_space)
+
+        # frames[env, y, x, slot, channel], so the stacked channels of a pixel are next to each other
+        ring_shape = (n_envs, height, width, self.ring_frames, channels)
+        ring_size = int(np.prod(ring_shape))
+        self.memory = shared_memory.SharedMemory(create=True, size=ring_size + n_envs * height * width * channels)
+        self.frames = np.ndarray(ring_shape, np.uint8, self.memory.buf)
+        self.reset_frames = np.ndarray((n_envs, height, width, channels), np.uint8, self.memory.buf, ring_size)
+        for rank, remote in enumerate(self.remotes):
+            remote.send(("attach", (self.memory.name, rank, ring_shape, ring_size)))
+        for remote in self.remotes:
+            remote.recv()
+        self.position = n_stack - 1  # the slot of the newest frame
+        self.written = None  # the slot the workers are writing to
+
+    def _stacks(self, position):
+        # The last n_stack frames up to position, as (env, y, x, n_stack * channels), without copying
+        stacks = self.frames[:, :, :, position - self.n_stack + 1:position + 1]
+        return stacks.reshape(stacks.shape[:3] + (-1,))
+
+    def _move_stacks(self, position):
+        # Copy the current stacks to a part of the ring buffer that no recent observation uses
+        new_position = position + self.n_stack if position + self.n_stack < self.ring_frames else self.n_stack - 1
+        old = slice(position - self.n_stack + 1, position + 1)
+        new = slice(new_position - self.n_stack + 1, new_position + 1)
+        self.frames[:, :, :, new] = self.frames[:, :, :, old]
+        return new_position
+
+    def step_async(self, actions):
+        self.written = self.position + 1
+        if self.written == self.ring_frames:
+            self.position = self._move_stacks(self.position)  # (to the start)
+            self.written = self.position + 1
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", (action, self.written)))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        rewards, dones, infos, self.reset_infos = zip(*results)
+        dones = np.array(dones)
+        self.position = self.written
+        if dones.any():
+            observations = self._stacks(self.position)
+            for env in np.flatnonzero(dones):
+                infos[env]["terminal_observation"] = observations[env].copy()
+            # the stacks of the new episodes start from zeros
+            self.position = self._move_stacks(self.position)
+            self.frames[dones, :, :, self.position - self.n_stack + 1:self.position] = 0
+            self.frames[dones, :, :, self.position] = self.reset_frames[dones]
+        return self._stacks(self.position), np.array(rewards), dones, infos
+
+    def reset(self):
+        for env, remote in enumerate(self.remotes):
+            remote.send(("reset", self._seeds[env]))
+        self.reset_infos = [remote.recv() for remote in self.remotes]
+        self._reset_seeds()
+        self.position = self.n_stack - 1
+        self.frames[:, :, :, :self.position] = 0
+        self.frames[:, :, :, self.position] = self.reset_frames
+        return self._stacks(self.position)
+
+    def close(self):
+        if self.closed:
+            return
+        super(SharedMemoryVecEnv, self).close()
+        self.memory.unlink()  # freed once the last observation using it is gone
@@ -0,0 +1,441 @@
+import os
+import csv
+import sys
+import glob
+import json
+import math
+import re
+import time
+import argparse
+import itertools
+import subprocess
+import numpy as np
+
+# Train many PPO configurations, a few at a time, stopping the ones that are
+# clearly worse than the others early, and rank them in a leaderboard.
+# Each trial is a separate 1_TrainMario.py process with its own log and checkpoint
+# directories and its own CPU cores. Options after "--" are passed to every trial.
+# e.g. "poetry run python marioSweep.py --param learning_rate=0.00001,0.0001 n_steps=256,512
+#       --budget 2000000 --cores 8 --cores-per-trial 2 -- --preprocess"
+#      "poetry run python marioSweep.py --search random --trials 12 --param learning_rate=loguniform:1e-6:1e-3"
+#      "poetry run python marioSweep.py --search halving --trials 9 --param learning_rate=loguniform:1e-6:1e-3"
+
+################################################################################
+# CONSTANTS
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "1_TrainMario.py")
+SWEEP_DIR = "./sweeps/sweep"  # Where the trials and the leaderboard are written
+BUDGET = 1000000  # Environment steps per trial (for halving, per trial in the first round)
+TRIALS = 8  # Configurations sampled for random search and halving
+REWARD_WINDOW = 20  # Episodes averaged for a trial's reward
+GRACE_FRACTION = 0.25  # Trials aren't stopped early before this fraction of the budget
+MIN_COMPARISONS = 2  # Other trials that must have got as far before a trial can be stopped early
+HALVING_RATE = 3  # Successive halving keeps 1 in this many trials each round, which train this many times longer
+POLL_SECONDS = 10  # How often to check on the trials
+
+LEADERBOARD_FIELDS = ["rank", "trial", "status", "params", "steps", "mean_reward", "best_reward", "seconds"]
+
+
+################################################################################
+# SEARCH SPACE
+
+
+def _number(text):
+    number = float(text)
+    return int(number) if number.is_integer() and "." not in text and "e" not in text.lower() else number
+
+
+def parse_param(spec):
+    """
+    Parse a "name=values" option into a search space entry.
+
+    The values are either a list ("0.0001,0.001"), or a distribution for random
+    search: "uniform:low:high", "loguniform:low:high" or "int:low:high".
+
+    :param spec: (str) e.g. "learning_rate=loguniform:1e-6:1e-3"
+    :return: ((str, list or tuple)) the name, and the list of values or (distribution, low, high)
+    """
+    name, values = spec.split("=", 1)
+    for distribution in ("uniform", "loguniform", "int"):
+        if values.startswith(distribution + ":"):
+            low, high = values[len(distribution) + 1:].split(":")
+            return name, (distribution, float(low), float(high))
+    return name, [_number(value) for value in values.split(",")]
+
+
+def sample_configs(space, search, trials, seed=0):
+    """
+    Choose the configurations to try.
+
+    :param space: (dict) name -> list of values or (distribution, low, high)
+    :param search: (str) "grid" (every combination of the lists) or "random"/"halving"
+        (trials random configurations)
+    :param trials: (int) how many configurations for random search
+    :param seed: (int) seed for random search
+    :return: ([dict]) the configurations
+    """
+    if search == "grid":
+        if any(not isinstance(values, list) for values in space.values()):
+            raise ValueError("grid search needs a list of values for every parameter")
+        return [dict(zip(space, values)) for values in itertools.product(*space.values())]
+    rng = np.random.default_rng(seed)
+    configs = []
+    for _ in range(trials):
+        config = {}
+        for name, values in space.items():
+            if isinstance(values, list):
+                config[name] = values[rng.integers(len(values))]
+            elif values[0] == "uniform":
+                config[name] = float(rng.uniform(values[1], values[2]))
+            elif values[0] == "loguniform":
+                config[name] = float(np.exp(rng.uniform(np.log(values[1]), np.log(values[2]))))
+            else:
+                config[name] = int(rng.integers(values[1], values[2] + 1))
+        configs.append(config)
+    return configs
+
+
+################################################################################
+# TRIALS
+
+
+def available_cores():
+    """
+    Get the CPU cores this process may run on, which may not be 0 to os.cpu_count() - 1
+    (e.g. in a container or under taskset).
+
+    :return: ([int]) the core IDs
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def read_monitor(log_dir):
+    """
+    Read the episode rewards of every worker of a trial from its monitor files.
+
+    :param log_dir: (str) the trial's log directory
+    :return: ([float]) the episode rewards, in the order they ended
+    """
+    episodes = []
+    for path in glob.glob(os.path.join(log_dir, "*.monitor.csv")):
+        try:
+            with open(path) as f:
+                f.readline()  # the #{...} metadata line
+                for row in csv.DictReader(f):
+                    episodes.append((float(row["t"]), float(row["r"])))
+        except (OSError, ValueError, KeyError):
+            continue  # being written
+    episodes.sort()
+    return [reward for _, reward in episodes]
+
+
+TIMESTEPS_LINE = re.compile(r"\|\s*total_timesteps\s*\|\s*(\d+)")  # in the table PPO prints after each update
+
+
+class Trial:
+    """
+    One configuration being trained by a 1_TrainMario.py process.
+
+    :param number: (int) the trial's number
+    :param params: (dict) its 1_TrainMario.py options, e.g. {"learning_rate": 0.0001}
+    :param sweep_dir: (str) the sweep's directory, the trial uses a directory inside it
+    """
+
+    def __init__(self, number, params, sweep_dir):
+        self.number = number
+        self.params = params
+        self.directory = os.path.join(sweep_dir, "trial_{}".format(number))
+        self.process = None
+        self.cores = []
+        self.status = "waiting"
+        self.rounds = 0  # successive halving rounds it has been trained in
+        self.history = []  # (steps, mean reward of the last REWARD_WINDOW episodes)
+        self.first_episode = 0  # episodes in the monitor files before this round, which don't count
+        self.steps = 0
+        self.log_position = 0  # how much of train.log has been read
+        self.seconds = 0.0
+        self.started = None
+
+    def start(self, budget, cores, train_args, resume=False):
+        """
+        Start (or carry on) training, up to budget environment steps in total.
+
+        :param budget: (int) the total steps to train to
+        :param cores: ([int]) the CPU cores to run on, one worker each
+        :param train_args: ([str]) more 1_TrainMario.py options
+        :param resume: (bool) carry on from the trial's latest checkpoint
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "params.json"), "w") as f:
+            json.dump(self.params, f, indent=2)
+        command = [sys.executable, TRAIN_SCRIPT, "--headless", "--workers", str(len(cores))]
+        command += ["--total-timesteps", str(budget), "--log-dir", "logs", "--checkpoint-dir", "models"]
+        command += ["--eval-freq", "0"]  # the sweep compares the trials itself
+        for name, value in self.params.items():
+            command += ["--" + name.replace("_", "-"), str(value)]
+        if resume:
+            command.append("--resume")
+        command += train_args
+        # one thread per core, for torch and anything else using OpenMP
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+
+        def pin():
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, cores)  # the workers started by it inherit this
+
+        log = open(os.path.join(self.directory, "train.log"), "a")
+        self.process = subprocess.Popen(
+            command, cwd=self.directory, env=env, stdout=log, stderr=subprocess.STDOUT,
+            preexec_fn=pin if os.name == "posix" else None,
+        )
+        log.close()
+        self.cores = cores
+        self.status = "running"
+        self.started = time.perf_counter()
+
+    def update(self):
+        """
+        Read the trial's progress, and check whether it has finished.
+
+        :return: (bool) True if it has just finished
+        """
+        # the steps trained from the trial's output, since the monitor files only have finished
+        # episodes (in emulator frames)
+        with open(os.path.join(self.directory, "train.log"), "rb") as f:
+            f.seek(self.log_position)
+            output = f.read()
+        output = output[:output.rfind(b"\n") + 1]  # up to the last whole line
+        self.log_position += len(output)
+        output = output.decode(errors="replace")
+        for steps in TIMESTEPS_LINE.findall(output):
+            self.steps = max(self.steps, int(steps))
+        rewards = read_monitor(os.path.join(self.directory, "logs"))[self.first_episode:]
+        if rewards:
+            self.history.append((self.steps, float(np.mean(rewards[-REWARD_WINDOW:]))))
+        if self.process is None or self.process.poll() is None:
+            return False
+        self.seconds += time.perf_counter() - self.started
+        self.status = "finished" if self.process.returncode == 0 else "failed"
+        self.process = None
+        return True
+
+    def stop(self):
+        """Stop the trial early."""
+        self.process.terminate()
+        self.process.wait()
+        self.seconds += time.perf_counter() - self.started
+        self.process = None
+        self.status = "stopped"
+
+    def reward_at(self, steps):
+        """
+        Get the trial's mean reward when it had trained for some steps.
+
+        :param steps: (int) environment steps
+        :return: (float) the last mean reward at or before then, or None if it hadn't got that far
+        """
+        if self.steps < steps:
+            return None
+        rewards = [reward for history_steps, reward in self.history if history_steps <= steps]
+        return rewards[-1] if rewards else None
+
+    @property
+    def mean_reward(self):
+        return self.history[-1][1] if self.history else None
+
+    @property
+    def best_reward(self):
+        return max(reward for _, reward in self.history) if self.history else None
+
+
+def should_stop(trial, trials, grace_steps):
+    """
+    The median stopping rule: stop a trial whose mean reward is below the median of
+    what the other trials had at the same number of steps.
+
+    :param trial: (Trial) the trial to check
+    :param trials: ([Trial]) every trial
+    :param grace_steps: (int) never stop a trial before this many steps
+    :return: (bool) whether to stop it
+    """
+    if trial.steps < grace_steps or trial.mean_reward is None:
+        return False
+    others = [other.reward_at(trial.steps) for other in trials if other is not trial]
+    others = [reward for reward in others if reward is not None]
+    return len(others) >= MIN_COMPARISONS and trial.mean_reward < np.median(others)
+
+
+################################################################################
+# RUNNING A SWEEP
+
+
+def run_trials(trials, budget, cores, cores_per_trial, train_args, early_stopping=True, resume=False, leaderboard=None):
+    """
+    Train every trial up to budget steps, running as many at once as the cores allow.
+
+    :param trials: ([Trial]) the trials
+    :param budget: (int) environment steps to train each to
+    :param cores: ([int]) the CPU cores the sweep can use
+    :param cores_per_trial: (int) cores (and workers) each trial gets
+    :param train_args: ([str]) more 1_TrainMario.py options
+    :param early_stopping: (bool) stop trials with the median stopping rule
+    :param resume: (bool) carry the trials on from their latest checkpoints
+    :param leaderboard: (str) rewrite this leaderboard file after every check, or None
+    """
+    waiting = list(trials)
+    running = []
+    free_cores = list(cores)
+    grace_steps = int(budget * GRACE_FRACTION)
+    while waiting or running:
+        while waiting and len(free_cores) >= cores_per_trial:
+            trial = waiting.pop(0)
+            trial.start(budget, free_cores[:cores_per_trial], train_args, resume)
+            free_cores = free_cores[cores_per_trial:]
+            running.append(trial)
+            print("Started trial {} {} on cores {}".format(trial.number, trial.params, trial.cores))
+        time.sleep(POLL_SECONDS)
+        for trial in list(running):
+            if not trial.update() and early_stopping and should_stop(trial, trials, grace_steps):
+                trial.stop()
+                print("Stopped trial {} at {} steps (mean reward {:.1f})".format(trial.number, trial.steps, trial.mean_reward))
+            if trial.process is None:
+                running.remove(trial)
+                free_cores += trial.cores
+                if trial.status != "stopped":
+                    print("Trial {} {} at {} steps".format(trial.number, trial.status, trial.steps))
+        if leaderboard is not None:
+            write_leaderboard(leaderboard, trials)
+
+
+def successive_halving(trials, budget, cores, cores_per_trial, train_args, rate=HALVING_RATE, leaderboard=None):
+    """
+    Train every trial a little, then keep training only the best 1/rate of them for
+    rate times longer, and so on until one is left.
+
+    The trials carry on from their checkpoints each round (1_TrainMario.py --resume).
+
+    :param trials: ([Trial]) the trials
+    :param budget: (int) environment steps in the first round
+    :param cores: ([int]) the CPU cores the sweep can use
+    :param cores_per_trial: (int) cores (and workers) each trial gets
+    :param train_args: ([str]) more 1_TrainMario.py options
+    :param rate: (int) the fraction of trials dropped, and how much longer the next round is
+    :param leaderboard: (str) rewrite this leaderboard file after every check, or None
+    """
+    survivors = list(trials)
+    round_budget = budget
+    first = True
+    while survivors:
+        print("Round with {} trials, training to {} steps".format(len(survivors), round_budget))
+        # only the reward of this round's episodes counts (resumed trials append to their monitor files)
+        for trial in survivors:
+            trial.history = []
+            trial.first_episode = len(read_monitor(os.path.join(trial.directory, "logs")))
+            trial.rounds += 1
+        run_trials(survivors, round_budget, cores, cores_per_trial, train_args, False, not first, leaderboard)
+        first = False
+        finished = [t for t in survivors if t.status == "finished" and t.mean_reward is not None]
+        if len(finished) <= 1:
+            break
+        finished.sort(key=lambda t: t.mean_reward, reverse=True)
+        survivors = finished[:max(len(finished) // rate, 1)]
+        for trial in finished[len(survivors):]:
+            trial.status = "stopped"
+        round_budget *= rate
+
+
+def write_leaderboard(path, trials):
+    """
+    Write the trials ranked by their latest mean reward (for successive halving, the
+    trials that got to later rounds first), as CSV (or JSON if path ends in .json).
+
+    :param path: (str) output file
+    :param trials: ([Trial]) the trials
+    :return: ([dict]) the rows, best first
+    """
+    ranked = sorted(
+        trials, key=lambda t: (t.rounds, -math.inf if t.mean_reward is None else t.mean_reward), reverse=True
+    )
+    rows = [
+        dict(
+            rank=rank + 1,
+            trial=trial.number,
+            status=trial.status,
+            params=json.dumps(trial.params),
+            steps=trial.steps,
+            mean_reward=trial.mean_reward,
+            best_reward=trial.best_reward,
+            seconds=round(trial.seconds, 1),
+        )
+        for rank, trial in enumerate(ranked)
+    ]
+    with open(path + ".tmp", "w", newline="") as f:
+        if path.endswith(".json"):
+            json.dump(rows, f, indent=2)
+        else:
+            writer = csv.DictWriter(f, fieldnames=LEADERBOARD_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    os.replace(path + ".tmp", path)
+    return rows
+
+
+################################################################################
+# COMMAND LINE
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Sweep PPO hyperparameters. Options after -- are passed to every 1_TrainMario.py trial."
+    )
+    parser.add_argument(
+        "--param",
+        nargs="+",
+        required=True,
+        help="1_TrainMario.py options to sweep, e.g. learning_rate=0.00001,0.0001 or "
+        "learning_rate=loguniform:1e-6:1e-3 (also uniform:low:high and int:low:high)",
+    )
+    parser.add_argument("--search", choices=["grid", "random", "halving"], default="grid")
+    parser.add_argument("--trials", type=int, default=TRIALS, help="configurations for random search and halving")
+    parser.add_argument("--budget", type=int, default=BUDGET, help="environment steps per trial (first round for halving)")
+    parser.add_argument("--cores", type=int, help="CPU cores the whole sweep can use (default: every one it may run on)")
+    parser.add_argument("--cores-per-trial", type=int, default=1, help="cores (and environment workers) per trial")
+    parser.add_argument("--no-early-stopping", action="store_true", help="never stop grid or random trials early")
+    parser.add_argument("--seed", type=int, default=0, help="seed for random search")
+    parser.add_argument("--output", default=SWEEP_DIR, help="directory for the trials and leaderboard.csv")
+    args, train_args = parser.parse_known_args()
+    if train_args and train_args[0] == "--":
+        train_args = train_args[1:]
+    return args, train_args
+
+
+if __name__ == "__main__":
+    args, train_args = parse_args()
+    space = dict(parse_param(spec) for spec in args.param)
+    configs = sample_configs(space, args.search, args.trials, args.seed)
+    os.makedirs(args.output, exist_ok=True)
+    trials = [Trial(i, config, args.output) for i, config in enumerate(configs)]
+    leaderboard = os.path.join(args.output, "leaderboard.csv")
+    cores = available_cores()
+    if args.cores is not None:
+        if not 0 < args.cores <= len(cores):
+            raise SystemExit("--cores must be between 1 and the {} cores this process may run on {}".format(len(cores), cores))
+        cores = cores[:args.cores]
+    if len(cores) < args.cores_per_trial:
+        raise SystemExit("--cores-per-trial is more than the {} cores".format(len(cores)))
+    print("Sweeping {} configurations, {} at a time on cores {}".format(len(trials), len(cores) // args.cores_per_trial, cores))
+
+    if args.search == "halving":
+        successive_halving(trials, args.budget, cores, args.cores_per_trial, train_args, leaderboard=leaderboard)
+    else:
+        run_trials(trials, args.budget, cores, args.cores_per_trial, train_args, not args.no_early_stopping,
+                   leaderboard=leaderboard)
+
+    rows = write_leaderboard(leaderboard, trials)
+    print(f"{'rank':>4} {'trial':>5} {'status':>8} {'steps':>9} {'mean reward':>11}  params")
+    for row in rows:
+        reward = "-" if row["mean_reward"] is None else "{:.1f}".format(row["mean_reward"])
+        print(f"{row['rank']:>4} {row['trial']:>5} {row['status']:>8} {row['steps']:>9} {reward:>11}  {row['params']}")
+    print("Leaderboard written to " + leaderboard)
@@ -0,0 +1,536 @@
+import os
+import time
+import gym
+import cv2 as cv
+import numpy as np
+import gym_super_mario_bros
+from gym_super_mario_bros._roms import decode_target
+from marioRecording import RecordingWrapper
+
+# Gym wrappers and helpers shared by the PPO scripts and the rule-based agent.
+# This file deliberately doesn't import stable_baselines3 (or torch), so the
+# rule-based agent can use it without the cost of loading them.
+
+################################################################################
+# CONSTANTS
+
+# Rendering can be switched off for every entry point with environment
+# variables, e.g. "MARIO_HEADLESS=1 poetry run python 1_TrainMario.py"
+HEADLESS = os.environ.get("MARIO_HEADLESS", "0") not in ("", "0")  # Never open a window
+RENDER_EVERY = int(os.environ.get("MARIO_RENDER_EVERY", "1"))  # Only show every Kth episode
+VIDEO_DIR = os.environ.get("MARIO_VIDEO_DIR")  # Write the shown episodes to videos here instead
+
+VIDEO_FPS = 60  # The NES runs at 60 frames per second
+
+# Snapshot resets (see SnapshotResetWrapper)
+SNAPSHOT_DISTANCE = 256  # Take a snapshot every time Mario gets this much further into a stage
+SNAPSHOT_POOL_SIZE = 32  # Snapshots kept per environment
+SNAPSHOT_START_PROBABILITY = 0.5  # Chance of starting an episode from the start of the stage anyway
+SNAPSHOT_REUSE = 4  # Episodes started from each sampled snapshot before sampling another one
+
+
+def add_render_arguments(parser):
+    """
+    Add the --headless, --render-every and --video-dir options to an argument parser.
+
+    :param parser: (argparse.ArgumentParser) the parser of an entry point
+    """
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        default=HEADLESS,
+        help="never open a window (also set by MARIO_HEADLESS=1)",
+    )
+    parser.add_argument(
+        "--render-every",
+        type=int,
+        default=RENDER_EVERY,
+        metavar="K",
+        help="only render every Kth episode (also set by MARIO_RENDER_EVERY)",
+    )
+    parser.add_argument(
+        "--video-dir",
+        default=VIDEO_DIR,
+        help="write the rendered episodes to video files in this directory instead of "
+        "showing a window, works with --headless (also set by MARIO_VIDEO_DIR)",
+    )
+
+
+def add_recording_arguments(parser):
+    """
+    Add the --record and --record-frames options to an argument parser.
+
+    :param parser: (argparse.ArgumentParser) the parser of an entry point
+    """
+    parser.add_argument(
+        "--record",
+        default=None,
+        metavar="DIR",
+        help="record every episode (the buttons pressed, rewards and info) to files in this "
+        "directory, which marioRecording.py can replay",
+    )
+    parser.add_argument(
+        "--record-frames",
+        action="store_true",
+        help="also store the frames in the recordings, instead of only making them again on replay",
+    )
+
+
+def stage_env_id(stage, version="v3"):
+    """
+    Get the gym_super_mario_bros environment id for a stage.
+
+    :param stage: (str) "world-stage" such as "1-1", or "all" for the whole game
+    :param version: (str) the ROM version, "v0" to "v3"
+    :return: (str) e.g. "SuperMarioBros-1-1-v3"
+    """
+    if stage == "all":
+        return "SuperMarioBros-{}".format(version)
+    return "SuperMarioBros-{}-{}".format(stage, version)
+
+
+def get_nes_env(env):
+    """
+    Find the NES emulator environment underneath any gym wrappers.
+
+    :param env: (gym.Env) a gym_super_mario_bros environment, possibly wrapped
+    :return: (SuperMarioBrosEnv) the nes_py environment that owns the emulator
+    """
+    env = env.unwrapped
+    # gym's API compatibility layer keeps the old-style environment in .env
+    while not hasattr(env, "ram") and hasattr(env, "env"):
+        env = env.env
+    return env
+
+
+def restore_start_state(nes_env):
+    """
+    Rebuild the start of the stage in the emulator's backup, which reset() restores.
+
+    The emulator only has one backup, so this is needed to get back to the start
+    after anything else has been backed up. It also starts a new target stage if
+    the environment's _target_world/_target_stage/_target_area have been changed.
+
+    :param nes_env: (SuperMarioBrosEnv) the environment from get_nes_env
+    """
+    # the same as the environment does when it's created
+    nes_env._has_backup = False
+    nes_env.reset()
+    # the console reset keeps some of the memory (e.g. the stage timer, and _skip_start_screen only
+    # writes the target stage while the timer is 0), so it's cleared like the console was switched on
+    nes_env.ram[:] = 0
+    nes_env._skip_start_screen()
+    nes_env._backup()
+
+
+################################################################################
+# RENDERING
+
+
+class RenderWrapper(gym.Wrapper):
+    """
+    Render only some episodes, either to a window or to video files.
+
+    :param env: (gym.Env) Mario environment created without a render mode
+    :param render_every: (int) render episodes 0, K, 2K, ...
+    :param video_dir: (str) if set, write the rendered episodes here as .mp4 files
+        instead of showing a window
+    """
+
+    def __init__(self, env, render_every=1, video_dir=None):
+        super(RenderWrapper, self).__init__(env)
+        self.render_every = max(render_every, 1)
+        self.video_dir = video_dir
+        self.episode = -1
+        self.episode_steps = 1
+        self.rendering = False
+        self.writer = None
+        if video_dir is not None:
+            os.makedirs(video_dir, exist_ok=True)
+
+    def reset(self, **kwargs):
+        obs, info = self.env.reset(**kwargs)
+        self._close_writer()
+        # vector environments reset automatically when an episode ends, so a
+        # second reset without any steps in between isn't a new episode
+        if self.episode_steps > 0:
+            self.episode += 1
+        self.episode_steps = 0
+        self.rendering = self.episode % self.render_every == 0
+        if self.rendering and self.video_dir is not None:
+            height, width = obs.shape[:2]
+            path = os.path.join(self.video_dir, "episode_{}.mp4".format(self.episode))
+            self.writer = cv.VideoWriter(
+                path, cv.VideoWriter_fourcc(*"mp4v"), VIDEO_FPS, (width, height)
+            )
+        self._render(obs)
+        return obs, info
+
+    def step(self, action):
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        self.episode_steps += 1
+        self._render(obs)
+        return obs, reward, terminated, truncated, info
+
+    def close(self):
+        self._close_writer()
+        return self.env.close()
+
+    def _render(self, obs):
+        if not self.rendering:
+            return
+        if self.writer is not None:
+            self.writer.write(cv.cvtColor(obs, cv.COLOR_RGB2BGR))  # opencv wants BGR
+        else:
+            get_nes_env(self.env).render(mode="human")
+
+    def _close_writer(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+
+################################################################################
+# OBSERVATION PREPROCESSING
+
+
+class MaxAndSkipFrame(gym.Wrapper):
+    """
+    Repeat each action for several frames and return the max of the last two.
+
+    The NES draws some sprites on alternating frames, so taking the per-pixel
+    max of the last two frames keeps them visible.
+
+    :param env: (gym.Env) Gym environment that will be wrapped
+    :param skip: (int) how many frames each action is repeated for
+    """
+
+    def __init__(self, env, skip=4):
+        super(MaxAndSkipFrame, self).__init__(env)
+        self.skip = skip
+        self.frames = np.zeros((2,) + env.observation_space.shape, dtype=np.uint8)
+
+    def step(self, action):
+        total_reward = 0.0
+        for i in range(self.skip):
+            obs, reward, terminated, truncated, info = self.env.step(action)
+            self.frames[i % 2] = obs
+            total_reward += reward
+            if terminated or truncated:
+                break
+        if i == 0:
+            obs = self.frames[0].copy()  # there is only one new frame to use
+        else:
+            obs = self.frames.max(axis=0)
+        return obs, total_reward, terminated, truncated, info
+
+
+class ResizeObservation(gym.ObservationWrapper):
+    """
+    Optionally convert frames to grayscale, and shrink them to size x size.
+
+    :param env: (gym.Env) Gym environment that will be wrapped
+    :param size: (int) width and height of the new frames, or None to keep the size
+    :param grayscale: (bool) convert the frames to a single grayscale channel
+    """
+
+    def __init__(self, env, size=84, grayscale=True):
+        super(ResizeObservation, self).__init__(env)
+        self.size = size
+        self.grayscale = grayscale
+        height, width, channels = env.observation_space.shape
+        if size is not None:
+            height, width = size, size
+        if grayscale:
+            channels = 1
+        self.observation_space = gym.spaces.Box(
+            low=0, high=255, shape=(height, width, channels), dtype=np.uint8
+        )
+
+    def observation(self, obs):
+        if self.grayscale:
+            obs = cv.cvtColor(obs, cv.COLOR_RGB2GRAY)
+        if self.size is not None:
+            # INTER_AREA averages the pixels being merged, so thin sprites don't disappear
+            obs = cv.resize(obs, (self.size, self.size), interpolation=cv.INTER_AREA)
+        return obs.reshape(self.observation_space.shape)
+
+
+################################################################################
+# TIMING
+
+
+class StepTimingWrapper(gym.Wrapper):
+    """
+    Add up the time spent in the wrapped environment's step and reset.
+
+    The running total (in seconds) is put in info["timings"][name] on every
+    step, so it reaches the training process even from a SubprocVecEnv worker,
+    and the latest info of each worker always has its whole total.
+
+    :param env: (gym.Env) Gym environment that will be wrapped
+    :param name: (str) the key to report the total under
+    """
+
+    def __init__(self, env, name):
+        super(StepTimingWrapper, self).__init__(env)
+        self.name = name
+        self.seconds = 0.0
+
+    def reset(self, **kwargs):
+        start = time.perf_counter()
+        result = self.env.reset(**kwargs)
+        self.seconds += time.perf_counter() - start
+        return result
+
+    def step(self, action):
+        start = time.perf_counter()
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        self.seconds += time.perf_counter() - start
+        info.setdefault("timings", {})[self.name] = self.seconds
+        return obs, reward, terminated, truncated, info
+
+
+################################################################################
+# SNAPSHOTS
+
+
+class SnapshotResetWrapper(gym.Wrapper):
+    """
+    Start some episodes from snapshots taken further along the stage.
+
+    The first time Mario stands on the ground in each SNAPSHOT_DISTANCE wide
+    section of a stage (after the first), the state is snapshotted, and again if
+    he gets there in fewer frames later. Resets then start from a sampled snapshot, favouring the ones that episodes
+    started from haven't got past, so training time goes to the parts of the
+    stage the agent can't do yet.
+
+    nes_py can't save the emulator's state, only back up one state internally,
+    so a snapshot is the list of buttons pressed since the start of the stage.
+    It's replayed once when the snapshot is sampled and then backed up, so the
+    next SNAPSHOT_REUSE resets from it are just a copy of the emulator's memory.
+
+    :param env: (gym.Env) Mario environment from make_mario (before JoypadSpace, so
+        the actions are NES buttons)
+    :param pool_size: (int) how many snapshots to keep, the most solved ones are dropped first
+    :param start_probability: (float) chance of starting from the start of the stage anyway
+    :param reuse: (int) episodes to start from each sampled snapshot
+    :param distance: (int) pixels between snapshots
+    :param seed: (int) seed for sampling the snapshots (also set by reset(seed=...))
+    """
+
+    def __init__(
+        self,
+        env,
+        pool_size=SNAPSHOT_POOL_SIZE,
+        start_probability=SNAPSHOT_START_PROBABILITY,
+        reuse=SNAPSHOT_REUSE,
+        distance=SNAPSHOT_DISTANCE,
+        seed=None,
+    ):
+        super(SnapshotResetWrapper, self).__init__(env)
+        self.nes_env = get_nes_env(env)
+        self.pool_size = pool_size
+        self.start_probability = start_probability
+        self.reuse = reuse
+        self.distance = distance
+        self.rng = np.random.default_rng(seed)
+        self.snapshots = {}  # (world, stage, x // distance) -> snapshot dict
+        self.backup_buttons = b""  # the buttons that lead to the state in the emulator's backup
+        self.buttons = bytearray()  # the buttons pressed since the start of the stage
+        self.current = None  # the snapshot this episode started from
+        self.target = None  # the snapshot (or None for the start) resets are using
+        self.uses = 0
+
+    def reset(self, **kwargs):
+        if kwargs.get("seed") is not None:
+            self.rng = np.random.default_rng(kwargs["seed"])
+        if self.uses >= self.reuse or (self.target is not None and self.target["key"] not in self.snapshots):
+            self.target = self._sample()
+            self.uses = 0
+        self.uses += 1
+        self._move_backup(self.target["buttons"] if self.target is not None else b"")
+        obs, info = self.env.reset(**kwargs)
+        self.current = self.target
+        self.buttons = bytearray(self.backup_buttons)
+        if self.current is not None:
+            self.current["starts"] += 1
+            self.current["passed"] = False
+        return obs, info
+
+    def step(self, action):
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        self.buttons.append(action)
+        current = self.current
+        if current is not None and not current["passed"] and info["x_pos"] >= current["x"] + self.distance:
+            current["passed"] = True  # this episode got past the part after its snapshot
+            current["successes"] += 1
+        if not (terminated or truncated) and self.nes_env.ram[0x001D] == 0:  # standing on the ground
+            self._add((info["world"], info["stage"], info["x_pos"] // self.distance), info["x_pos"])
+        return obs, reward, terminated, truncated, info
+
+    def _add(self, key, x):
+        existing = self.snapshots.get(key)
+        # snapshots reached with fewer frames have more time left on the stage timer
+        if key[2] == 0 or (existing is not None and len(existing["buttons"]) <= len(self.buttons)):
+            return
+        if existing is not None:
+            existing.update(buttons=bytes(self.buttons), x=x)  # keeping its statistics
+            return
+        self.snapshots[key] = dict(key=key, buttons=bytes(self.buttons), x=x, starts=0, successes=0, passed=True)
+        if len(self.snapshots) > self.pool_size:
+            weights = self._weights()
+            del self.snapshots[min(weights, key=lambda k: (weights[k], k))]
+
+    def _weights(self):
+        # the fraction of the episodes started from each snapshot that didn't get past it
+        # (counting one success and one failure to begin with)
+        return {
+            key: (snapshot["starts"] - snapshot["successes"] + 1) / (snapshot["starts"] + 2)
+            for key, snapshot in self.snapshots.items()
+        }
+
+    def _sample(self):
+        if not self.snapshots or self.rng.random() < self.start_probability:
+            return None
+        weights = self._weights()
+        keys = list(weights)
+        probabilities = np.array([weights[key] for key in keys])
+        return self.snapshots[keys[self.rng.choice(len(keys), p=probabilities / probabilities.sum())]]
+
+    def _move_backup(self, buttons):
+        # put the state after pressing buttons into the emulator's backup
+        if buttons == self.backup_buttons:
+            return
+        if not buttons.startswith(self.backup_buttons):
+            restore_start_state(self.nes_env)
+            self.backup_buttons = b""
+        self.nes_env.reset()
+        for button in buttons[len(self.backup_buttons):]:
+            self.nes_env.step(button)  # the same as a real step, including skipping animations
+        self.nes_env._backup()
+        self.backup_buttons = buttons
+
+    def pool_summary(self):
+        """
+        Describe the snapshots, e.g. for logging.
+
+        :return: ([dict]) world, stage, x, frames (the length of the replay), starts and
+            successes of every snapshot
+        """
+        return [
+            dict(world=key[0], stage=key[1], x=snapshot["x"], frames=len(snapshot["buttons"]),
+                 starts=snapshot["starts"], successes=snapshot["successes"])
+            for key, snapshot in sorted(self.snapshots.items())
+        ]
+
+
+################################################################################
+# CURRICULUM
+
+
+def parse_stage(stage):
+    """
+    :param stage: (str) "world-stage" such as "1-1"
+    :return: ((int, int)) (world, stage)
+    """
+    try:
+        world, number = (int(part) for part in stage.split("-"))
+    except ValueError:
+        raise ValueError("{!r} isn't a stage like 1-1".format(stage))
+    return world, number
+
+
+class CurriculumWrapper(gym.Wrapper):
+    """
+    Play a stage sampled from several every episode, with probabilities that can
+    be changed while training (see CurriculumCallback in marioCallbacks.py).
+
+    The environment is a single stage environment whose target stage is changed
+    on reset, and the start of the new stage is rebuilt in the emulator (see
+    restore_start_state), so a worker process can move to another stage without
+    being restarted. Stages only change on reset, so no episode is cut short.
+
+    :param env: (gym.Env) single stage Mario environment, e.g. "SuperMarioBros-1-1-v3"
+    :param stages: ([str]) stages such as "1-1" to sample from
+    :param probabilities: ([float]) chance of each stage, defaults to all the same
+    :param seed: (int) seed for sampling the stages (also set by reset(seed=...))
+    """
+
+    def __init__(self, env, stages, probabilities=None, seed=None):
+        super(CurriculumWrapper, self).__init__(env)
+        self.nes_env = get_nes_env(env)
+        if not self.nes_env.is_single_stage_env:
+            raise ValueError("a curriculum needs a single stage environment, e.g. SuperMarioBros-1-1-v3")
+        self.stages = list(stages)
+        self.targets = [decode_target(parse_stage(stage), False) for stage in self.stages]
+        self.probabilities = np.full(len(self.stages), 1 / len(self.stages))
+        if probabilities is not None:
+            self.set_probabilities(probabilities)
+        self.rng = np.random.default_rng(seed)
+        self.stage = "{}-{}".format(self.nes_env._target_world, self.nes_env._target_stage)  # the one being played
+
+    def set_probabilities(self, probabilities):
+        """
+        Change how often each stage is played, from the next reset.
+
+        :param probabilities: ([float]) chance (or weight) of each stage
+        """
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+        if probabilities.shape != (len(self.stages),) or (probabilities < 0).any() or probabilities.sum() <= 0:
+            raise ValueError("need a non-negative weight for each of the {} stages".format(len(self.stages)))
+        self.probabilities = probabilities / probabilities.sum()
+
+    def reset(self, **kwargs):
+        if kwargs.get("seed") is not None:
+            self.rng = np.random.default_rng(kwargs["seed"])
+        index = self.rng.choice(len(self.stages), p=self.probabilities)
+        if self.stages[index] != self.stage:
+            nes_env = self.nes_env
+            nes_env._target_world, nes_env._target_stage, nes_env._target_area = self.targets[index]
+            restore_start_state(nes_env)
+            self.stage = self.stages[index]
+        return self.env.reset(**kwargs)
+
+
+def make_mario(
+    env_id,
+    headless=HEADLESS,
+    render_every=RENDER_EVERY,
+    video_dir=VIDEO_DIR,
+    snapshots=False,
+    record_path=None,
+    record_frames=False,
+    curriculum=None,
+):
+    """
+    Create a gym_super_mario_bros environment with the requested rendering.
+
+    The emulator itself is always created without a render mode, so headless
+    environments never create a window or pay for drawing one.
+
+    :param env_id: (str) gym_super_mario_bros environment id, e.g. "SuperMarioBros-1-1-v3"
+    :param headless: (bool) never open a window
+    :param render_every: (int) only render every Kth episode
+    :param video_dir: (str) write rendered episodes to videos here instead of a window
+    :param snapshots: (bool) start some episodes from snapshots further along the stage
+    :param record_path: (str) record every episode to this file (see marioRecording.py), or None
+    :param record_frames: (bool) also store the frames in the recording
+    :param curriculum: ([str]) play a stage sampled from these every episode (see
+        CurriculumWrapper), env_id being the first of them, or None
+    :return: (gym.Env) the environment
+    """
+    if curriculum is not None and (snapshots or record_path is not None):
+        # (both of them assume every episode is on env_id's stage)
+        raise ValueError("a curriculum can't be used with snapshots or recordings")
+    env = gym_super_mario_bros.make(env_id, apply_api_compatibility=True, render_mode=None)
+    if curriculum is not None:
+        env = CurriculumWrapper(env, curriculum)
+    if snapshots:
+        env = SnapshotResetWrapper(env)
+    if record_path is not None:
+        # below any JoypadSpace, so the NES buttons are recorded
+        env = RecordingWrapper(env, env_id, record_path, record_frames)
+    if video_dir is not None or not headless:
+        env = RenderWrapper(env, render_every, video_dir)
+    return env
@@ -4,6 +4,18 @@ import gym
 import cv2 as cv
 import numpy as np
 import string
+import argparse
+import os
+import time
+import struct
+import hashlib
+import zipfile
+from collections.abc import Mapping
+from functools import partial
+from marioWrappers import add_render_arguments, add_recording_arguments, make_mario, get_nes_env
+from marioRam import locate_objects_ram
+from marioGrid import OccupancyGrid, ENEMY, HAZARD, LEDGE_LOOKAHEAD, LANDING_RANGE, BEHIND_RANGE
+from marioPlanner import Planner, PLAN_BUDGET, PLAN_INTERVAL, rule_policy
 
 # code for locating objects on the screen in super mario bros
 # by Lauren Gee
@@ -28,9 +40,50 @@ SCREEN_HEIGHT   = 240
 SCREEN_WIDTH    = 256
 MATCH_THRESHOLD = 0.9
 
+#addition: faster detection modes for locate_objects (compare them with "benchmarkMario.py detect")
+# "full" searches the whole screen for everything, like the original code
+# "roi" finds Mario near where he was last seen, then only searches the area around him that
+#   make_action looks at (falling back to the whole screen if Mario can't be found)
+# "pyramid" is "roi", but each template is first matched on a half size screen and only
+#   the area around those rough matches is searched at full size
+DETECTION_MODE = "full"
+HUD_HEIGHT = 32 # the score/coins/world/time text at the top of the screen
+MARIO_SEARCH_RADIUS = 48 # how far from his last location to look for Mario
+ROI_RADIUS_X = 80 # how far left/right of Mario to look for other objects
+ROI_RADIUS_Y = 48 # how far above/below Mario to look for other objects
+PYRAMID_THRESHOLD = 0.5 # the half size matches are blurrier, so accept weaker matches
+
+#addition: how templates are matched (compare them with "benchmarkMario.py match")
+# "loop" matches one template at a time with cv.matchTemplate, like the original code
+# "batched" matches all the same size templates of an object together (see _match_group)
+# "palette" matches colours exactly instead of greyscale, so e.g. red and green mushrooms are told
+#   apart (see _match_palette); sprites are only found in the colours of their template images
+MATCH_ENGINE = "batched"
+MIN_VARIANCE = 0.1 # windows of the screen flatter than this (per pixel) can't match anything
+MATCH_NMS_RADIUS = 0 # if > 0, only keep matches that are the best within this many pixels
+
+#addition: where make_action gets object locations from
+# "vision" locates them on the screen (see DETECTION_MODE)
+# "ram" reads them from the emulator's memory (see marioRam.py), which needs no image processing
+PERCEPTION = "vision"
+
+#addition: how make_action decides what to do with the located objects
+# "objects" checks every object against the original rules, with their checks for enemies behind
+#   Mario and for big Mario fixed (the agent does best with these)
+# "grid" draws them into a tile occupancy grid of the screen and asks it questions (see
+#   marioGrid.py), with rewritten rules (e.g. waiting for piranha plants) that don't do as well
+#   on most stages yet (compare them with "ruleBasedRunner.py --decisions")
+DECISIONS = "objects"
+
 ################################################################################
 # TEMPLATES FOR LOCATING OBJECTS
 
+#addition: the template images are found next to this file (not in the current directory), and
+# the decoded templates are cached in TEMPLATE_CACHE, which is memory-mapped by later runs (and
+# worker processes) instead of decoding every image again. It is rebuilt when the images change.
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_CACHE = os.path.join(TEMPLATE_DIR, "template_cache.npz") # None to never use a cache
+
 # ignore sky blue colour when matching templates
 MASK_COLOUR = np.array([252, 136, 104]) #ground
 
@@ -83,7 +136,7 @@ image_files = {
 
 
 def _get_template(filename):
-    image = cv.imread(filename)
+    image = cv.imread(os.path.join(TEMPLATE_DIR, filename)) #edit: relative to this file
     assert image is not None, f"File {filename} does not exist."
     template = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
     mask = np.uint8(np.where(np.all(image == MASK_COLOUR, axis=2), 0, 1))
@@ -111,29 +164,539 @@ def get_template_and_flipped(filenames):
 # horizontally flipped versions of those templates.
 include_flipped = {"mario", "enemy", "hard_enemy"}
 
-# generate all templatees
-templates = {}
-for category in image_files:
-    category_items = image_files[category]
-    category_templates = {}
-    for object_name in category_items:
-        filenames = category_items[object_name]
-        if category in include_flipped or object_name in include_flipped:
-            category_templates[object_name] = get_template_and_flipped(filenames)
+#edit: the templates are generated (or loaded from the cache) the first time they're used
+def _build_templates():
+    # generate all templatees
+    templates = {}
+    for category in image_files:
+        category_items = image_files[category]
+        category_templates = {}
+        for object_name in category_items:
+            filenames = category_items[object_name]
+            if category in include_flipped or object_name in include_flipped:
+                category_templates[object_name] = get_template_and_flipped(filenames)
+            else:
+                category_templates[object_name] = get_template(filenames)
+        templates[category] = category_templates
+    return templates
+
+#addition: the template cache
+def _template_cache_key():
+    # a hash of everything the templates are made from
+    digest = hashlib.sha1(repr((image_files, sorted(include_flipped), MASK_COLOUR.tolist())).encode())
+    for category in image_files:
+        for object_name in image_files[category]:
+            for filename in image_files[category][object_name]:
+                path = os.path.join(TEMPLATE_DIR, filename)
+                assert os.path.exists(path), f"File {filename} does not exist."
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+    return digest.hexdigest()
+
+def _save_template_cache(path, key, templates):
+    # every template and mask goes into one array of pixels, with an index of where each one is
+    pieces, index, offset = [], [], 0
+    for category in templates:
+        for object_name in templates[category]:
+            for template, mask, dimensions in templates[category][object_name]:
+                height, width = template.shape
+                mask_offset = -1 if mask is None else offset + template.size
+                index.append((offset, height, width, mask_offset))
+                pieces += [template.ravel()] + ([] if mask is None else [mask.ravel()])
+                offset += template.size * (1 if mask is None else 2)
+    # written to a temporary file first, so processes starting at the same time never see half a file
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as f:
+        # stored uncompressed, so the pixels can be memory-mapped
+        np.savez(f, key=np.array(key), index=np.array(index, dtype=np.int64), pixels=np.concatenate(pieces))
+    os.replace(temporary, path)
+
+def _memory_map_npz(path, name):
+    # np.load can't memory-map arrays inside an .npz, so find where the array's data starts
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(name + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(path) as data:
+            return data[name]
+    with open(path, "rb") as f:
+        f.seek(info.header_offset + 26) # the lengths of the name and extra field in the zip entry's header
+        name_length, extra_length = struct.unpack("<HH", f.read(4))
+        f.seek(name_length + extra_length, os.SEEK_CUR)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
         else:
-            category_templates[object_name] = get_template(filenames)
-    templates[category] = category_templates
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return np.memmap(path, dtype, "r", offset, shape)
+
+def _load_template_cache(path, key):
+    # the templates from the cache, in the same structure as _build_templates, or None if it's out of date
+    try:
+        with np.load(path) as data:
+            if str(data["key"]) != key:
+                return None
+            index = data["index"]
+        pixels = _memory_map_npz(path, "pixels")
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+    rows = iter(index.tolist())
+    templates = {}
+    for category in image_files:
+        templates[category] = {}
+        for object_name in image_files[category]:
+            flipped = category in include_flipped or object_name in include_flipped
+            category_templates = []
+            for _ in range(len(image_files[category][object_name]) * (2 if flipped else 1)):
+                offset, height, width, mask_offset = next(rows)
+                template = pixels[offset:offset + height*width].reshape(height, width)
+                mask = None if mask_offset < 0 else pixels[mask_offset:mask_offset + height*width].reshape(height, width)
+                category_templates.append((template, mask, (width, height)))
+            templates[category][object_name] = category_templates
+    return templates
+
+def load_templates(cache_path=TEMPLATE_CACHE):
+    """
+    Load the templates from the cache, building (and caching) them if the images have changed.
+
+    :param cache_path: (str) the cache file, or None to always build them from the images
+    :return: (dict) category -> object name -> [(template, mask, (width, height))]
+    """
+    if cache_path is None:
+        return _build_templates()
+    key = _template_cache_key()
+    loaded = _load_template_cache(cache_path, key)
+    if loaded is not None:
+        return loaded
+    built = _build_templates()
+    try:
+        _save_template_cache(cache_path, key, built)
+    except OSError:
+        pass # e.g. a read-only install, the templates just aren't cached
+    return built
+
+class _LazyTemplates(Mapping):
+    # a dictionary that's only filled in (by load) the first time it's used, so importing this file is quick
+    def __init__(self, load):
+        self._load = load
+        self._templates = None
+
+    def _get(self):
+        if self._templates is None:
+            self._templates = self._load()
+        return self._templates
+
+    def __getitem__(self, category):
+        return self._get()[category]
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+templates = _LazyTemplates(lambda: load_templates(TEMPLATE_CACHE))
+
+#addition: half size versions of every template for the "pyramid" detection mode
+def _get_half_template(template, mask, dimensions):
+    width, height = dimensions
+    half_size = (max(width//2, 1), max(height//2, 1))
+    half_template = cv.resize(template, half_size, interpolation=cv.INTER_AREA)
+    half_mask = None
+    if mask is not None:
+        half_mask = cv.resize(mask, half_size, interpolation=cv.INTER_NEAREST)
+        if half_mask.size - np.sum(half_mask) < 3:
+            half_mask = None
+    return half_template, half_mask, half_size
+
+def _build_half_templates():
+    half_templates = {}
+    for category in templates:
+        half_templates[category] = {}
+        for object_name in templates[category]:
+            half_templates[category][object_name] = [_get_half_template(*t) for t in templates[category][object_name]]
+    return half_templates
+
+half_templates = _LazyTemplates(_build_half_templates)
+
+#addition: palette index versions of every template for the "palette" match engine. The NES can
+# only show these 64 colours (as nes_py draws them, 0xRRGGBB; some are the same black), so each
+# pixel is turned into the index of its colour with a lookup table on the top 6 bits of red, green
+# and blue (which are all different for these colours). Other colours get PALETTE_UNKNOWN.
+NES_PALETTE = [
+    0x7c7c7c, 0x0000fc, 0x0000bc, 0x4428bc, 0x940084, 0xa80020, 0xa81000, 0x881400,
+    0x503000, 0x007800, 0x006800, 0x005800, 0x004058, 0x000000, 0x000000, 0x000000,
+    0xbcbcbc, 0x0078f8, 0x0058f8, 0x6844fc, 0xd800cc, 0xe40058, 0xf83800, 0xe45c10,
+    0xac7c00, 0x00b800, 0x00a800, 0x00a844, 0x008888, 0x000000, 0x000000, 0x000000,
+    0xf8f8f8, 0x3cbcfc, 0x6888fc, 0x9878f8, 0xf878f8, 0xf85898, 0xf87858, 0xfca044,
+    0xf8b800, 0xb8f818, 0x58d854, 0x58f898, 0x00e8d8, 0x787878, 0x000000, 0x000000,
+    0xfcfcfc, 0xa4e4fc, 0xb8b8f8, 0xd8b8f8, 0xf8b8f8, 0xf8a4c0, 0xf0d0b0, 0xfce0a8,
+    0xf8d878, 0xd8f878, 0xb8f8b8, 0xb8f8d8, 0x00fcfc, 0xf8d8f8, 0x000000, 0x000000,
+]
+PALETTE_UNKNOWN = 255
+PALETTE_THRESHOLD = 0.9 # the fraction of a template's pixels that must be exactly the right colour
+PALETTE_COLOUR_THRESHOLD = 0.5 # and the fraction of the pixels of each of its main colours
+PALETTE_MAIN_COLOURS = 2 # how many of a template's most common colours are its main colours
+
+# colours that some areas swap for others, e.g. underground blocks are teal instead of brown;
+# templates in the given categories with these colours also get a version with them swapped (as {from: to})
+PALETTE_SWAPS = [
+    (("block", "item"), {0xe45c10: 0x008888, 0xf0d0b0: 0x00fcfc}), # underground
+    (("enemy",), {0xe45c10: 0x008888, 0xf0d0b0: 0x00fcfc, 0x000000: 0x004058}), # underground
+]
+
+def _palette_key(colour):
+    return ((colour >> 18) & 63) << 12 | ((colour >> 10) & 63) << 6 | ((colour >> 2) & 63)
+
+def _build_palette_lookup():
+    lookup = np.full(1 << 18, PALETTE_UNKNOWN, np.uint8)
+    index = 0
+    for colour in NES_PALETTE:
+        key = _palette_key(colour)
+        if lookup[key] == PALETTE_UNKNOWN:
+            lookup[key] = index
+            index += 1
+    return lookup
+
+PALETTE_LOOKUP = _build_palette_lookup()
+
+def to_palette(screen):
+    """
+    Turn an RGB frame into the palette index of every pixel.
+
+    :param screen: (np.ndarray) (height, width, 3) RGB frame
+    :return: (np.ndarray) (height, width) uint8 palette indices
+    """
+    top = screen >> 2
+    keys = top[:, :, 0].astype(np.int32) << 12
+    keys |= top[:, :, 1].astype(np.int32) << 6
+    keys |= top[:, :, 2]
+    return PALETTE_LOOKUP[keys]
+
+def _get_palette_template(filename, flip=False):
+    image = cv.imread(os.path.join(TEMPLATE_DIR, filename))
+    assert image is not None, f"File {filename} does not exist."
+    indices = to_palette(cv.cvtColor(image, cv.COLOR_BGR2RGB)) # (the images are BGR, the screen is RGB)
+    # the sky is always masked, even when only a few pixels of it are (unlike _get_template),
+    # otherwise a mostly sky template like the vine matches the sky anywhere
+    mask = np.uint8(np.where(np.all(image == MASK_COLOUR, axis=2), 0, 1))
+    if mask.all():
+        mask = None
+    dimensions = tuple(indices.shape[::-1])
+    if flip:
+        indices, mask = cv.flip(indices, 1), (None if mask is None else cv.flip(mask, 1))
+    return indices, mask, dimensions
+
+def _swapped_palette_templates(category, object_templates):
+    # versions of the templates in the PALETTE_SWAPS colours, for the templates that have them
+    swapped = []
+    for categories, swap in PALETTE_SWAPS:
+        if category not in categories:
+            continue
+        table = np.arange(256, dtype=np.uint8)
+        for old, new in swap.items():
+            table[PALETTE_LOOKUP[_palette_key(old)]] = PALETTE_LOOKUP[_palette_key(new)]
+        for indices, mask, dimensions in object_templates:
+            if (table[indices] != indices).any():
+                swapped.append((table[indices], mask, dimensions))
+    return swapped
+
+def _build_palette_templates():
+    # the same structure as _build_templates, with the swapped versions after the others
+    palette = {}
+    for category in image_files:
+        palette[category] = {}
+        for object_name, filenames in image_files[category].items():
+            flipped = category in include_flipped or object_name in include_flipped
+            object_templates = [_get_palette_template(filename, flip)
+                                for filename in filenames for flip in ((False, True) if flipped else (False,))]
+            palette[category][object_name] = object_templates + _swapped_palette_templates(category, object_templates)
+    return palette
+
+palette_templates = _LazyTemplates(_build_palette_templates)
 
 #the grid printing functions originally in Lauren's code were not used in our project (even in debugging), so they have been removed
 
 ################################################################################
 # LOCATING OBJECTS
 
-def _locate_object(screen, templates, stop_early=False, threshold=MATCH_THRESHOLD):
+#addition: region is (x0, y0, x1, y1); only matches with their top left corner inside it are found
+def _search_area(screen, region, dimensions):
+    if region is None:
+        return screen, 0, 0
+    x0, y0, x1, y1 = region
+    width, height = dimensions
+    return screen[y0:y1 + height - 1, x0:x1 + width - 1], x0, y0
+
+#addition: match a half size template on a half size screen, and return the (smaller)
+# region of the full size screen where the template might be, or None if it's nowhere
+def _pyramid_region(area, half_template, half_mask, dimensions):
+    area_height, area_width = area.shape
+    half_area = cv.resize(area, (area_width//2, area_height//2), interpolation=cv.INTER_AREA)
+    half_width, half_height = half_template.shape[::-1]
+    if half_area.shape[0] < half_height or half_area.shape[1] < half_width:
+        return (0, 0, area_width - dimensions[0] + 1, area_height - dimensions[1] + 1)
+    results = cv.matchTemplate(half_area, half_template, cv.TM_CCOEFF_NORMED, mask=half_mask)
+    ys, xs = np.where(results >= PYRAMID_THRESHOLD)
+    if len(xs) == 0:
+        return None
+    # each half size pixel covers 2 full size pixels, plus a little slack for rounding
+    return (max(2*xs.min() - 2, 0), max(2*ys.min() - 2, 0),
+            min(2*xs.max() + 4, area_width - dimensions[0] + 1), min(2*ys.max() + 4, area_height - dimensions[1] + 1))
+
+def _match(screen, template, mask, dimensions, threshold, region=None, half_template=None):
+    #addition: search only inside region (and the pyramid's rough matches), returning screen coordinates
+    area, x_offset, y_offset = _search_area(screen, region, dimensions)
+    if area.shape[0] < dimensions[1] or area.shape[1] < dimensions[0]:
+        return [], []
+    if half_template is not None:
+        rough_region = _pyramid_region(area, half_template[0], half_template[1], dimensions)
+        if rough_region is None:
+            return [], []
+        area, rough_x, rough_y = _search_area(area, rough_region, dimensions)
+        x_offset, y_offset = x_offset + rough_x, y_offset + rough_y
+    results = cv.matchTemplate(area, template, cv.TM_CCOEFF_NORMED, mask=mask)
+    ys, xs = np.where(results >= threshold)
+    return ys + y_offset, xs + x_offset
+
+#addition: the "batched" engine. TM_CCOEFF_NORMED is split into the correlation of the screen
+# with the zero mean template, divided by the variance of the screen under the template's mask.
+# The screen is Fourier transformed once per search area and every template once (the first
+# time it's used), so each template only costs a multiply and an inverse transform. Templates
+# with the same mask share the variance, and unmasked ones get it from an integral image.
+_prepared_templates = {} # id(template) -> (template, its prepared version)
+FFT_MIN_AREA = SCREEN_HEIGHT*SCREEN_WIDTH//4 # smaller search areas are quicker to correlate directly
+
+def _spectrum(image):
+    # correlating through screen sized transforms is exact wherever the template fits inside image
+    padded = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH), np.float32)
+    padded[:image.shape[0], :image.shape[1]] = image
+    return cv.dft(padded)
+
+def _correlate(image, image_spectrum, template, template_spectrum):
+    if image_spectrum is None:
+        return cv.matchTemplate(image, template, cv.TM_CCORR)
+    product = cv.mulSpectrums(image_spectrum, template_spectrum, 0, conjB=True)
+    height, width = image.shape[0] - template.shape[0] + 1, image.shape[1] - template.shape[1] + 1
+    return cv.idft(product, flags=cv.DFT_REAL_OUTPUT | cv.DFT_SCALE)[:height, :width]
+
+def _prepare_template(template, mask):
+    prepared = _prepared_templates.get(id(template))
+    if prepared is not None and prepared[0] is template:
+        return prepared[1]
+    weights = np.ones(template.shape, np.float32) if mask is None else mask.astype(np.float32)
+    count = float(weights.sum())
+    zero_mean = (weights * (template - np.sum(weights * template) / count)).astype(np.float32)
+    mask_key = None if mask is None else mask.tobytes()
+    norm = max(float(np.sum(zero_mean**2)), 1e-6)
+    prepared = (count, norm, zero_mean, _spectrum(zero_mean), mask_key, weights, _spectrum(weights))
+    _prepared_templates[id(template)] = (template, prepared)
+    return prepared
+
+def _area_statistics(area, cache, key):
+    # transforms and window sums of a search area, shared by every template that searches it
+    if key not in cache:
+        centred = area.astype(np.float32) - 128 # smaller numbers keep the float32 transforms accurate
+        centred_squares = centred * centred
+        spectrum = square_spectrum = None
+        if area.size >= FFT_MIN_AREA:
+            spectrum, square_spectrum = _spectrum(centred), _spectrum(centred_squares)
+        sums, squares = cv.integral2(centred, sdepth=cv.CV_64F, sqdepth=cv.CV_64F)
+        cache[key] = (centred, centred_squares, spectrum, square_spectrum, sums, squares, {})
+    return cache[key]
+
+def _window_sums(integral, height, width, out_height, out_width):
+    return (integral[height:height + out_height, width:width + out_width] - integral[:out_height, width:width + out_width]
+            - integral[height:height + out_height, :out_width] + integral[:out_height, :out_width])
+
+def _match_group(screen, group, threshold, region=None, cache=None):
+    # match templates that all have the same size; returns the template index, y and x (in
+    # screen coordinates) and score of every match, in the order the loop engine finds them
+    width, height = dimensions = group[0][2]
+    area, x_offset, y_offset = _search_area(screen, region, dimensions)
+    if area.shape[0] < height or area.shape[1] < width:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty, empty, np.zeros(0, np.float32)
+    centred, centred_squares, spectrum, square_spectrum, sums, squares, variances = _area_statistics(
+        area, {} if cache is None else cache, (x_offset, y_offset) + area.shape)
+    out_height, out_width = area.shape[0] - height + 1, area.shape[1] - width + 1
+
+    found_indices, found_positions, found_scores = [], [], []
+    for i, (template, mask, _) in enumerate(group):
+        count, norm, zero_mean, template_spectrum, mask_key, weights, mask_spectrum = _prepare_template(template, mask)
+        variance_key = (dimensions, mask_key)
+        if variance_key not in variances:
+            if mask is None:
+                total = _window_sums(sums, height, width, out_height, out_width)
+                total_squares = _window_sums(squares, height, width, out_height, out_width)
+            else:
+                total = _correlate(centred, spectrum, weights, mask_spectrum)
+                total_squares = _correlate(centred_squares, square_spectrum, weights, mask_spectrum)
+            variance = total_squares - total * total / count
+            # the standard deviation of each window, times the template's count (infinite if it's flat)
+            spread = np.sqrt(np.maximum(variance, 0), dtype=np.float32)
+            spread[variance <= MIN_VARIANCE * count] = np.inf
+            variances[variance_key] = spread
+        spread = variances[variance_key]
+        numerator = _correlate(centred, spectrum, zero_mean, template_spectrum)
+        # score >= threshold, without dividing every window by its spread
+        positions = np.flatnonzero(numerator >= spread * np.float32(threshold * np.sqrt(norm)))
+        if len(positions):
+            found_indices.append(np.full(len(positions), i))
+            found_positions.append(positions)
+            found_scores.append(numerator.flat[positions] / (spread.flat[positions] * np.sqrt(norm)))
+    if not found_indices:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty, empty, np.zeros(0, np.float32)
+    ys, xs = np.divmod(np.concatenate(found_positions), out_width)
+    return np.concatenate(found_indices), ys + y_offset, xs + x_offset, np.concatenate(found_scores)
+
+def _suppress(ys, xs, scores):
+    # non-maximum suppression: keep the matches with the best score within MATCH_NMS_RADIUS
+    best = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH), np.float32)
+    np.maximum.at(best, (ys, xs), scores)
+    size = 2*MATCH_NMS_RADIUS + 1
+    return best[ys, xs] >= cv.dilate(best, np.ones((size, size), np.uint8))[ys, xs]
+
+def _locate_object_batched(screen, templates, stop_early, threshold, region, cache):
+    if stop_early:
+        # try the templates in order, so the rest can be skipped once one matches
+        groups = [[i] for i in range(len(templates))]
+    else:
+        by_size = {}
+        for i, (template, mask, dimensions) in enumerate(templates):
+            by_size.setdefault(dimensions, []).append(i)
+        groups = list(by_size.values())
+    found_indices, found_ys, found_xs, found_scores = [], [], [], []
+    for group in groups:
+        indices, ys, xs, scores = _match_group(screen, [templates[i] for i in group], threshold, region, cache)
+        found_indices.append(np.asarray(group)[indices])
+        found_ys.append(ys)
+        found_xs.append(xs)
+        found_scores.append(scores)
+        if stop_early and len(indices):
+            break
+    if not found_indices:
+        return []
+    # put the matches in template order, then keep one per location (with the size of the last
+    # template that matched there, like the loop engine's dictionary)
+    order = np.argsort(np.concatenate(found_indices), kind="stable")
+    indices = np.concatenate(found_indices)[order]
+    ys, xs = np.concatenate(found_ys)[order], np.concatenate(found_xs)[order]
+    if MATCH_NMS_RADIUS > 0:
+        keep = _suppress(ys, xs, np.concatenate(found_scores)[order])
+        indices, ys, xs = indices[keep], ys[keep], xs[keep]
+    keys = ys * SCREEN_WIDTH + xs
+    _, first = np.unique(keys, return_index=True)
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    first_order = np.argsort(first)
+    return [((x, y), templates[i][2]) for x, y, i in
+            zip(xs[first[first_order]].tolist(), ys[first[first_order]].tolist(), indices[last[first_order]].tolist())]
+
+#addition: the "palette" engine. The screen is turned into palette indices once per frame (see
+# to_palette), and a template's score at each position is the fraction of its (unmasked) pixels
+# that are exactly the same colour there, i.e. one minus the Hamming distance. That's the sum, over
+# the template's few colours, of correlating the screen's pixels of that colour with the template's.
+# Templates whose colours aren't in the search area enough to reach the thresholds anywhere (most
+# of them, on most frames) are skipped without correlating anything.
+_prepared_palette = {} # id(palette template) -> (template, its prepared version)
+
+def _prepare_palette_template(indices, mask):
+    prepared = _prepared_palette.get(id(indices))
+    if prepared is not None and prepared[0] is indices:
+        return prepared[1]
+    weights = np.ones(indices.shape, bool) if mask is None else mask.astype(bool)
+    colours = []
+    for colour in np.unique(indices[weights]).tolist():
+        plane = ((indices == colour) & weights).astype(np.float32)
+        colours.append((colour, plane, int(plane.sum())))
+    colours.sort(key=lambda c: -c[2])
+    prepared = (colours, int(weights.sum()))
+    _prepared_palette[id(indices)] = (indices, prepared)
+    return prepared
+
+def _palette_area(area, cache, key):
+    # colour counts of a search area, and its pixels of each colour (made when first needed)
+    if key not in cache:
+        cache[key] = (np.bincount(area.ravel(), minlength=256), {})
+    return cache[key]
+
+def _match_palette(screen, indices, mask, dimensions, threshold, region=None, cache=None):
+    area, x_offset, y_offset = _search_area(screen, region, dimensions)
+    if area.shape[0] < dimensions[1] or area.shape[1] < dimensions[0]:
+        return [], []
+    counts, planes = _palette_area(area, {} if cache is None else cache, ("palette", x_offset, y_offset) + area.shape)
+    colours, count = _prepare_palette_template(indices, mask)
+    if count == 0:
+        return [], []
+    needed = threshold * count - 0.5 # (the correlations are floats)
+    # it can't match anywhere if the area doesn't have enough pixels of its colours
+    main_colours = colours[:PALETTE_MAIN_COLOURS]
+    if any(counts[colour] < PALETTE_COLOUR_THRESHOLD * pixels for colour, _, pixels in main_colours):
+        return [], []
+    if sum(min(counts[colour], pixels) for colour, _, pixels in colours) < needed:
+        return [], []
+    matches, main_present = None, None
+    for i, (colour, plane, pixels) in enumerate(colours):
+        if counts[colour] == 0:
+            continue
+        if colour not in planes:
+            planes[colour] = (area == colour).astype(np.float32)
+        result = cv.matchTemplate(planes[colour], plane, cv.TM_CCORR)
+        matches = result if matches is None else matches + result
+        # the main colours have to be there, so e.g. the mostly green vine doesn't match every bush,
+        # but a less common colour can be different (e.g. the highlights of 4-1's ground blocks)
+        if i < PALETTE_MAIN_COLOURS:
+            present = result >= PALETTE_COLOUR_THRESHOLD * pixels - 0.5
+            main_present = present if main_present is None else main_present & present
+    ys, xs = np.where((matches >= needed) & main_present)
+    return ys + y_offset, xs + x_offset
+
+def _locate_object_palette(screen, object_templates, stop_early, threshold, region, cache):
+    locations = {}
+    for template, mask, dimensions in object_templates:
+        for y, x in zip(*_match_palette(screen, template, mask, dimensions, threshold, region, cache)):
+            locations[(int(x), int(y))] = dimensions
+        if stop_early and locations:
+            break
+    return [(location, locations[location]) for location in locations]
+
+_palette_versions = {} # id(greyscale template list) -> (list, the palette templates of the same object)
+
+def _palette_version(object_templates):
+    # the palette templates of the object whose greyscale templates these are
+    version = _palette_versions.get(id(object_templates))
+    if version is None or version[0] is not object_templates:
+        version = (object_templates, []) # e.g. an empty list when there are no templates for Mario's status
+        for category in templates:
+            for object_name in templates[category]:
+                if templates[category][object_name] is object_templates:
+                    version = (object_templates, palette_templates[category][object_name])
+        _palette_versions[id(object_templates)] = version
+    return version[1]
+
+#addition: the screen that templates are matched on, for the match engine being used
+def _matching_screen(screen):
+    if MATCH_ENGINE == "palette":
+        return to_palette(screen)
+    return cv.cvtColor(screen, cv.COLOR_BGR2GRAY)
+
+#edit: cache holds what the batched engine has worked out about this screen, so it's shared between calls
+def _locate_object(screen, templates, stop_early=False, threshold=MATCH_THRESHOLD, region=None, half_templates=None, cache=None):
+    #addition: the palette engine searches the palette templates of the same object (without the pyramid)
+    if MATCH_ENGINE == "palette":
+        threshold = PALETTE_THRESHOLD if threshold == MATCH_THRESHOLD else threshold
+        return _locate_object_palette(screen, _palette_version(templates), stop_early, threshold, region, cache)
+    #addition: the pyramid already narrows each template's search down separately, so it uses the loop
+    if MATCH_ENGINE == "batched" and half_templates is None:
+        return _locate_object_batched(screen, templates, stop_early, threshold, region, cache)
+
     locations = {}
-    for template, mask, dimensions in templates:
-        results = cv.matchTemplate(screen, template, cv.TM_CCOEFF_NORMED, mask=mask)
-        locs = np.where(results >= threshold)
+    for i, (template, mask, dimensions) in enumerate(templates):
+        #edit: _match can restrict the search to a region, and use the pyramid
+        half_template = half_templates[i] if half_templates is not None else None
+        locs = _match(screen, template, mask, dimensions, threshold, region, half_template)
         for y, x in zip(*locs):
             locations[(x, y)] = dimensions
 
@@ -144,21 +707,63 @@ def _locate_object(screen, templates, stop_early=False, threshold=MATCH_THRESHOL
     #      [((x,y), (width,height))]
     return [( loc,  locations[loc]) for loc in locations]
 
-def _locate_pipe(screen, threshold=MATCH_THRESHOLD):
+#addition: join up the pipe pieces with array operations instead of looking up every piece
+def _assemble_pipes(upper_ys, upper_xs, lower_ys, lower_xs):
+    upper_width, upper_height = templates["block"]["pipe"][0][2]
+    lower_height = templates["block"]["pipe"][1][2][1]
+    lower = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH), bool)
+    lower[lower_ys, lower_xs] = True
+    heights = np.arange(upper_height, SCREEN_HEIGHT, lower_height)
+    rows = upper_ys[:, None] + heights[None, :]
+    columns = np.broadcast_to(upper_xs[:, None] + 2, rows.shape)
+    inside = (rows < SCREEN_HEIGHT) & (columns < SCREEN_WIDTH)
+    present = np.zeros(rows.shape, bool)
+    present[inside] = lower[rows[inside], columns[inside]]
+    # each pipe ends where the first lower part is missing
+    ends = np.argmin(present, axis=1)
+    complete = ~present.all(axis=1)
+    return [((x, y), (upper_width, h), "pipe") for x, y, h in
+            zip(upper_xs[complete].tolist(), upper_ys[complete].tolist(), heights[ends[complete]].tolist())]
+
+#edit: cache is passed on to the batched engine
+def _locate_pipe(screen, threshold=MATCH_THRESHOLD, region=None, cache=None):
     upper_template, upper_mask, upper_dimensions = templates["block"]["pipe"][0]
     lower_template, lower_mask, lower_dimensions = templates["block"]["pipe"][1]
 
+    #addition: the palette engine finds the pieces in colour, then puts them together like the batched one
+    if MATCH_ENGINE == "palette":
+        threshold = PALETTE_THRESHOLD if threshold == MATCH_THRESHOLD else threshold
+        upper, lower = palette_templates["block"]["pipe"][:2]
+        upper_ys, upper_xs = _match_palette(screen, *upper, threshold, region, cache)
+        if not len(upper_ys):
+            return []
+        if region is not None:
+            region = (region[0], region[1], region[2], SCREEN_HEIGHT)
+        lower_ys, lower_xs = _match_palette(screen, *lower, threshold, region, cache)
+        return _assemble_pipes(np.asarray(upper_ys), np.asarray(upper_xs), np.asarray(lower_ys), np.asarray(lower_xs))
+    #addition: the batched engine finds the pieces and puts them together with arrays
+    if MATCH_ENGINE == "batched":
+        _, upper_ys, upper_xs, _ = _match_group(screen, [templates["block"]["pipe"][0]], threshold, region, cache)
+        if not len(upper_ys):
+            return []
+        if region is not None:
+            region = (region[0], region[1], region[2], SCREEN_HEIGHT)
+        _, lower_ys, lower_xs, _ = _match_group(screen, [templates["block"]["pipe"][1]], threshold, region, cache)
+        return _assemble_pipes(upper_ys, upper_xs, lower_ys, lower_xs)
+
     # find the upper part of the pipe
-    upper_results = cv.matchTemplate(screen, upper_template, cv.TM_CCOEFF_NORMED, mask=upper_mask)
-    upper_locs = list(zip(*np.where(upper_results >= threshold)))
+    #edit: _match can restrict the search to a region
+    upper_locs = list(zip(*_match(screen, upper_template, upper_mask, upper_dimensions, threshold, region)))
     
     # stop early if there are no pipes
     if not upper_locs:
         return []
     
     # find the lower part of the pipe
-    lower_results = cv.matchTemplate(screen, lower_template, cv.TM_CCOEFF_NORMED, mask=lower_mask)
-    lower_locs = set(zip(*np.where(lower_results >= threshold)))
+    #addition: the lower parts can go below the region, so search all the way down
+    if region is not None:
+        region = (region[0], region[1], region[2], SCREEN_HEIGHT)
+    lower_locs = set(zip(*_match(screen, lower_template, lower_mask, lower_dimensions, threshold, region)))
 
     # put the pieces together
     upper_width, upper_height = upper_dimensions
@@ -171,9 +776,25 @@ def _locate_pipe(screen, threshold=MATCH_THRESHOLD):
                 break
     return locations
 
-def locate_objects(screen, mario_status):
+#addition: the region around (x, y) with the given radii, clipped to the screen below the HUD
+def _region_around(x, y, radius_x, radius_y):
+    return (max(x - radius_x, 0), max(y - radius_y, HUD_HEIGHT),
+            min(x + radius_x, SCREEN_WIDTH), min(y + radius_y, SCREEN_HEIGHT))
+
+#edit: mode is one of the DETECTION_MODEs, and mario_hint is where Mario was last seen (or None)
+def locate_objects(screen, mario_status, mode=None, mario_hint=None):
+    if mode is None:
+        mode = DETECTION_MODE
     # convert to greyscale
-    screen = cv.cvtColor(screen, cv.COLOR_BGR2GRAY)
+    #edit: or palette indices, for the palette match engine
+    screen = _matching_screen(screen)
+    cache = {} #addition: shared by every search of this screen
+
+    #addition: work out where to search for mario (the rest is decided once he's found)
+    region = None
+    pyramid = None
+    if mode != "full" and mario_hint is not None:
+        region = _region_around(mario_hint[0], mario_hint[1], MARIO_SEARCH_RADIUS, MARIO_SEARCH_RADIUS)
 
     # iterate through our templates data structure
     object_locations = {}
@@ -181,6 +802,14 @@ def locate_objects(screen, mario_status):
         category_templates = templates[category]
         category_items = []
         stop_early = False
+        #addition: once Mario has been found, only search around him
+        if category != "mario" and mode != "full":
+            region = None
+            if object_locations["mario"]:
+                mario_x, mario_y = object_locations["mario"][0][0]
+                region = _region_around(mario_x, mario_y, ROI_RADIUS_X, ROI_RADIUS_Y)
+            if mode == "pyramid":
+                pyramid = half_templates[category]
         for object_name in category_templates:
             # use mario_status to determine which type of mario to look for
             if category == "mario":
@@ -193,23 +822,200 @@ def locate_objects(screen, mario_status):
                 continue
             
             # find locations of objects
-            results = _locate_object(screen, category_templates[object_name], stop_early)
+            #edit: only search the region (and use the pyramid) when using a faster mode
+            object_pyramid = pyramid[object_name] if pyramid is not None else None
+            results = _locate_object(screen, category_templates[object_name], stop_early,
+                                     region=region, half_templates=object_pyramid, cache=cache)
+            #addition: look everywhere if Mario isn't near where he was last seen
+            if category == "mario" and not results and region is not None:
+                results = _locate_object(screen, category_templates[object_name], stop_early, cache=cache)
             for location, dimensions in results:
                 category_items.append((location, dimensions, object_name))
 
         object_locations[category] = category_items
 
     # locate pipes
-    object_locations["block"] += _locate_pipe(screen)
+    object_locations["block"] += _locate_pipe(screen, region=region, cache=cache)
 
     return object_locations
 
+################################################################################
+# TRACKING OBJECTS BETWEEN FRAMES
+#addition: this whole section
+
+TRACKER_REFRESH = 120 # search the whole screen at least this often (calls), to catch changes like broken blocks
+TRACKER_MOVE_RADIUS = 24 # how far around its last location to look for each moving object
+TRACKER_DANGER_X = 72 # always look for enemies this far left/right of Mario (what make_action checks)
+TRACKER_DANGER_Y = 24 # and this far above/below him
+SCROLL_TOLERANCE = 12.0 # mean greyscale difference above which the screen is treated as a new scene
+
+# blocks and pipes don't move, so they're remembered between frames
+STATIC_CATEGORIES = {"block"}
+
+def _merge_regions(regions):
+    # merge overlapping (x0, y0, x1, y1) regions, so the same pixels aren't searched twice
+    merged = []
+    for region in sorted(regions):
+        for i, other in enumerate(merged):
+            if region[0] <= other[2] and other[0] <= region[2] and region[1] <= other[3] and other[1] <= region[3]:
+                merged[i] = (min(region[0], other[0]), min(region[1], other[1]),
+                             max(region[2], other[2]), max(region[3], other[3]))
+                break
+        else:
+            merged.append(region)
+    return merged
+
+class ObjectTracker:
+    """
+    Locate objects incrementally, instead of searching the whole screen every frame.
+
+    Consecutive frames only differ by a horizontal scroll and a few moving
+    sprites, so blocks and pipes are remembered in world coordinates and only
+    the newly scrolled-in strip on the right is searched for new ones. Mario,
+    enemies and items are searched for around where they were last seen and
+    in the new strip; enemies are also searched for in the area around Mario
+    that make_action checks, and piranha plants above pipes. Everything is
+    searched again after a death, a stage change, a scene change (e.g. going
+    down a pipe) or every TRACKER_REFRESH calls.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.scene = None # (world, stage, life) the cached objects belong to
+        self.previous_screen = None
+        self.previous_x = 0
+        self.camera_x = 0 # world x coordinate of the left edge of the screen
+        self.static = [] # [(world_x, y), (width, height), name, category]
+        self.moving = {} # category -> the last object locations
+        self.calls = 0
+
+    def update(self, screen, info):
+        """Return the object locations for this frame, in the same format as locate_objects."""
+        gray = cv.cvtColor(screen, cv.COLOR_BGR2GRAY)
+        scene = (info["world"], info["stage"], info["life"])
+        scroll = None
+        if scene == self.scene and self.calls < TRACKER_REFRESH:
+            scroll = self._scroll(gray, info["x_pos"] - self.previous_x)
+        if scroll is None:
+            object_locations = self._refresh(screen, info)
+        else:
+            # (the scroll is always found in greyscale, the objects with the match engine's screen)
+            object_locations = self._track(gray if MATCH_ENGINE != "palette" else to_palette(screen), info, scroll)
+        self.scene = scene
+        self.previous_screen = gray
+        self.previous_x = info["x_pos"]
+        return object_locations
+
+    def _scroll(self, gray, x_change):
+        # the screen only scrolls right, and never further than Mario moved, so try every
+        # scroll from 0 to x_change and keep the one that lines the two frames up best
+        previous = self.previous_screen[HUD_HEIGHT::2]
+        current = gray[HUD_HEIGHT::2]
+        best_scroll, best_difference = None, SCROLL_TOLERANCE
+        for scroll in range(0, min(max(x_change, 0), SCREEN_WIDTH//2) + 1):
+            difference = np.mean(cv.absdiff(previous[:, scroll:], current[:, :SCREEN_WIDTH - scroll]))
+            if difference < best_difference:
+                best_scroll, best_difference = scroll, difference
+        return best_scroll
+
+    def _refresh(self, screen, info):
+        object_locations = locate_objects(screen, info["status"], "full")
+        self.calls = 0
+        self.camera_x = 0
+        self.static = [(location, dimensions, name, category)
+                       for category in STATIC_CATEGORIES for location, dimensions, name in object_locations[category]]
+        self.moving = {category: object_locations[category] for category in object_locations
+                       if category not in STATIC_CATEGORIES}
+        return object_locations
+
+    def _track(self, gray, info, scroll):
+        self.calls += 1
+        self.camera_x += scroll
+        cache = {} # shared by every search of this screen
+        # regions of the screen that could contain something new
+        strip = (max(SCREEN_WIDTH - scroll - 32, 0), HUD_HEIGHT, SCREEN_WIDTH, SCREEN_HEIGHT)
+
+        # move the remembered blocks with the screen, and add any in the new strip
+        object_locations = {category: [] for category in templates}
+        known = set()
+        for (world_x, y), dimensions, name, category in self.static:
+            if world_x - self.camera_x >= 0:
+                object_locations[category].append(((world_x - self.camera_x, y), dimensions, name))
+                known.add((world_x, y, name))
+        if scroll > 0:
+            for category in STATIC_CATEGORIES:
+                found = []
+                for object_name in templates[category]:
+                    if object_name == "pipe":
+                        found += _locate_pipe(gray, region=strip, cache=cache)
+                        continue
+                    for location, dimensions in _locate_object(gray, templates[category][object_name], region=strip, cache=cache):
+                        found.append((location, dimensions, object_name))
+                for (x, y), dimensions, name in found:
+                    if (x + self.camera_x, y, name) not in known:
+                        object_locations[category].append(((x, y), dimensions, name))
+                        known.add((x + self.camera_x, y, name))
+        self.static = [((x + self.camera_x, y), dimensions, name, category)
+                       for category in STATIC_CATEGORIES for (x, y), dimensions, name in object_locations[category]]
+
+        # look for Mario around where he was
+        mario = self.moving.get("mario")
+        mario_hint = (mario[0][0][0] - scroll, mario[0][0][1]) if mario else None
+        region = None
+        if mario_hint is not None:
+            region = _region_around(mario_hint[0], mario_hint[1], MARIO_SEARCH_RADIUS, MARIO_SEARCH_RADIUS)
+        results = _locate_object(gray, templates["mario"].get(info["status"], []), True, region=region, cache=cache)
+        if not results and region is not None:
+            results = _locate_object(gray, templates["mario"].get(info["status"], []), True, cache=cache)
+        object_locations["mario"] = [(location, dimensions, info["status"]) for location, dimensions in results]
+
+        # look for the moving objects around where they were and in the new strip, and for
+        # new enemies near Mario (e.g. dropping off a ledge) and piranha plants above pipes
+        near_mario = []
+        if object_locations["mario"]:
+            near_mario = [_region_around(*object_locations["mario"][0][0], TRACKER_DANGER_X, TRACKER_DANGER_Y)]
+        above_pipes = [(x, max(y - TRACKER_MOVE_RADIUS, HUD_HEIGHT), x + width, y)
+                       for (x, y), (width, height), name in object_locations["block"] if name == "pipe"]
+        for category in templates:
+            if category == "mario" or category in STATIC_CATEGORIES:
+                continue
+            regions = [strip]
+            if category == "enemy":
+                regions += near_mario
+            elif category == "hard_enemy":
+                regions += near_mario + above_pipes
+            for (x, y), dimensions, name in self.moving.get(category, []):
+                regions.append(_region_around(x - scroll, y, TRACKER_MOVE_RADIUS, TRACKER_MOVE_RADIUS))
+            found = {}
+            for region in _merge_regions(regions):
+                for object_name in templates[category]:
+                    for location, dimensions in _locate_object(gray, templates[category][object_name], region=region, cache=cache):
+                        found[location] = (location, dimensions, object_name)
+            object_locations[category] = list(found.values())
+
+        self.moving = {category: object_locations[category] for category in object_locations
+                       if category not in STATIC_CATEGORIES}
+        return object_locations
+
 ################################################################################
 # GETTING INFORMATION AND CHOOSING AN ACTION
 
-def make_action(screen, info, step, env, prev_action):
+#addition: where Mario was found on the previous call, so the faster detection modes know where to look
+last_mario_location = None
+
+#edit: tracker is an optional ObjectTracker, to locate objects incrementally
+def make_action(screen, info, step, env, prev_action, tracker=None):
+    global last_mario_location
     mario_status = info["status"]
-    object_locations = locate_objects(screen, mario_status)
+    #edit: read the objects from memory if PERCEPTION is "ram"
+    if PERCEPTION == "ram":
+        object_locations = locate_objects_ram(get_nes_env(env).ram, mario_status)
+    elif tracker is not None:
+        object_locations = tracker.update(screen, info)
+    else:
+        object_locations = locate_objects(screen, mario_status, DETECTION_MODE, last_mario_location)
 
     # List of locations of Mario:
     mario_locations = object_locations["mario"]
@@ -239,13 +1045,14 @@ def make_action(screen, info, step, env, prev_action):
     #addition: defaults for mario's location based on where he's most likely located on the screen, for if the agent can't find him for whatever reason
     mario_x = 120
     mario_y = 79
+    mario_dimensions = (16, 16)
     #edit: check mario's location and set the variables no matter what, since they're used in the decision making code
     if mario_locations:
         location, dimensions, object_name = mario_locations[0]
         mario_x, mario_y = location
-        #addition: avoid breaking by adjusting Mario's coordinates if he's big, since the locating code measures from the top-right corner
-        if info["status"] != 'small':
-            mario_y -= 16
+        last_mario_location = location
+        #edit: keep his size (with DECISIONS = "grid", big Mario's coordinates aren't moved up 16 pixels, which put his feet a block too high)
+        mario_dimensions = dimensions
     if PRINT_LOCATIONS:
         # To get the information out of a list:
         for enemy in enemy_locations:
@@ -286,6 +1093,29 @@ def make_action(screen, info, step, env, prev_action):
         print("Mario's location in world:",
               mario_world_x, mario_world_y, f"({mario_status} mario)")
     #addition: all decision making code below
+    #edit: the decisions are in choose_action, so the planner's simulations can use them too (see marioPlanner.py)
+    return choose_action(object_locations, ((mario_x, mario_y), mario_dimensions), mario_status)
+
+#addition: the decision making code of make_action
+def choose_action(object_locations, mario, status, decisions=None):
+    """
+    :param object_locations: (dict) the located objects, from locate_objects or locate_objects_ram
+    :param mario: (((int, int), (int, int))) Mario's location and dimensions
+    :param status: (str) Mario's status from the info dict ("small", "tall" or "fireball")
+    :param decisions: (str) "objects" or "grid", or None for DECISIONS
+    :return: (int) the COMPLEX_MOVEMENT action to take
+    """
+    if (decisions or DECISIONS) == "grid":
+        return _choose_action_grid(object_locations, mario)
+    block_locations = object_locations["block"]
+    enemy_locations = object_locations["enemy"]
+    hard_enemy_locations = object_locations["hard_enemy"]
+    (mario_x, mario_y), mario_dimensions = mario
+    #addition: avoid breaking by adjusting Mario's coordinates if he's big, since the locating code measures from the top-right corner
+    #edit: the rules expect small Mario's top, which is 16 pixels above his feet, so big Mario is moved down 16 pixels
+    # (this moved him up 16 pixels, which put his feet a block too high, so he was almost never grounded)
+    if status != 'small':
+        mario_y += mario_dimensions[1] - 16
     #choose an action based on collected information
     hole = True
     grounded = False
@@ -316,7 +1146,9 @@ def make_action(screen, info, step, env, prev_action):
                     print("Mario coordinates:", mario_x, mario_y)
                 '''
                 return 4
-            if e[0][0] - mario_x in range(-1, -70) and e[0][1] - mario_y in range(-20, 20):
+            #edit: this looked at range(-1, -70), which is empty, so it never happened. It now looks one block behind
+            # Mario (jumping back from everything within 70 pixels behind him lost ground on most stages)
+            if e[0][0] - mario_x in range(-16, 0) and e[0][1] - mario_y in range(-20, 20):
                 #jump over enemies coming from behind
                 '''mass printing freezes the screen for debugging purposes
                 for i in range(250000):
@@ -334,7 +1166,9 @@ def make_action(screen, info, step, env, prev_action):
                     print("Mario coordinates:", mario_x, mario_y)
                 '''
                 return 4
-            if e[0][0] - mario_x in range(-1, -70) and e[0][1] - mario_y in range(-20, 20):
+            #edit: this looked at range(-1, -70), which is empty, so it never happened. It now looks one block behind
+            # Mario (jumping back from everything within 70 pixels behind him lost ground on most stages)
+            if e[0][0] - mario_x in range(-16, 0) and e[0][1] - mario_y in range(-20, 20):
                 #jump over enemies coming from behind
                 '''mass printing freezes the screen for debugging purposes
                 for i in range(250000):
@@ -343,6 +1177,38 @@ def make_action(screen, info, step, env, prev_action):
                 '''
                 return 9
         #space for more jumping responses
+
+    #space for more non-jumping responses
+    #by default run right
+    return 3
+
+#addition: the decisions with DECISIONS = "grid"
+def _choose_action_grid(object_locations, mario):
+    #edit: the decisions ask an occupancy grid of the screen (see marioGrid.py) instead of checking every object
+    grid = OccupancyGrid(object_locations)
+    if PRINT_LOCATIONS:
+        print(grid)
+    #choose an action based on collected information
+    #see if there's something to jump over, assuming you're grounded and can jump
+    if grid.grounded(mario):
+        #print('grounded')
+        if grid.pit_ahead(mario):
+            #jump when you're at the edge of a pit
+            return 4
+        #edit: only jump off the edge of a platform (onto lower ground) if there's an enemy where you'd land
+        if grid.pit_ahead(mario, LEDGE_LOOKAHEAD, depth=1) and grid.enemy_within(mario, LANDING_RANGE, below=True):
+            return 4
+        #jump over nearby enemies
+        if grid.enemy_within(mario, kinds=ENEMY):
+            return 4
+        #edit: only jump over unstompable enemies if the jump wouldn't go through them (e.g. piranha plants that are up), otherwise wait for them
+        if grid.enemy_within(mario, kinds=HAZARD):
+            return 0 if grid.jump_hits(mario, HAZARD) else 4
+        #jump over enemies coming from behind
+        #edit: this looked at range(-1, -70), which is empty, so it never happened
+        if grid.enemy_within(mario, BEHIND_RANGE, behind=True):
+            return 9
+        #space for more jumping responses
    
     #space for more non-jumping responses
     #by default run right
@@ -350,92 +1216,212 @@ def make_action(screen, info, step, env, prev_action):
 ################################################################################
 #end of Lauren's code
 
-#run from 1-1 with 3 lives
-env = gym.make("SuperMarioBros-v0", apply_api_compatibility=True, render_mode="human")
-#run from level of choice with 1 life
-#env = gym.make("SuperMarioBros-1-3-v0", apply_api_compatibility=True, render_mode="human")
-env = JoypadSpace(env, COMPLEX_MOVEMENT)
-
-obs, done = None, True
-env.reset()
-jumpCount, maxDist, blockedCount, triedSmall = 0, 0, 0, False
-lives = 3
-stage = (1,1)
-rewardSum, steps = 0,0
-for step in range(100000):
-    if jumpCount > 0:
-        #when jumping, keep holding jump to ensure a large jump is made
-        jumpCount -= 1
-        #print("JUMP!JUMP!JUMP!JUMP!JUMP!JUMP!JUMP!JUMP!" + str(jumpCount))
-        #the last few frames of the jump release the jump button to ensure the button isn't kept held down, which would prevent consecutive jumps
-        if jumpCount > 10:
-            action = 4
+################################################################################
+# RUNNING AN EPISODE
+#addition: the agent loop is a function, so it can be run many times (see ruleBasedRunner.py)
+
+NOOP_MAX = 30 # with a seed, wait seed % (NOOP_MAX + 1) frames at the start, so episodes differ
+STICKY_PROBABILITY = 0.1 # and with a seed, each step repeats the last action instead with this probability
+
+def run_episode(env, tracker=None, max_steps=100000, seed=None, planner=None, sticky=STICKY_PROBABILITY):
+    """
+    Play one episode with the rule-based agent.
+
+    The emulator and the agent are both deterministic, so a seed makes Mario
+    wait seed % (NOOP_MAX + 1) frames first, which changes where the enemies
+    are when he reaches them. That alone often isn't enough, since the game
+    only starts some things every 21 frames (so many waits end up the same),
+    so with a seed every step also repeats the last action pressed instead of
+    the new one with probability sticky ("sticky actions"), from a random
+    generator seeded with the seed. Without a seed there's no randomness.
+
+    With a planner, whenever make_action wants to do something other than run
+    right (and every PLAN_INTERVAL steps anyway), the planner simulates that and
+    the other candidate moves, and Mario takes the best one.
+
+    :param env: (gym.Env) Mario environment with the COMPLEX_MOVEMENT actions
+    :param tracker: (ObjectTracker) locate objects incrementally, or None
+    :param max_steps: (int) stop after this many steps even if the episode hasn't ended
+    :param seed: (int) seed for the random start and the sticky actions, or None for neither
+    :param planner: (Planner) choose moves by simulating them (see marioPlanner.py), or None
+    :param sticky: (float) with a seed, the probability of each step repeating the last action
+    :return: (dict) reward, steps, score, x_pos (the furthest Mario got), flag (whether
+        he reached a flag), world, stage and seconds
+    """
+    global last_mario_location
+    last_mario_location = None
+    if tracker is not None:
+        tracker.reset()
+    start = time.perf_counter()
+
+    obs, done = None, True
+    #addition: the planner has to get ready before the environment is reset
+    if planner is not None:
+        planner.reset(env)
+    env.reset()
+    #edit: every seed up to NOOP_MAX waits a different number of frames, and seeds the sticky actions
+    rng = None if seed is None else np.random.default_rng(seed)
+    if seed is not None:
+        #stand still for a number of frames first
+        for _ in range(seed % (NOOP_MAX + 1)):
+            env.step(0)
+            if planner is not None:
+                planner.record(0)
+    pressed = 0
+    jumpCount, maxDist, blockedCount, triedSmall = 0, 0, 0, False
+    lives = 3
+    stage = (1,1)
+    rewardSum, steps = 0,0
+    furthest, flag = 0, False
+    #addition: the rest of the move the planner chose, and when it last planned
+    plan, lastPlan = [], 0
+    for step in range(max_steps):
+        #addition: sometimes keep pressing the last action instead (only with a seed), before anything
+        # else is decided, so a repeat doesn't start a jump's count without pressing jump
+        if rng is not None and rng.random() < sticky:
+            action = pressed
+        elif plan:
+            action = plan.pop(0)
+        elif jumpCount > 0:
+            #when jumping, keep holding jump to ensure a large jump is made
+            jumpCount -= 1
+            #print("JUMP!JUMP!JUMP!JUMP!JUMP!JUMP!JUMP!JUMP!" + str(jumpCount))
+            #the last few frames of the jump release the jump button to ensure the button isn't kept held down, which would prevent consecutive jumps
+            if jumpCount > 10:
+                action = 4
+            else:
+                action = 3
+        elif jumpCount < 0:
+            #same as above for leftward jumps
+            jumpCount += 1
+            #print("JUMP?JUMP?JUMP?JUMP?JUMP?JUMP?JUMP?JUMP?" + str(jumpCount))
+            if jumpCount < -10:
+                action = 9
+            else:
+                action = 8
+        #if Mario hasn't moved right in a while, try jumping to clear blocks/pipes
+        elif blockedCount > 15 and not triedSmall:
+            #start with a small jump to ascend staircases
+            '''
+            for i in range(100000):
+                print("Blocked; jumping at short height...")
+            '''
+            action == 4
+            jumpCount = 15
+            blockedCount = 0
+            triedSmall = True
+        elif blockedCount > 35:
+            #do a full sized jump if the small one didn't work
+            '''
+            for i in range(100000):
+                print("Blocked; jumping at full height...")
+            '''
+            action == 4
+            jumpCount = 35
+            blockedCount = 0
+        elif obs is not None:
+            action = make_action(obs, info, step, env, action, tracker)
+            #addition: at decision points, let the planner choose between this and the other moves
+            if planner is not None and (action != 3 or step - lastPlan >= PLAN_INTERVAL):
+                plan = planner.plan(env, action)
+                action = plan.pop(0)
+                lastPlan = step
+            #if you begin to jump, set the jumpCount variables accordingly
+            #edit: (unless the planner has, since its moves say how long to jump for)
+            elif action == 4 and jumpCount == 0:
+                jumpCount = 35
+            elif action == 9 and jumpCount == 0:
+                jumpCount = -35
+        #run right as the first action + if the observation ever fails to be obtained
         else:
             action = 3
-    elif jumpCount < 0:
-        #same as above for leftward jumps
-        jumpCount += 1
-        #print("JUMP?JUMP?JUMP?JUMP?JUMP?JUMP?JUMP?JUMP?" + str(jumpCount))
-        if jumpCount < -10:
-            action = 9
-        else:
-            action = 8
-    #if Mario hasn't moved right in a while, try jumping to clear blocks/pipes
-    elif blockedCount > 15 and not triedSmall:
-        #start with a small jump to ascend staircases
-        '''
-        for i in range(100000):
-            print("Blocked; jumping at short height...")
+        pressed = action
+        obs, reward, terminated, truncated, info = env.step(action)
+        if planner is not None:
+            planner.record(action)
+        '''Debug print statements to display notable information to the terminal
+        print(action)
+        print("Action performed: " + str(COMPLEX_MOVEMENT[action]))
+        print(maxDist, blockedCount)
+        print('Reward: ' + str(reward))
         '''
-        action == 4
-        jumpCount = 15
-        blockedCount = 0
-        triedSmall = True
-    elif blockedCount > 35:
-        #do a full sized jump if the small one didn't work
-        '''
-        for i in range(100000):
-            print("Blocked; jumping at full height...")
-        '''
-        action == 4
-        jumpCount = 35
-        blockedCount = 0
-    elif obs is not None:
-        action = make_action(obs, info, step, env, action)
-        #if you begin to jump, set the jumpCount variables accordingly
-        if action == 4 and jumpCount == 0:
-            jumpCount = 35
-        elif action == 9 and jumpCount == 0:
-            jumpCount = -35
-    #run right as the first action + if the observation ever fails to be obtained
-    else:
-        action = 3
-    obs, reward, terminated, truncated, info = env.step(action)
-    '''Debug print statements to display notable information to the terminal
-    print(action)
-    print("Action performed: " + str(COMPLEX_MOVEMENT[action]))
-    print(maxDist, blockedCount)
-    print('Reward: ' + str(reward))
-    '''
-    rewardSum += reward
-    steps += 1
-    #check if Mario is still successfully moving right and start counting if he isn't
-    if info["x_pos"] > maxDist:
-        maxDist = info['x_pos']
-        blockedCount = 0
-        triedSmall = False
-    #reset max distance on death or stage clear
-    elif info["life"] < lives or (info["world"], info["stage"]) != stage:
-        maxDist = 0
-        lives = info['life']
-        stage = (info["world"], info["stage"])
-        #print("Current reward gained: " + str(rewardSum) + ", current steps: " + str(steps) + ", current score: " + str(info["score"]))
-    else:
-        blockedCount += 1
-
-    done = terminated or truncated
-    if done:
-        maxDist = 0
-        break
-print("Total reward gained: " + str(rewardSum) + ", total steps: " + str(steps) + ", total score: " + str(info["score"]))
-env.close()
+        rewardSum += reward
+        steps += 1
+        furthest = max(furthest, info["x_pos"])
+        flag = flag or bool(info["flag_get"])
+        #check if Mario is still successfully moving right and start counting if he isn't
+        if info["x_pos"] > maxDist:
+            maxDist = info['x_pos']
+            blockedCount = 0
+            triedSmall = False
+        #reset max distance on death or stage clear
+        elif info["life"] < lives or (info["world"], info["stage"]) != stage:
+            maxDist = 0
+            lives = info['life']
+            stage = (info["world"], info["stage"])
+            #print("Current reward gained: " + str(rewardSum) + ", current steps: " + str(steps) + ", current score: " + str(info["score"]))
+        else:
+            blockedCount += 1
+
+        done = terminated or truncated
+        if done:
+            maxDist = 0
+            break
+    return dict(reward=rewardSum, steps=steps, score=info["score"], x_pos=furthest, flag=flag,
+                world=info["world"], stage=info["stage"], seconds=time.perf_counter() - start)
+
+#addition: only run the agent when this file is run directly, so its functions can be imported
+if __name__ == "__main__":
+    #addition: --headless/--render-every/--video-dir (or MARIO_HEADLESS=1) to run without a window
+    parser = argparse.ArgumentParser(description="Run the rule-based Mario agent.")
+    add_render_arguments(parser)
+    #addition: --record DIR to record the episode so it can be replayed (see marioRecording.py)
+    add_recording_arguments(parser)
+    #addition: choose how objects are located (see DETECTION_MODE)
+    parser.add_argument("--detection", choices=["full", "roi", "pyramid"], default=DETECTION_MODE,
+                        help="how to locate objects on the screen")
+    #addition: choose how templates are matched (see MATCH_ENGINE)
+    parser.add_argument("--match-engine", choices=["loop", "batched", "palette"], default=MATCH_ENGINE,
+                        help="greyscale template matching one at a time or batched, or exact colour matching")
+    #addition: remember objects between frames (see ObjectTracker)
+    parser.add_argument("--track", action="store_true", help="locate objects incrementally between frames")
+    #addition: read objects from the emulator's memory instead (see PERCEPTION)
+    parser.add_argument("--perception", choices=["vision", "ram"], default=PERCEPTION,
+                        help="locate objects on the screen, or read them from memory")
+    #addition: choose how the located objects are turned into an action (see DECISIONS)
+    parser.add_argument("--decisions", choices=["objects", "grid"], default=DECISIONS,
+                        help="check every object against the rules, or ask an occupancy grid of the screen")
+    #addition: choose moves by simulating them ahead (see marioPlanner.py)
+    parser.add_argument("--plan", action="store_true", help="simulate the candidate moves at decision points and take the best")
+    parser.add_argument("--plan-workers", type=int, default=0, metavar="N",
+                        help="simulate the candidates in N worker processes (0 simulates them in the environment itself)")
+    parser.add_argument("--plan-budget", type=float, default=PLAN_BUDGET, metavar="SECONDS",
+                        help="time for simulating candidates per decision")
+    args = parser.parse_args()
+    DETECTION_MODE = args.detection
+    MATCH_ENGINE = args.match_engine
+    PERCEPTION = args.perception
+    DECISIONS = args.decisions
+    tracker = ObjectTracker() if args.track else None
+
+    #run from 1-1 with 3 lives
+    #edit: recorded to rule_based.mario with --record
+    record_path = None if args.record is None else os.path.join(args.record, "rule_based.mario")
+    env_id = "SuperMarioBros-v0"
+    env = make_mario(env_id, args.headless, args.render_every, args.video_dir,
+                     record_path=record_path, record_frames=args.record_frames)
+    #run from level of choice with 1 life
+    #env = make_mario("SuperMarioBros-1-3-v0", args.headless, args.render_every, args.video_dir)
+    env = JoypadSpace(env, COMPLEX_MOVEMENT)
+
+    #(the planner's workers are told which decisions to simulate, since they have their own copy of DECISIONS)
+    policy = partial(rule_policy, decisions=DECISIONS)
+    planner = Planner(args.plan_workers, env_id, args.plan_budget, policy=policy) if args.plan else None
+
+    #edit: the loop is now run_episode
+    result = run_episode(env, tracker, planner=planner)
+    print("Total reward gained: " + str(result["reward"]) + ", total steps: " + str(result["steps"]) + ", total score: " + str(result["score"]))
+    if planner is not None:
+        print(planner.summary())
+        planner.close()
+    env.close()
@@ -0,0 +1,215 @@
+import csv
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from nes_py.wrappers import JoypadSpace
+from gym_super_mario_bros.actions import COMPLEX_MOVEMENT
+import ruleBasedMario
+from marioWrappers import make_mario, stage_env_id
+from marioPlanner import Planner, PLAN_BUDGET
+
+# Run the rule-based agent on many stages at once, to see how changes to its rules
+# affect every stage.
+# e.g. "poetry run python ruleBasedRunner.py --seeds 4 --perception ram --output report.csv"
+
+################################################################################
+# CONSTANTS
+
+ALL_STAGES = ["{}-{}".format(world, stage) for world in range(1, 9) for stage in range(1, 5)]
+VERSION = "v0"  # ROM version of the environments, the same as ruleBasedMario.py
+SEEDS = 2  # Episodes per stage, each with a different random start
+MAX_EPISODE_STEPS = 10000  # Steps before an episode is cut off (the stage timer runs out before this)
+
+REPORT_FIELDS = [
+    "stage",
+    "episodes",
+    "completion_rate",
+    "mean_x_pos",
+    "max_x_pos",
+    "mean_reward",
+    "mean_steps",
+    "steps_per_second",
+]
+
+
+################################################################################
+# RUNNING EPISODES
+
+
+def _init_worker(
+    detection=ruleBasedMario.DETECTION_MODE,
+    perception=ruleBasedMario.PERCEPTION,
+    match_engine=ruleBasedMario.MATCH_ENGINE,
+    decisions=ruleBasedMario.DECISIONS,
+):
+    # every worker has its own copy of ruleBasedMario, so its settings are set in each one
+    # (also used by marioDataset.py, which only sets some of them)
+    ruleBasedMario.DETECTION_MODE = detection
+    ruleBasedMario.PERCEPTION = perception
+    ruleBasedMario.MATCH_ENGINE = match_engine
+    ruleBasedMario.DECISIONS = decisions
+
+
+def run_job(job):
+    """
+    Run the rule-based agent for one episode on one stage.
+
+    :param job: ((str, int, dict)) the stage, the seed, and the version, max_steps, track,
+        plan, plan_budget and sticky options
+    :return: (dict) the episode's result from run_episode, with its stage and seed
+    """
+    stage, seed, options = job
+    env = JoypadSpace(
+        make_mario(stage_env_id(stage, options["version"]), headless=True), COMPLEX_MOVEMENT
+    )
+    tracker = ruleBasedMario.ObjectTracker() if options["track"] else None
+    # (the candidates are simulated in the environment itself, since the pool's processes can't start workers)
+    planner = Planner(budget=options["plan_budget"]) if options["plan"] else None
+    result = ruleBasedMario.run_episode(env, tracker, options["max_steps"], seed, planner, options["sticky"])
+    env.close()
+    return dict(result, stage=stage, seed=seed)
+
+
+def run_jobs(
+    stages,
+    seeds,
+    processes=None,
+    version=VERSION,
+    max_steps=MAX_EPISODE_STEPS,
+    detection=ruleBasedMario.DETECTION_MODE,
+    perception=ruleBasedMario.PERCEPTION,
+    match_engine=ruleBasedMario.MATCH_ENGINE,
+    decisions=ruleBasedMario.DECISIONS,
+    track=False,
+    plan=False,
+    plan_budget=PLAN_BUDGET,
+    sticky=ruleBasedMario.STICKY_PROBABILITY,
+):
+    """
+    Run every stage with every seed, spreading the episodes over a process pool.
+
+    :param stages: ([str]) stages such as "1-1"
+    :param seeds: ([int]) seeds for the random starts, one episode per stage and seed
+    :param processes: (int) size of the process pool, defaults to the number of cores
+    :param version: (str) the ROM version
+    :param max_steps: (int) steps before an episode is cut off
+    :param detection: (str) ruleBasedMario's DETECTION_MODE
+    :param perception: (str) ruleBasedMario's PERCEPTION
+    :param match_engine: (str) ruleBasedMario's MATCH_ENGINE
+    :param decisions: (str) ruleBasedMario's DECISIONS
+    :param track: (bool) locate objects with an ObjectTracker
+    :param plan: (bool) choose moves with a Planner (see marioPlanner.py)
+    :param plan_budget: (float) the planner's seconds per decision
+    :param sticky: (float) the probability of each step repeating the last action
+    :return: ([dict]) the result of every episode
+    """
+    options = dict(version=version, max_steps=max_steps, track=track, plan=plan, plan_budget=plan_budget, sticky=sticky)
+    jobs = [(stage, seed, options) for stage in stages for seed in seeds]
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(detection, perception, match_engine, decisions)) as pool:
+        return list(pool.map(run_job, jobs))
+
+
+################################################################################
+# REPORT
+
+
+def summarise(results):
+    """
+    Summarise the episodes of each stage as the rows of a report.
+
+    :param results: ([dict]) episodes from run_jobs
+    :return: ([dict]) one row per stage (in the order they were run) with the REPORT_FIELDS keys
+    """
+    by_stage = {}
+    for result in results:
+        by_stage.setdefault(result["stage"], []).append(result)
+    return [
+        dict(
+            stage=stage,
+            episodes=len(episodes),
+            completion_rate=float(np.mean([e["flag"] for e in episodes])),
+            mean_x_pos=float(np.mean([e["x_pos"] for e in episodes])),
+            max_x_pos=max(e["x_pos"] for e in episodes),
+            mean_reward=float(np.mean([e["reward"] for e in episodes])),
+            mean_steps=float(np.mean([e["steps"] for e in episodes])),
+            steps_per_second=sum(e["steps"] for e in episodes) / sum(e["seconds"] for e in episodes),
+        )
+        for stage, episodes in by_stage.items()
+    ]
+
+
+def write_report(path, rows, results):
+    """
+    Write the report as CSV, or as JSON (including every episode) if path ends in .json.
+
+    :param path: (str) output file
+    :param rows: ([dict]) report rows from summarise
+    :param results: ([dict]) every episode
+    """
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(dict(stages=rows, episodes=results), f, indent=2, default=int)
+    else:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+################################################################################
+# COMMAND LINE
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the rule-based agent on many stages in parallel.")
+    parser.add_argument("--stages", nargs="+", default=ALL_STAGES, help="e.g. 1-1 1-2 (default: all 32)")
+    parser.add_argument("--seeds", type=int, default=SEEDS, help="episodes per stage")
+    parser.add_argument("--processes", type=int, default=None, help="size of the process pool")
+    parser.add_argument("--version", default=VERSION, help="ROM version of the environments")
+    parser.add_argument("--max-steps", type=int, default=MAX_EPISODE_STEPS, help="steps per episode")
+    parser.add_argument("--detection", choices=["full", "roi", "pyramid"], default=ruleBasedMario.DETECTION_MODE)
+    parser.add_argument("--perception", choices=["vision", "ram"], default=ruleBasedMario.PERCEPTION)
+    parser.add_argument("--match-engine", choices=["loop", "batched", "palette"], default=ruleBasedMario.MATCH_ENGINE)
+    parser.add_argument("--decisions", choices=["objects", "grid"], default=ruleBasedMario.DECISIONS)
+    parser.add_argument("--track", action="store_true", help="locate objects incrementally between frames")
+    parser.add_argument("--plan", action="store_true", help="simulate the candidate moves at decision points")
+    parser.add_argument("--plan-budget", type=float, default=PLAN_BUDGET, help="seconds per decision")
+    parser.add_argument(
+        "--sticky",
+        type=float,
+        default=ruleBasedMario.STICKY_PROBABILITY,
+        help="probability of each step repeating the last action (0 for only the random start)",
+    )
+    parser.add_argument("--output", default="rule_based_report.csv", help="report file (.csv or .json)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print("Running {} stages with {} seeds".format(len(args.stages), args.seeds))
+    results = run_jobs(
+        args.stages,
+        range(args.seeds),
+        processes=args.processes,
+        version=args.version,
+        max_steps=args.max_steps,
+        detection=args.detection,
+        perception=args.perception,
+        match_engine=args.match_engine,
+        decisions=args.decisions,
+        track=args.track,
+        plan=args.plan,
+        plan_budget=args.plan_budget,
+        sticky=args.sticky,
+    )
+    rows = summarise(results)
+    write_report(args.output, rows, results)
+
+    print(f"{'stage':>6} {'completed':>9} {'mean x_pos':>10} {'max x_pos':>9} {'mean reward':>11} {'steps/sec':>9}")
+    for row in rows:
+        print(
+            f"{row['stage']:>6} {row['completion_rate']:>9.2f} {row['mean_x_pos']:>10.1f} {row['max_x_pos']:>9}"
+            f" {row['mean_reward']:>11.1f} {row['steps_per_second']:>9.1f}"
+        )
+    print("Report written to " + args.output)
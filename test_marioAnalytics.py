@@ -0,0 +1,21 @@
+from marioAnalytics import Curve
+
+# Run with "poetry run python -m pytest test_marioAnalytics.py"
+
+
+def test_curve_at_inside_first_bin():
+    curve = Curve(bin_steps=1000)
+    curve.add(300, 1.0)
+    curve.add(900, 2.0)  # (replaces the 300 point, the same bin)
+    curve.add(1500, 3.0)
+    assert curve.at(100) == 2.0  # before the bin's point, but in the bin
+    assert curve.at(900) == 2.0
+    assert curve.at(1200) == 3.0
+    assert curve.at(5000) == 3.0
+
+
+def test_curve_at_before_first_bin():
+    curve = Curve(bin_steps=1000)
+    curve.add(2500, 4.0)
+    assert curve.at(10) == 4.0
+    assert Curve().at(10) is None